@@ -5,3 +5,7 @@ class dot_extConfig(AppConfig):
     name = 'apps.dot_ext'
     label = 'dot_ext'
     verbose_name = 'Django OAuth Toolkit Extension'
+
+    def ready(self):
+        # connect the token cache invalidation signals
+        from . import token_cache  # noqa
@@ -24,6 +24,29 @@ class SingleAccessTokenValidator(OAuth2Validator):
     it instead of creating a new one.
     """
 
+    def validate_bearer_token(self, token, scopes, request):
+        """
+        Same as OAuth2Validator.validate_bearer_token, but the
+        application developer is loaded in the same query so callers
+        can log who is making the call without going back to the db.
+        """
+        if not token:
+            return False
+
+        try:
+            access_token = AccessToken.objects.select_related(
+                'application', 'application__user', 'user').get(token=token)
+        except AccessToken.DoesNotExist:
+            return False
+
+        if access_token.is_valid(scopes):
+            request.client = access_token.application
+            request.user = access_token.user
+            request.scopes = scopes
+            request.access_token = access_token
+            return True
+        return False
+
     def save_bearer_token(self, token, request, *args, **kwargs):
         """
         Check if an access_token exists for the couple user/application
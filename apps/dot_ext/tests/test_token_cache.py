@@ -0,0 +1,107 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from unittest.mock import patch
+
+from django.test import override_settings
+from django.utils import timezone
+from django.utils.timezone import timedelta
+
+from oauth2_provider.models import AccessToken, RefreshToken
+
+from apps.test import BaseApiTest
+from .. import token_cache
+
+
+@override_settings(TOKEN_CACHE_LOCAL_TTL=60)
+class TestTokenCache(BaseApiTest):
+
+    def setUp(self):
+        token_cache.clear()
+        self.user = self._create_user('john', '123456')
+        self.application = self._create_application('test')
+        self.access_token = AccessToken.objects.create(
+            user=self.user, application=self.application, token='abc123',
+            scope='read', expires=timezone.now() + timedelta(seconds=600))
+
+    def test_cached_state(self):
+        token_cache.set_token_state(self.access_token)
+        state = token_cache.get_token_state('abc123')
+
+        self.assertEqual(state['user_id'], self.user.pk)
+        self.assertEqual(state['application_id'], self.application.pk)
+        self.assertEqual(state['scope'], 'read')
+        self.assertIsNone(token_cache.get_token_state('unknown'))
+
+    def test_expired_token_not_cached(self):
+        self.access_token.expires = timezone.now() - timedelta(seconds=1)
+        token_cache.set_token_state(self.access_token)
+
+        self.assertIsNone(token_cache.get_token_state('abc123'))
+
+    def test_revoke_invalidates(self):
+        token_cache.set_token_state(self.access_token)
+        self.access_token.revoke()
+
+        self.assertIsNone(token_cache.get_token_state('abc123'))
+
+    def test_refresh_invalidates(self):
+        refresh_token = RefreshToken.objects.create(
+            user=self.user, application=self.application, token='def456',
+            access_token=self.access_token)
+        token_cache.set_token_state(self.access_token)
+        refresh_token.revoke()
+
+        self.assertIsNone(token_cache.get_token_state('abc123'))
+
+    def test_save_invalidates(self):
+        token_cache.set_token_state(self.access_token)
+        self.access_token.scope = 'read write'
+        self.access_token.save()
+
+        self.assertIsNone(token_cache.get_token_state('abc123'))
+
+    @override_settings(TOKEN_CACHE_SIZE=1)
+    def test_bounded(self):
+        token_cache.set_token_state(self.access_token)
+        other = AccessToken.objects.create(
+            user=self.user, application=self.application, token='xyz789',
+            scope='read', expires=timezone.now() + timedelta(seconds=600))
+        token_cache.set_token_state(other)
+
+        self.assertIsNone(token_cache.get_token_state('abc123'))
+        self.assertIsNotNone(token_cache.get_token_state('xyz789'))
+
+    @override_settings(TOKEN_CACHE_LOCAL_TTL=0)
+    def test_disabled(self):
+        token_cache.set_token_state(self.access_token)
+
+        self.assertIsNone(token_cache.get_token_state('abc123'))
+
+    @override_settings(TOKEN_CACHE_ALIAS='default')
+    def test_revoke_reaches_other_workers(self):
+        """ A token revoked in one worker is refused by another at once """
+        worker_a = patch.object(token_cache, '_local', OrderedDict())
+        worker_b = patch.object(token_cache, '_local', OrderedDict())
+
+        with worker_b:
+            token_cache.set_token_state(self.access_token)
+            self.assertIsNotNone(token_cache.get_token_state('abc123'))
+        with worker_a:
+            self.access_token.revoke()
+        with worker_b:
+            self.assertIsNone(token_cache.get_token_state('abc123'))
+
+    @override_settings(TOKEN_CACHE_ALIAS=None, TOKEN_CACHE_LOCAL_TTL=0)
+    def test_revoke_reaches_other_workers_by_default(self):
+        """ Without a shared cache, workers keep nothing unless told to """
+        worker_a = patch.object(token_cache, '_local', OrderedDict())
+        worker_b = patch.object(token_cache, '_local', OrderedDict())
+
+        with worker_b:
+            token_cache.set_token_state(self.access_token)
+        with worker_a:
+            self.access_token.revoke()
+        with worker_b:
+            self.assertIsNone(token_cache.get_token_state('abc123'))
@@ -0,0 +1,144 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import hashlib
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from oauth2_provider.models import AccessToken, RefreshToken
+
+logger = logging.getLogger('hhs_server.%s' % __name__)
+
+# Validated bearer token state, keyed on a hash of the token string:
+#   {'user_id', 'application_id', 'scope', 'expires'}
+# Entries never outlive the token's own expiry. They are dropped when
+# the AccessToken is saved, revoked or replaced through a refresh.
+#
+# With settings.TOKEN_CACHE_ALIAS set, entries are only kept in that
+# shared cache, for up to TOKEN_CACHE_TTL seconds, so a revocation in
+# one worker reaches all of them at once. Without it nothing is cached
+# unless TOKEN_CACHE_LOCAL_TTL is set: each worker then keeps its own
+# LRU of TOKEN_CACHE_SIZE entries, and another worker can accept a
+# revoked token for up to TOKEN_CACHE_LOCAL_TTL seconds.
+_local = OrderedDict()
+_local_lock = threading.Lock()
+
+
+def make_key(token):
+    """ Never keep the raw bearer token as a cache key """
+    return 'bb_token:%s' % hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def get_shared_cache():
+    alias = getattr(settings, 'TOKEN_CACHE_ALIAS', None)
+    if alias:
+        return caches[alias]
+    return None
+
+
+def get_ttl(shared):
+    """ Seconds an entry is kept, in the shared cache or this worker's own """
+    if shared is not None:
+        return settings.TOKEN_CACHE_TTL
+    return settings.TOKEN_CACHE_LOCAL_TTL
+
+
+def get_token_state(token):
+    """ Return the cached state for token, or None """
+    shared = get_shared_cache()
+    if not token or get_ttl(shared) <= 0:
+        return None
+
+    key = make_key(token)
+    now = time.time()
+
+    if shared is not None:
+        state = shared.get(key)
+        if state is not None and state['expires'] > now:
+            return state
+        return None
+
+    with _local_lock:
+        entry = _local.get(key)
+        if entry is not None:
+            state, deadline = entry
+            if deadline > now:
+                _local.move_to_end(key)
+                return state
+            del _local[key]
+
+    return None
+
+
+def set_token_state(access_token):
+    """ Remember a freshly validated AccessToken """
+    shared = get_shared_cache()
+    if get_ttl(shared) <= 0:
+        return
+
+    state = {'user_id': access_token.user_id,
+             'application_id': access_token.application_id,
+             'scope': access_token.scope,
+             'expires': access_token.expires.timestamp()}
+    key = make_key(access_token.token)
+    now = time.time()
+
+    if shared is None:
+        _set_local(key, state, now)
+        return
+
+    ttl = min(settings.TOKEN_CACHE_TTL, state['expires'] - now)
+    if ttl > 0:
+        shared.set(key, state, int(ttl) or 1)
+
+
+def _set_local(key, state, now):
+    ttl = min(settings.TOKEN_CACHE_LOCAL_TTL, state['expires'] - now)
+    if ttl <= 0:
+        return
+
+    with _local_lock:
+        _local[key] = (state, now + ttl)
+        _local.move_to_end(key)
+        while len(_local) > settings.TOKEN_CACHE_SIZE:
+            _local.popitem(last=False)
+
+
+def invalidate_token(token):
+    """ Forget token in this worker and in the shared cache """
+    key = make_key(token)
+    with _local_lock:
+        _local.pop(key, None)
+
+    shared = get_shared_cache()
+    if shared is not None:
+        shared.delete(key)
+
+
+def clear():
+    with _local_lock:
+        _local.clear()
+
+
+@receiver(post_save, sender=AccessToken)
+@receiver(post_delete, sender=AccessToken)
+def invalidate_access_token(sender, instance, **kwargs):
+    # covers revoke() (a delete) and any change to expires or scope
+    invalidate_token(instance.token)
+
+
+@receiver(post_delete, sender=RefreshToken)
+def invalidate_refreshed_token(sender, instance, **kwargs):
+    # a used refresh token takes its access token with it
+    try:
+        invalidate_token(instance.access_token.token)
+    except AccessToken.DoesNotExist:
+        pass
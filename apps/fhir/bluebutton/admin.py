@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from apps.fhir.bluebutton.models import (Crosswalk)
+from apps.fhir.bluebutton.models import (Crosswalk, ExportJob)
 
 
 class CrosswalkAdmin(admin.ModelAdmin):
@@ -10,3 +10,13 @@ class CrosswalkAdmin(admin.ModelAdmin):
 
 
 admin.site.register(Crosswalk, CrosswalkAdmin)
+
+
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'application', 'status', 'date_created', 'date_finished')
+    list_filter = ('status',)
+    search_fields = ('user__username',)
+    raw_id_fields = ("user", "application")
+
+
+admin.site.register(ExportJob, ExportJobAdmin)
@@ -0,0 +1,80 @@
+import gzip
+import re
+import zlib
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+from hhs_oauth_server.request_logging import timed
+
+# gzip Content-Encoding for proxied FHIR responses, as GZipMiddleware
+# does it, with a settable level and size threshold, and able to send
+# bytes that were gzipped already (search cache entries) as they are.
+
+re_accepts_gzip = re.compile(r'\bgzip\b')
+
+
+def accepts_gzip(request):
+    return bool(re_accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', '')))
+
+
+def compress_response(request, response, gzipped=None):
+    """
+    gzip the body of response if the client accepts it and it is worth
+    it. gzipped, if given, is response.content already gzipped.
+    """
+    if response.status_code != 200 or response.has_header('Content-Encoding'):
+        return response
+
+    if response.streaming:
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if accepts_gzip(request):
+            response.streaming_content = gzip_chunks(response.streaming_content)
+            if response.has_header('Content-Length'):
+                del response['Content-Length']
+            set_gzip_encoding(response)
+        return response
+
+    if len(response.content) < settings.FHIR_COMPRESS_MIN_SIZE:
+        return response
+
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if not accepts_gzip(request):
+        return response
+
+    if gzipped is None:
+        with timed('compress'):
+            gzipped = gzip.compress(response.content, settings.FHIR_COMPRESS_LEVEL)
+    if len(gzipped) >= len(response.content):
+        return response
+
+    response.content = gzipped
+    response['Content-Length'] = str(len(gzipped))
+    return set_gzip_encoding(response)
+
+
+def precompressed_response(response, gzipped):
+    """ Send gzipped, response.content compressed ahead of time, in place of the content """
+    patch_vary_headers(response, ('Accept-Encoding',))
+    response.content = gzipped
+    response['Content-Length'] = str(len(gzipped))
+    return set_gzip_encoding(response)
+
+
+def set_gzip_encoding(response):
+    # A strong ETag names the identity encoding. Make it weak, as
+    # GZipMiddleware does; If-None-Match compares weakly anyway.
+    etag = response.get('ETag')
+    if etag and etag.startswith('"'):
+        response['ETag'] = 'W/' + etag
+    response['Content-Encoding'] = 'gzip'
+    return response
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(settings.FHIR_COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
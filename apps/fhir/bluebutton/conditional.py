@@ -0,0 +1,129 @@
+import calendar
+import hashlib
+import logging
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date, quote_etag
+
+from .jsonscan import find_member
+from .search_cache import get_cache, get_generation
+
+logger = logging.getLogger('hhs_server.%s' % __name__)
+
+# ETag and Last-Modified for read and search responses, and the 304s
+# they allow.
+#
+# The ETag is strong: it hashes the public url with meta.versionId (or
+# the backend's ETag) when the backend has one, and hashes the body
+# otherwise. Last-Modified comes from meta.lastUpdated.
+#
+# The validators of each response are kept for FHIR_VALIDATOR_CACHE_TTL
+# seconds, per beneficiary, under the same generation as their cached
+# searches:
+#   fhir_validator:<router>:<fhir_id>:<generation>:<hash of url>
+# A conditional request matching a kept validator is answered 304 before
+# the backend is called.
+
+
+def validator_key(request, crosswalk):
+    url = request.build_absolute_uri()
+    return 'fhir_validator:%s:%s:%s:%s' % (
+        crosswalk.fhir_source_id,
+        crosswalk.fhir_id,
+        get_generation(crosswalk.fhir_source_id, crosswalk.fhir_id),
+        hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+
+def is_conditional(request):
+    return ('HTTP_IF_NONE_MATCH' in request.META or
+            'HTTP_IF_MODIFIED_SINCE' in request.META)
+
+
+def cached_not_modified(request, key):
+    """
+    The 304 for a conditional request matching the kept validators of
+    key, or None if the response has to be built.
+    """
+    if not is_conditional(request):
+        return None
+
+    validators = kept_validators(key)
+    if validators is None:
+        return None
+
+    etag, last_modified = validators
+    response = get_conditional_response(request, etag, last_modified,
+                                        set_validators(HttpResponse(), etag, last_modified))
+    if response.status_code == 304:
+        logger.debug('Validator cache hit for %s' % request.path)
+        return response
+    return None
+
+
+def conditional_response(request, key, response, text, backend_etag=None):
+    """
+    Add ETag and Last-Modified to response, a 200 holding the rewritten
+    form of the backend document text, keep them under key and return
+    the response, or a 304 if the request's conditions match.
+    """
+    version = None
+    last_modified = None
+    try:
+        meta = find_member(text, 'meta')
+        version = meta.get('versionId')
+        last_modified = parse_last_updated(meta.get('lastUpdated'))
+    except (KeyError, ValueError, AttributeError):
+        pass
+
+    version = version or backend_etag
+    if version:
+        tag = '%s|%s' % (request.build_absolute_uri(), version)
+        etag = quote_etag(hashlib.sha1(tag.encode('utf-8')).hexdigest())
+    else:
+        etag = quote_etag(hashlib.sha1(response.content).hexdigest())
+
+    set_validators(response, etag, last_modified)
+    if settings.FHIR_VALIDATOR_CACHE_TTL:
+        get_cache().set(key, (etag, last_modified), settings.FHIR_VALIDATOR_CACHE_TTL)
+
+    return get_conditional_response(request, etag, last_modified, response)
+
+
+def kept_validators(key):
+    """ The (etag, last_modified) kept under key, or None """
+    if not settings.FHIR_VALIDATOR_CACHE_TTL:
+        return None
+    return get_cache().get(key)
+
+
+def kept_response(request, response, validators):
+    """ response with the kept validators, or the 304 they allow """
+    etag, last_modified = validators
+    set_validators(response, etag, last_modified)
+    return get_conditional_response(request, etag, last_modified, response)
+
+
+def set_validators(response, etag, last_modified):
+    if response.get('Content-Encoding') == 'gzip':
+        # a strong ETag would name the identity encoding
+        etag = 'W/' + etag
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def parse_last_updated(value):
+    """ meta.lastUpdated as a timestamp, or None """
+    if not isinstance(value, str):
+        return None
+    try:
+        when = parse_datetime(value)
+    except ValueError:
+        return None
+    if when is None or when.tzinfo is None:
+        return None
+    return calendar.timegm(when.utctimetuple())
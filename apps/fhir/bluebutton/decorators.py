@@ -5,24 +5,67 @@ from functools import wraps
 
 from oauthlib.oauth2 import Server
 
-from oauth2_provider.oauth2_validators import OAuth2Validator
+from django.contrib.auth.models import User
+
 from oauth2_provider.oauth2_backends import OAuthLibCore
+from oauth2_provider.settings import oauth2_settings
 
+from apps.dot_ext import token_cache
+from hhs_oauth_server.request_logging import timed
 from .errors import build_error_response
+from .identity import RequestIdentity
+
+# The validator and server hold no per-request state, so one of each
+# is shared by every request in the worker.
+_oauthlib_core = None
+
+
+def get_oauthlib_core():
+    global _oauthlib_core
+    if _oauthlib_core is None:
+        _oauthlib_core = OAuthLibCore(Server(oauth2_settings.OAUTH2_VALIDATOR_CLASS()))
+    return _oauthlib_core
+
+
+def get_bearer_token(request):
+    """ The bearer token from the Authorization header, or None """
+    auth = request.META.get('HTTP_AUTHORIZATION', '')
+    if auth.startswith('Bearer '):
+        return auth[7:].strip()
+    return None
+
+
+def get_token_identity(request):
+    """ The RequestIdentity of the request's access token, or None if it is not valid """
+    token = get_bearer_token(request)
+    state = token_cache.get_token_state(token)
+    if state is not None:
+        try:
+            return RequestIdentity.from_token_state(state)
+        except User.DoesNotExist:
+            token_cache.invalidate_token(token)
+
+    valid, oauthlib_req = get_oauthlib_core().verify_request(request, scopes=[])
+    if valid:
+        token_cache.set_token_state(oauthlib_req.access_token)
+        return RequestIdentity(user=oauthlib_req.user,
+                               access_token=oauthlib_req.access_token)
+    return None
 
 
 def require_valid_token():
     def decorator(view_func):
         @wraps(view_func)
         def _validate(request, *args, **kwargs):
-            core = OAuthLibCore(Server(OAuth2Validator()))
-            valid, oauthlib_req = core.verify_request(request, scopes=[])
-            if valid:
-                # Note, resource_owner is not a very good name for this
-                request.resource_owner = oauthlib_req.user
-                return view_func(request, *args, **kwargs)
-
-            return build_error_response(401, 'The token authentication failed.')
+            with timed('token'):
+                identity = get_token_identity(request)
+            if identity is None:
+                return build_error_response(401, 'The token authentication failed.')
+
+            # Note, resource_owner is not a very good name for this
+            request.resource_owner = identity.user
+            request.identity = identity
+            return view_func(request, *args, **kwargs)
 
         return _validate
 
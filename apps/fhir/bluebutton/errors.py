@@ -19,3 +19,9 @@ def method_not_allowed(allowed_methods):
     response = build_error_response(405, 'The method you requested is not allowed')
     response['Allow'] = ', '.join(allowed_methods)
     return response
+
+
+def backend_unavailable(retry_after):
+    response = build_error_response(503, 'The upstream server is temporarily unavailable')
+    response['Retry-After'] = str(retry_after)
+    return response
@@ -0,0 +1,276 @@
+import gzip
+import json
+import logging
+import tempfile
+import time
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from apps.fhir.server.sessions import get_session
+
+from .jsonscan import find_member
+from .models import Crosswalk, ExportJob
+from .utils import (backend_get,
+                    build_rewrite_list,
+                    FhirServerAuth,
+                    FhirServerVerify,
+                    mask_list_with_host)
+from .views.search import search_parameters
+
+logger = logging.getLogger('hhs_server.%s' % __name__)
+
+# Bulk export of one beneficiary's data, after the FHIR Bulk Data
+# Patient/$export operation.
+#
+# The kick-off view (views/export.py) only records an ExportJob. The
+# process_export_jobs management command claims queued jobs and runs
+# them here: every page of each resource type's search is fetched from
+# the backend, its urls rewritten to the public host, and each entry
+# written as one line of a gzipped NDJSON file in the export storage.
+# A whole history never goes through a web worker.
+#
+# A running job is touched (date_heartbeat) before each backend page.
+# One whose worker died is queued again by reclaim_stale_jobs, or failed
+# after settings.FHIR_EXPORT_MAX_ATTEMPTS tries.
+
+# resource types that can be exported, in export order
+EXPORT_TYPES = ['Patient', 'Coverage', 'ExplanationOfBenefit']
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+class ExportFailed(Exception):
+    pass
+
+
+def get_export_storage():
+    if settings.FHIR_EXPORT_STORAGE:
+        return import_string(settings.FHIR_EXPORT_STORAGE)()
+    return FileSystemStorage(location=settings.FHIR_EXPORT_ROOT)
+
+
+def export_file_name(job, resource_type):
+    return 'bulk/%s/%s.ndjson.gz' % (job.pk, resource_type)
+
+
+def claim_next_job():
+    """ Mark the oldest queued job running and return it, or None """
+    queued = ExportJob.objects.filter(status=ExportJob.QUEUED).order_by('date_created')
+    for job_id in queued.values_list('pk', flat=True)[:10]:
+        # another worker may claim the same job between the two queries
+        now = timezone.now()
+        claimed = ExportJob.objects.filter(pk=job_id, status=ExportJob.QUEUED).update(
+            status=ExportJob.RUNNING, date_started=now, date_heartbeat=now, attempts=F('attempts') + 1)
+        if claimed:
+            return ExportJob.objects.get(pk=job_id)
+    return None
+
+
+def reclaim_stale_jobs():
+    """
+    Queue again the running jobs whose worker stopped touching them, or
+    fail those already tried FHIR_EXPORT_MAX_ATTEMPTS times. Returns the
+    number of jobs reclaimed.
+    """
+    stale = ExportJob.objects.filter(
+        status=ExportJob.RUNNING,
+        date_heartbeat__lt=timezone.now() - timedelta(seconds=settings.FHIR_EXPORT_STALE_AFTER))
+
+    failed = stale.filter(attempts__gte=settings.FHIR_EXPORT_MAX_ATTEMPTS).update(
+        status=ExportJob.FAILED,
+        error='The export stopped responding and was not retried',
+        date_finished=timezone.now())
+    requeued = stale.filter(attempts__lt=settings.FHIR_EXPORT_MAX_ATTEMPTS).update(
+        status=ExportJob.QUEUED,
+        progress='')
+    if failed or requeued:
+        logger.warning('Reclaimed stale exports: %s queued again, %s failed' % (requeued, failed))
+    return failed + requeued
+
+
+def run_export_job(job):
+    """ Export every resource type of a claimed job """
+    logger.info('Running export %s for %s' % (job.pk, job.user))
+
+    storage = get_export_storage()
+    output = []
+    try:
+        crosswalk = Crosswalk.objects.select_related('fhir_source').filter(user=job.user).first()
+        if crosswalk is None:
+            raise ExportFailed('No access information was found for the user')
+
+        for resource_type in job.get_resource_types():
+            name = export_file_name(job, resource_type)
+            count = export_resource_type(job, crosswalk, resource_type, storage, name)
+            output.append({'type': resource_type, 'count': count})
+
+    except ExportCancelled:
+        logger.info('Export %s cancelled' % job.pk)
+        delete_export_files(job, storage)
+        return
+
+    except ExportFailed as e:
+        logger.warning('Export %s failed: %s' % (job.pk, e))
+        fail_job(job, storage, str(e))
+        return
+
+    except Exception as e:
+        # backend, storage, TLS or parse errors alike: the job must not
+        # be left running with nothing to finish it
+        logger.exception('Export %s failed' % job.pk)
+        fail_job(job, storage, '%s: %s' % (e.__class__.__name__, e))
+        return
+
+    # a job cancelled during its last page keeps its cancelled status
+    finished = ExportJob.objects.filter(pk=job.pk, status=ExportJob.RUNNING).update(
+        status=ExportJob.COMPLETE,
+        output=json.dumps(output),
+        progress='',
+        date_finished=timezone.now())
+    if not finished:
+        delete_export_files(job, storage)
+
+
+def fail_job(job, storage, error):
+    try:
+        delete_export_files(job, storage)
+    except Exception:
+        logger.exception('Could not delete the files of failed export %s' % job.pk)
+    ExportJob.objects.filter(pk=job.pk, status=ExportJob.RUNNING).update(
+        status=ExportJob.FAILED,
+        error=error,
+        date_finished=timezone.now())
+
+
+def delete_export_files(job, storage=None):
+    storage = storage or get_export_storage()
+    for resource_type in job.get_resource_types():
+        name = export_file_name(job, resource_type)
+        if storage.exists(name):
+            storage.delete(name)
+
+
+def export_resource_type(job, crosswalk, resource_type, storage, name):
+    """ Write the NDJSON file for one resource type; returns its line count """
+    count = 0
+    with tempfile.TemporaryFile() as tmp:
+        with gzip.GzipFile(fileobj=tmp, mode='wb') as out:
+            for resource in fetch_resources(job, crosswalk, resource_type):
+                out.write(json.dumps(resource).encode('utf-8'))
+                out.write(b'\n')
+                count += 1
+
+        tmp.seek(0)
+        if storage.exists(name):
+            storage.delete(name)
+        storage.save(name, File(tmp))
+
+    return count
+
+
+def fetch_resources(job, crosswalk, resource_type):
+    """ Every resource of resource_type for the beneficiary, page by page """
+    rr = crosswalk.fhir_source
+    rewrite_list = build_rewrite_list(crosswalk)
+
+    auth_state = FhirServerAuth(crosswalk)
+    if auth_state['client_auth']:
+        cert = (auth_state['cert_file'], auth_state['key_file'])
+    else:
+        cert = ()
+    session = get_session(rr, cert, FhirServerVerify(crosswalk))
+    headers = backend_headers(job, crosswalk)
+
+    if resource_type == 'Patient':
+        check_cancelled(job)
+        url = rr.fhir_url + 'Patient/' + crosswalk.fhir_id + '/'
+        text = fetch_page(session, rr, crosswalk, url, {'_format': 'json'}, headers)
+        yield json.loads(mask_list_with_host(None, job.base_url, text, rewrite_list))
+        return
+
+    url = rr.fhir_url + resource_type + '/'
+    params = search_parameters(resource_type, crosswalk.fhir_id)
+    params['_count'] = settings.FHIR_EXPORT_PAGE_SIZE
+    pages = 0
+    exported = 0
+
+    while url:
+        check_cancelled(job)
+        text = fetch_page(session, rr, crosswalk, url, params, headers)
+        pages += 1
+
+        # the next link is followed on the backend, so it is read
+        # before the urls are rewritten
+        url = next_page_url(rr, text)
+        params = {}
+
+        bundle = json.loads(mask_list_with_host(None, job.base_url, text, rewrite_list))
+        for entry in bundle.get('entry', []):
+            if 'resource' in entry:
+                exported += 1
+                yield entry['resource']
+
+        ExportJob.objects.filter(pk=job.pk).update(
+            progress='%s: %s resources in %s pages' % (resource_type, exported, pages))
+
+
+def fetch_page(session, rr, crosswalk, url, params, headers):
+    start = time.monotonic()
+    r = backend_get(session, rr, crosswalk, url, params=params, headers=headers)
+    logger.debug('Export page %s %s: %s in %.3fs'
+                 % (url, params, r.status_code, time.monotonic() - start))
+    if r.status_code >= 300:
+        raise ExportFailed('The upstream server returned %s for %s' % (r.status_code, url))
+    r.encoding = r.encoding or 'utf-8'
+    return r.text
+
+
+def next_page_url(rr, text):
+    """ The backend url of the page after this Bundle, if there is one """
+    try:
+        links = find_member(text, 'link')
+    except (KeyError, ValueError):
+        return None
+
+    if not isinstance(links, list):
+        return None
+
+    for link in links:
+        if isinstance(link, dict) and link.get('relation') == 'next':
+            url = link.get('url') or ''
+            # never follow a link off the backend
+            if url.startswith(rr.fhir_url):
+                return url
+            logger.warning('Ignoring next link off the backend: %s' % url)
+    return None
+
+
+def backend_headers(job, crosswalk):
+    """ The BlueButton-* headers a proxied call would send, less the request ones """
+    headers = {'BlueButton-BeneficiaryId': 'patientId:' + str(crosswalk.fhir_id),
+               'BlueButton-UserId': str(job.user.id),
+               'BlueButton-User': str(job.user),
+               'BlueButton-OriginalQueryId': str(job.pk),
+               'BlueButton-Application': '',
+               'BlueButton-ApplicationId': ''}
+    if job.application is not None:
+        headers['BlueButton-Application'] = str(job.application.name)
+        headers['BlueButton-ApplicationId'] = str(job.application.id)
+    return headers
+
+
+def check_cancelled(job):
+    """ Touch the job's heartbeat; raise ExportCancelled once it was cancelled or deleted """
+    running = ExportJob.objects.filter(pk=job.pk, status=ExportJob.RUNNING).update(
+        date_heartbeat=timezone.now())
+    if not running:
+        raise ExportCancelled()
@@ -0,0 +1,43 @@
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+
+from hhs_oauth_server.request_logging import timed
+
+logger = logging.getLogger('hhs_server.%s' % __name__)
+
+# Worker threads shared by the views that make several backend calls for
+# one request. Tasks should only call the backend: anything they need
+# from the database is loaded by the view before fanning out.
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=settings.FHIR_FANOUT_WORKERS,
+                                           thread_name_prefix='fhir-fanout')
+    return _pool
+
+
+def fan_out(fn, items):
+    """ fn(item) for each item, run concurrently; results in item order """
+    with timed('fanout'):
+        futures = [get_pool().submit(run_task, fn, item) for item in items]
+        return [future.result() for future in futures]
+
+
+def run_task(fn, item):
+    try:
+        return fn(item)
+    finally:
+        # a task that did reach the database must not keep the connection
+        connections.close_all()
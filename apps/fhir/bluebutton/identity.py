@@ -0,0 +1,82 @@
+import logging
+
+from django.contrib.auth.models import User
+
+from apps.dot_ext.models import Application
+from .models import Crosswalk
+
+logger = logging.getLogger('hhs_server.%s' % __name__)
+
+_UNSET = object()
+
+
+class RequestIdentity(object):
+    """
+    Who is behind a FHIR call: the access token, its application and
+    developer, the beneficiary user and their Crosswalk.
+
+    Built once per request (see require_valid_token and
+    utils.get_identity) and attached as request.identity so the views,
+    the backend header builder and the logging share one lookup.
+    """
+
+    def __init__(self, user=None, access_token=None, application_id=None):
+        self.user = user
+        self.access_token = access_token
+        self.application_id = application_id
+        self._application = _UNSET
+        self._crosswalk = _UNSET
+
+    @classmethod
+    def from_token_state(cls, state):
+        """
+        Build the identity for a token validated from the token cache.
+        The user comes back with the crosswalk lookup; the application
+        and developer are only loaded if asked for.
+        """
+        if state['user_id'] is None:
+            return cls(application_id=state['application_id'])
+
+        crosswalk = Crosswalk.objects.select_related(
+            'user', 'fhir_source').filter(user_id=state['user_id']).first()
+        if crosswalk is None:
+            user = User.objects.get(pk=state['user_id'])
+        else:
+            user = crosswalk.user
+
+        identity = cls(user=user, application_id=state['application_id'])
+        identity._crosswalk = crosswalk
+        return identity
+
+    @property
+    def application(self):
+        if self.access_token is not None:
+            return self.access_token.application
+        if self._application is _UNSET:
+            self._application = None
+            if self.application_id is not None:
+                self._application = Application.objects.select_related(
+                    'user').filter(pk=self.application_id).first()
+        return self._application
+
+    @property
+    def developer(self):
+        if self.application is None:
+            return None
+        return self.application.user
+
+    @property
+    def crosswalk(self):
+        """ Crosswalk (with its ResourceRouter) for user, or None """
+        if self._crosswalk is _UNSET:
+            self._crosswalk = None
+            if self.user is not None and not self.user.is_anonymous():
+                try:
+                    self._crosswalk = Crosswalk.objects.select_related(
+                        'fhir_source').get(user=self.user)
+                except Crosswalk.DoesNotExist:
+                    pass
+        return self._crosswalk
+
+    def __str__(self):
+        return '%s via %s' % (self.user, self.application)
@@ -0,0 +1,132 @@
+import json
+import re
+
+# Pull one top level member out of a JSON object without decoding the
+# whole document. The scan stops as soon as the member is found, so
+# whatever follows it (e.g. the line items of an ExplanationOfBenefit)
+# is never decoded. Members ahead of it go through the C decoder, which
+# is faster than any pure Python skipping, so the worst case costs about
+# the same as json.loads.
+#
+# scan_object goes over every member the same way, keeping where each
+# value's JSON text is, so a document can be cut down and put back
+# together from the pieces of the original text.
+
+_decoder = json.JSONDecoder()
+
+_WS = re.compile(r'[ \t\n\r]*')
+_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+
+
+def find_member(text, name):
+    """
+    Value of the top level member name of the JSON object in text.
+
+    Raises KeyError if there is no such member and ValueError if text
+    is not a JSON object.
+    """
+    return locate_member(text, name)[0]
+
+
+def locate_member(text, name):
+    """
+    (value, start, end) of the top level member name: text[start:end]
+    is its JSON text. Raises as find_member does.
+    """
+    pos = _first_member(text, 0)
+    while text[pos:pos + 1] != '}':
+        key, pos = _member_name(text, pos)
+        if key == name:
+            value, end = _decoder.raw_decode(text, pos)
+            return value, pos, end
+        pos = _next_member(text, skip_value(text, pos))
+    raise KeyError(name)
+
+
+def scan_object(text, pos=0, nested=None):
+    """
+    (members, end) of the JSON object at pos, end being just past it.
+
+    Each member is (name, start, end, scanned): text[start:end] is the
+    JSON text of its value. Values are skipped unless nested has an
+    entry for name: an object value is then scanned with nested[name]
+    (scanned is its members), and an array value item by item (scanned
+    is a list of (start, end, members), members None for an item that
+    is not an object).
+    """
+    nested = nested or {}
+    members = []
+    pos = _first_member(text, pos)
+    while text[pos:pos + 1] != '}':
+        name, start = _member_name(text, pos)
+        first = text[start:start + 1]
+        if name in nested and first == '{':
+            scanned, end = scan_object(text, start, nested[name])
+        elif name in nested and first == '[':
+            scanned, end = _scan_items(text, start, nested[name])
+        else:
+            scanned, end = None, skip_value(text, start)
+        members.append((name, start, end, scanned))
+        pos = _next_member(text, end)
+    return members, pos + 1
+
+
+def _scan_items(text, pos, nested):
+    """ (items, end) of the JSON array at pos, as scan_object gives them """
+    items = []
+    pos = _WS.match(text, pos + 1).end()
+    if text[pos:pos + 1] == ']':
+        return items, pos + 1
+
+    while True:
+        if text[pos:pos + 1] == '{':
+            members, end = scan_object(text, pos, nested)
+        else:
+            members, end = None, skip_value(text, pos)
+        items.append((pos, end, members))
+        pos = _WS.match(text, end).end()
+        delimiter = text[pos:pos + 1]
+        if delimiter == ']':
+            return items, pos + 1
+        if delimiter != ',':
+            raise ValueError("Expecting ',' at %s" % pos)
+        pos = _WS.match(text, pos + 1).end()
+
+
+def _first_member(text, pos):
+    """ Position of the first member of the JSON object at pos, or of its '}' """
+    pos = _WS.match(text, pos).end()
+    if text[pos:pos + 1] != '{':
+        raise ValueError('Expecting a JSON object')
+    pos = _WS.match(text, pos + 1).end()
+    return pos
+
+
+def _member_name(text, pos):
+    """ (name, position of the value) of the member at pos """
+    match = _STRING.match(text, pos)
+    if match is None:
+        raise ValueError('Expecting a member name at %s' % pos)
+    pos = _WS.match(text, match.end()).end()
+    if text[pos:pos + 1] != ':':
+        raise ValueError("Expecting ':' at %s" % pos)
+    return json.loads(match.group()), _WS.match(text, pos + 1).end()
+
+
+def _next_member(text, pos):
+    """ Position of the member after the value ending at pos, or of the '}' """
+    pos = _WS.match(text, pos).end()
+    delimiter = text[pos:pos + 1]
+    if delimiter == '}':
+        return pos
+    if delimiter != ',':
+        raise ValueError("Expecting ',' at %s" % pos)
+    pos = _WS.match(text, pos + 1).end()
+    if text[pos:pos + 1] == '}':
+        raise ValueError('Expecting a member name at %s' % pos)
+    return pos
+
+
+def skip_value(text, pos):
+    """ Position just after the JSON value starting at pos """
+    return _decoder.raw_decode(text, pos)[1]
@@ -0,0 +1,39 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.fhir.bluebutton.export import claim_next_job, reclaim_stale_jobs, run_export_job
+
+logger = logging.getLogger('hhs_server.%s' % __name__)
+
+
+class Command(BaseCommand):
+    help = 'Run queued Patient/$export jobs, polling for new ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once there are no queued jobs left')
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                reclaim_stale_jobs()
+                job = claim_next_job()
+                if job is not None:
+                    run_export_job(job)
+                    job.refresh_from_db()
+                    self.stdout.write('Export %s %s' % (job.pk, job.status))
+                    continue
+            except Exception:
+                # e.g. the database went away: keep polling
+                logger.exception('Export worker error')
+                if options['once']:
+                    raise
+
+            if options['once']:
+                return
+            time.sleep(settings.FHIR_EXPORT_WORKER_SLEEP)
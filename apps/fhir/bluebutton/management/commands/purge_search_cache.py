@@ -0,0 +1,28 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.fhir.bluebutton.models import Crosswalk
+from apps.fhir.bluebutton.search_cache import is_shared, purge_beneficiary
+
+
+class Command(BaseCommand):
+    help = 'Drop the cached search results of one or more beneficiaries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('fhir_id', nargs='+', help='Beneficiary FHIR id')
+
+    def handle(self, *args, **options):
+        if not is_shared():
+            # this process's own cache: the web workers would keep theirs
+            raise CommandError('FHIR_CACHE_ALIAS is a per-process cache; nothing the web workers '
+                               'hold can be purged from here. Configure a shared cache (CACHES).')
+
+        for fhir_id in options['fhir_id']:
+            router_pks = Crosswalk.objects.filter(
+                fhir_id=fhir_id, fhir_source__isnull=False).values_list('fhir_source_id', flat=True)
+            if not router_pks:
+                raise CommandError('No crosswalk found for %s' % fhir_id)
+            for router_pk in set(router_pks):
+                purge_beneficiary(router_pk, fhir_id)
+            self.stdout.write('Purged cached searches for %s' % fhir_id)
@@ -1,11 +1,16 @@
+import json
 import logging
-from requests import Response
+import uuid
 from django.conf import settings
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from apps.fhir.server.models import ResourceRouter
 from django.utils.crypto import pbkdf2
 import binascii
 
+from .search_cache import purge_beneficiary
+
 logger = logging.getLogger('hhs_server.%s' % __name__)
 
 
@@ -71,36 +76,124 @@ class Crosswalk(models.Model):
         return full_url
 
 
-class Fhir_Response(Response):
+class ExportJob(models.Model):
+    """
+    A bulk $export of one beneficiary's data, run in the background by
+    the process_export_jobs management command (see export.py).
     """
-    Build a more consistent Response object
-    requests.Response can be missing fields if an error is encountered
-    The purpose of this object is to encapsulate request.Response
-    and make sure the items needed further upstream are present.
 
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    COMPLETE = 'complete'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    STATUS_CHOICES = ((QUEUED, 'Queued'),
+                      (RUNNING, 'Running'),
+                      (COMPLETE, 'Complete'),
+                      (FAILED, 'Failed'),
+                      (CANCELLED, 'Cancelled'))
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL)
+    application = models.ForeignKey(settings.OAUTH2_PROVIDER_APPLICATION_MODEL,
+                                    blank=True,
+                                    null=True)
+    resource_types = models.CharField(max_length=254,
+                                      help_text="Comma separated resource types to export")
+    base_url = models.CharField(max_length=512,
+                                help_text="Public FHIR base url the backend urls are rewritten to")
+    request_url = models.TextField(help_text="The kick-off request")
+    status = models.CharField(max_length=16,
+                              choices=STATUS_CHOICES,
+                              default=QUEUED,
+                              db_index=True)
+    progress = models.CharField(max_length=254, blank=True, default="")
+    error = models.TextField(blank=True, default="")
+    # JSON list of {"type", "count"}, one per exported file
+    output = models.TextField(blank=True, default="")
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_started = models.DateTimeField(blank=True, null=True)
+    date_finished = models.DateTimeField(blank=True, null=True)
+    # touched by the worker between pages; a running job whose worker
+    # died stops being touched and is reclaimed (export.reclaim_stale_jobs)
+    date_heartbeat = models.DateTimeField(blank=True, null=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+
+    def __str__(self):
+        return '%s %s (%s)' % (self.user, self.id, self.status)
+
+    def get_resource_types(self):
+        return [t for t in self.resource_types.split(',') if t]
+
+    def get_output(self):
+        return json.loads(self.output) if self.output else []
+
+
+_UNSET = object()
+
+
+class Fhir_Response(object):
+    """
+    What came back from one backend FHIR call.
+
+    Built by the backend client (see utils.build_fhir_response) from the
+    requests.Response, or from the exception when no response arrived.
+    Read-only. text and json() are decoded from content on first use.
+
+    status_code: backend status, 504 if the call failed, 503 if it was
+        not attempted (see retry_after)
+    content: body bytes. Empty while stream holds an unread body.
+    elapsed: seconds spent on the call
+    error: None, or what went wrong: 'timeout', 'connection', 'http'
+        or 'unavailable'
+    detail: description of the error for the client, or ""
     """
 
-    def __init__(self, req_response=Response):
-        if req_response is None:
-            req_response = Response
-
-        for k, v in req_response.__dict__.items():
-            self.__dict__[k] = v
-
-        extend_response = {"_response": req_response,
-                           "_text": "",
-                           "_json": "{}",
-                           "_xml": "</>",
-                           "_status_code": "",
-                           "_call_url": "",
-                           "_cx": Crosswalk,
-                           "_result": "",
-                           "_owner": "",
-                           "encoding": "utf-8",
-                           "_content": ""
-                           }
-
-        # Add extra fields to Response Object
-        for k, v in extend_response.items():
-            # logger.debug("Key:%s with Value:%s" % (k, v))
-            self.__dict__[k] = v
+    __slots__ = ('status_code', 'headers', 'content', 'encoding',
+                 'call_url', 'elapsed', 'error', 'detail', 'retry_after',
+                 'stream', '_text', '_json')
+
+    def __init__(self, status_code, content=b'', headers=None,
+                 encoding='utf-8', call_url='', elapsed=None, error=None,
+                 detail='', retry_after=None, stream=None):
+        init = super(Fhir_Response, self).__setattr__
+        init('status_code', status_code)
+        init('content', content)
+        init('headers', headers if headers is not None else {})
+        init('encoding', encoding or 'utf-8')
+        init('call_url', call_url)
+        init('elapsed', elapsed)
+        init('error', error)
+        init('detail', detail)
+        init('retry_after', retry_after)
+        init('stream', stream)
+        init('_text', None)
+        init('_json', _UNSET)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Fhir_Response is read-only')
+
+    @property
+    def text(self):
+        if self._text is None:
+            super(Fhir_Response, self).__setattr__(
+                '_text', self.content.decode(self.encoding, 'replace'))
+        return self._text
+
+    def json(self):
+        if self._json is _UNSET:
+            super(Fhir_Response, self).__setattr__('_json', json.loads(self.text))
+        return self._json
+
+    def __repr__(self):
+        return '<Fhir_Response [%s] %s>' % (self.status_code, self.call_url)
+
+
+@receiver(post_save, sender=Crosswalk)
+@receiver(post_delete, sender=Crosswalk)
+def purge_crosswalk_searches(sender, instance, **kwargs):
+    # a re-linked or removed beneficiary must not see cached results
+    if kwargs.get('raw'):
+        return
+    if instance.fhir_source_id and instance.fhir_id:
+        purge_beneficiary(instance.fhir_source_id, instance.fhir_id)
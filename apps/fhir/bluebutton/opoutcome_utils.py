@@ -1,7 +1,7 @@
 import logging
 
 from collections import OrderedDict
-from apps.fhir.server.models import SupportedResourceType
+from apps.fhir.server.config import get_config
 
 logger = logging.getLogger('hhs_server.%s' % __name__)
 
@@ -26,11 +26,8 @@ def valid_interaction(resource, rr):
     """
 
     interaction_list = []
-    try:
-        resource_interaction = \
-            SupportedResourceType.objects.get(resourceType=resource,
-                                              fhir_source=rr)
-    except SupportedResourceType.DoesNotExist:
+    resource_interaction = get_config().resource(rr, resource)
+    if resource_interaction is None:
         # this is a strange error
         # earlier gets should have found a record
         # otherwise we wouldn't get in to this function
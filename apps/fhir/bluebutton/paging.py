@@ -0,0 +1,113 @@
+import json
+
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+from django.conf import settings
+
+from .jsonscan import find_member, locate_member
+
+# Search results are paged with _count (page size) and startIndex (offset
+# of the first entry), as the backend pages them. Every backend search
+# asks for a page no larger than max_page_size(resource_type), and the
+# Bundle.link urls of a page are replaced by urls for the same pages on
+# this server, which carry only the paging parameters.
+
+
+def max_page_size(resource_type):
+    return settings.FHIR_PAGE_SIZE_MAX_BY_TYPE.get(resource_type,
+                                                   settings.FHIR_PAGE_SIZE_MAX)
+
+
+def page_parameters(query, resource_type):
+    """
+    Backend _count and startIndex for the client's query parameters.
+
+    _count defaults to, and is clamped to, max_page_size(resource_type).
+    Raises ValueError for values that are not non-negative integers.
+    """
+    count = max_page_size(resource_type)
+    if query.get('_count'):
+        count = min(count, parse_index('_count', query['_count']))
+
+    params = OrderedDict([('_count', count)])
+    start = parse_index('startIndex', query.get('startIndex') or '0')
+    if start:
+        params['startIndex'] = start
+    return params
+
+
+def parse_index(name, value):
+    try:
+        index = int(value)
+    except ValueError:
+        index = -1
+    if index < 0:
+        raise ValueError('%s must be a non-negative integer' % name)
+    return index
+
+
+def page_url(host_path, resource_type, count, start, extra=None):
+    query = OrderedDict([('_count', count), ('startIndex', start)])
+    query.update(extra or {})
+    return '%s/%s?%s' % (host_path, resource_type, urlencode(query))
+
+
+def rewrite_page_links(text, host_path, resource_type, params, extra=None):
+    """
+    Point the self, first, previous, next and last links of the Bundle
+    in text at this server, adding the query parameters in extra. Other
+    links, and text without a list of links, are left as they are.
+
+    text may be only the start of the Bundle, as read before a large
+    page is streamed: its links are rewritten if they are all in it.
+    """
+    count = params['_count']
+    start = params.get('startIndex', 0)
+    try:
+        links, link_start, link_end = locate_member(text, 'link')
+    except (KeyError, ValueError):
+        return text
+    if not isinstance(links, list) or count == 0:
+        return text
+
+    try:
+        total = find_member(text, 'total')
+    except (KeyError, ValueError):
+        total = None
+
+    for link in links:
+        if not isinstance(link, dict):
+            continue
+        relation = link.get('relation')
+        if relation == 'self':
+            index = start
+        elif relation == 'first':
+            index = 0
+        elif relation in ('previous', 'prev'):
+            index = max(0, start - count)
+        elif relation == 'next':
+            index = start + count
+        elif relation == 'last' and isinstance(total, int):
+            index = max(0, total - 1) // count * count
+        else:
+            continue
+        link['url'] = page_url(host_path, resource_type, count, index, extra)
+
+    return text[:link_start] + json.dumps(links) + text[link_end:]
+
+
+def next_page_parameters(text, params):
+    """ params for the page after the Bundle in text, or None on the last page """
+    try:
+        links = find_member(text, 'link')
+    except (KeyError, ValueError):
+        return None
+    if not isinstance(links, list) or params['_count'] == 0:
+        return None
+    if not any(isinstance(link, dict) and link.get('relation') == 'next' for link in links):
+        return None
+
+    next_params = OrderedDict(params)
+    next_params['startIndex'] = params.get('startIndex', 0) + params['_count']
+    return next_params
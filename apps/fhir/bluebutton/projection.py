@@ -0,0 +1,155 @@
+import json
+
+from collections import OrderedDict
+
+from .jsonscan import scan_object
+
+# _elements and _summary: return part of each resource.
+#
+# Projection works on top level elements. resourceType, id and meta are
+# always kept, and a projected resource is tagged SUBSETTED so a client
+# cannot mistake it for the whole resource. In a searchset Bundle the
+# projection applies to each entry's resource, and _summary=count drops
+# the entries altogether.
+#
+# The projection works on the JSON text: the members kept are copied
+# from it as they are and only meta is decoded, so a large Bundle is
+# neither built as Python objects nor serialized again.
+
+SUMMARY_VALUES = ('true', 'false', 'data', 'count')
+
+MANDATORY_ELEMENTS = ('resourceType', 'id', 'meta')
+
+# Top level elements kept by _summary=true, from the summary flags of
+# the resource definitions
+SUMMARY_ELEMENTS = {
+    'Patient': ('identifier', 'active', 'name', 'telecom', 'gender', 'birthDate',
+                'deceasedBoolean', 'deceasedDateTime', 'address',
+                'managingOrganization', 'link'),
+    'Coverage': ('identifier', 'status', 'type', 'policyHolder', 'subscriber',
+                 'subscriberId', 'beneficiary', 'relationship', 'period', 'payor',
+                 'grouping', 'dependent', 'sequence', 'order', 'network', 'contract'),
+    'ExplanationOfBenefit': ('identifier', 'status', 'type', 'patient', 'billablePeriod',
+                             'created', 'insurer', 'provider', 'organization',
+                             'outcome', 'totalCost', 'payment'),
+}
+
+# Bundle elements kept by _summary=count
+COUNT_ELEMENTS = MANDATORY_ELEMENTS + ('type', 'total', 'link')
+
+SUBSETTED = OrderedDict([('system', 'http://hl7.org/fhir/v3/ObservationValue'),
+                         ('code', 'SUBSETTED')])
+
+
+class Projection(object):
+
+    def __init__(self, elements=None, summary=None):
+        self.elements = elements
+        self.summary = summary
+
+    def parameters(self):
+        """ The query parameters asking the backend for this projection """
+        params = OrderedDict()
+        if self.elements is not None:
+            params['_elements'] = ','.join(self.elements)
+        if self.summary is not None:
+            params['_summary'] = self.summary
+        return params
+
+    def apply(self, text):
+        """ JSON text of a resource, or of each resource of a Bundle, projected """
+        members = scan_object(text, 0, {'entry': {'resource': {}}})[0]
+        if member_value(text, members, 'resourceType') != 'Bundle':
+            return self.project(text, members) or text
+
+        if self.summary == 'count':
+            return subsetted(text, [m for m in members if m[0] in COUNT_ELEMENTS])
+
+        # splice each projected resource into the rest of the text
+        entries = find_member(members, 'entry')
+        pieces = []
+        pos = 0
+        for entry in (entries and entries[3]) or ():
+            for name, start, end, resource in entry[2] or ():
+                if name != 'resource' or resource is None:
+                    continue
+                projected = self.project(text, resource)
+                if projected is not None:
+                    pieces.append(text[pos:start])
+                    pieces.append(projected)
+                    pos = end
+        pieces.append(text[pos:])
+        return ''.join(pieces)
+
+    def project(self, text, members):
+        """ JSON text of the resource with members (see scan_object) projected, None if all are kept """
+        names = [m[0] for m in members]
+        if self.elements is not None:
+            keep = MANDATORY_ELEMENTS + tuple(self.elements)
+        elif self.summary in ('true', 'count'):
+            keep = MANDATORY_ELEMENTS + SUMMARY_ELEMENTS.get(member_value(text, members, 'resourceType'), ())
+        elif self.summary == 'data':
+            keep = [k for k in names if k != 'text']
+        else:
+            return None
+
+        kept = [m for m in members if m[0] in keep]
+        if len(kept) == len(members):
+            return None
+        return subsetted(text, kept)
+
+
+def find_member(members, name):
+    """ The member name of members (see scan_object), None if there is none """
+    for member in members:
+        if member[0] == name:
+            return member
+    return None
+
+
+def member_value(text, members, name):
+    """ Value of the member name of members, None if there is none """
+    member = find_member(members, name)
+    if member is None:
+        return None
+    return json.loads(text[member[1]:member[2]], object_pairs_hook=OrderedDict)
+
+
+def subsetted(text, members):
+    """ JSON text of an object of members, tagged SUBSETTED """
+    meta = member_value(text, members, 'meta')
+    if not isinstance(meta, dict):
+        meta = OrderedDict()
+    tags = meta.setdefault('tag', [])
+    if SUBSETTED not in tags:
+        tags.append(SUBSETTED)
+
+    pieces = ['%s: %s' % (json.dumps(name), json.dumps(meta) if name == 'meta' else text[start:end])
+              for name, start, end, scanned in members]
+    if find_member(members, 'meta') is None:
+        pieces.append('"meta": %s' % json.dumps(meta))
+    return '{%s}' % ', '.join(pieces)
+
+
+def get_projection(query):
+    """
+    The Projection asked for by _elements or _summary in query, or None.
+
+    Raises ValueError for an unknown _summary or for both parameters.
+    """
+    elements = query.get('_elements')
+    summary = query.get('_summary')
+
+    if elements and summary:
+        raise ValueError('_elements and _summary cannot be combined')
+
+    if elements:
+        return Projection(elements=[e.strip() for e in elements.split(',') if e.strip()])
+
+    if summary:
+        if summary not in SUMMARY_VALUES:
+            raise ValueError('_summary must be one of %s' % ', '.join(SUMMARY_VALUES))
+        if summary != 'false':
+            return Projection(summary=summary)
+
+    return None
@@ -0,0 +1,146 @@
+import gzip
+import hashlib
+import logging
+import threading
+import uuid
+
+from collections import Counter
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+
+from hhs_oauth_server.request_logging import register_stats
+
+logger = logging.getLogger('hhs_server.%s' % __name__)
+
+# Rewritten search results, gzipped, per beneficiary:
+#   fhir_search:<router>:<resource type>:<fhir_id>:<generation>:<hash>
+# The hash covers the public host path and the normalized backend query.
+# Entries live for the router's server_search_expiry seconds.
+# Purging a beneficiary moves their generation on, which orphans every
+# entry they have without having to enumerate the cache. That only
+# reaches every worker when FHIR_CACHE_ALIAS is a cache they share
+# (see is_shared); a per-process LocMemCache is purged in one process.
+_stats = Counter()
+_stats_lock = threading.Lock()
+_warned_not_shared = False
+
+
+def get_cache():
+    return caches[settings.FHIR_CACHE_ALIAS]
+
+
+def is_shared():
+    """ Do all workers (and management commands) see the same cache? """
+    return not isinstance(get_cache(), LocMemCache)
+
+
+def is_cacheable(resource_router, resource_type):
+    return (resource_type in settings.FHIR_SEARCH_CACHE_RESOURCE_TYPES and
+            resource_router.server_search_expiry > 0)
+
+
+def normalize_params(parameters):
+    """ Order-independent query string for a dict of backend parameters """
+    return urlencode(sorted(parameters.items()), doseq=True)
+
+
+def generation_key(router_pk, fhir_id):
+    return 'fhir_search_gen:%s:%s' % (router_pk, fhir_id)
+
+
+def get_generation(router_pk, fhir_id):
+    cache = get_cache()
+    key = generation_key(router_pk, fhir_id)
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, uuid.uuid4().hex[:12], None)
+        generation = cache.get(key)
+    return generation
+
+
+def make_key(resource_router, resource_type, fhir_id, host_path, parameters):
+    query = '%s?%s' % (host_path, normalize_params(parameters))
+    return 'fhir_search:%s:%s:%s:%s:%s' % (
+        resource_router.pk,
+        resource_type,
+        fhir_id,
+        get_generation(resource_router.pk, fhir_id),
+        hashlib.sha1(query.encode('utf-8')).hexdigest())
+
+
+def get_search(key, decompress=True):
+    """ Return the cached payload bytes for key, gzipped unless decompress, or None """
+    payload = get_cache().get(key)
+    if payload is None:
+        record('misses')
+        return None
+
+    record('hits')
+    if not decompress:
+        return payload
+    return gzip.decompress(payload)
+
+
+def set_search(key, resource_router, content):
+    """
+    Keep content (rewritten response bytes) for server_search_expiry.
+    Returns the gzipped bytes kept, or None if content is too large.
+    """
+    if len(content) > settings.FHIR_STREAM_MEMORY_CEILING:
+        record('skipped')
+        return None
+
+    payload = gzip.compress(content, settings.FHIR_SEARCH_CACHE_COMPRESSLEVEL)
+    get_cache().set(key, payload, resource_router.server_search_expiry)
+    record('stores')
+    return payload
+
+
+def purge_beneficiary(router_pk, fhir_id):
+    """
+    Drop every cached search for fhir_id on the router router_pk.
+    Returns False if the cache is per-process, so only this process was
+    purged, and logs a warning the first time.
+    """
+    get_cache().set(generation_key(router_pk, fhir_id),
+                    uuid.uuid4().hex[:12], None)
+    record('purges')
+    if not is_shared():
+        global _warned_not_shared
+        if not _warned_not_shared:
+            _warned_not_shared = True
+            logger.warning('FHIR_CACHE_ALIAS %s is a per-process cache: cached searches are '
+                           'purged in the process that asks only' % settings.FHIR_CACHE_ALIAS)
+        return False
+    logger.debug('Purged cached searches for %s on %s' % (fhir_id, router_pk))
+    return True
+
+
+def record(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def cache_stats():
+    """
+    hits, misses, stores, skipped and purges in this worker, logged with
+    the other worker statistics (see hhs_oauth_server.request_logging)
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    for name in ('hits', 'misses', 'stores', 'skipped', 'purges'):
+        stats.setdefault(name, 0)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+register_stats('search_cache', cache_stats)
@@ -0,0 +1,104 @@
+import json
+
+from django.test import Client, override_settings
+
+from .test_views import BACKEND, FHIR_ID, FhirProxyViewTestCase, backend_response
+
+
+class BatchTest(FhirProxyViewTestCase):
+
+    def backend(self, url, **kwargs):
+        resource_type, resource_id = url[len(BACKEND):].strip('/').split('/')
+        if resource_id == 'missing':
+            return backend_response({}, status_code=404)
+        return backend_response(
+            {'resourceType': resource_type,
+             'id': resource_id,
+             'patient': {'reference': 'Patient|' + (
+                 '20140000000001' if resource_id == 'other' else FHIR_ID)},
+             'link': BACKEND + resource_type + '/' + resource_id})
+
+    def post(self, bundle, client=None):
+        client = client or self.client
+        return client.post('/v1/fhir/', json.dumps(bundle),
+                           content_type='application/json',
+                           **self.auth_headers)
+
+    def batch(self, *urls):
+        return {'resourceType': 'Bundle',
+                'type': 'batch',
+                'entry': [{'request': {'method': 'GET', 'url': url}} for url in urls]}
+
+    def test_batch_read(self):
+        self.session.get.side_effect = self.backend
+
+        response = self.post(self.batch('ExplanationOfBenefit/carrier-1',
+                                        'ExplanationOfBenefit/other',
+                                        'ExplanationOfBenefit/missing',
+                                        'Patient/' + FHIR_ID,
+                                        'Organization/1'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, BACKEND)
+        bundle = response.json()
+        self.assertEqual(bundle['type'], 'batch-response')
+        self.assertEqual([e['response']['status'] for e in bundle['entry']],
+                         ['200 OK', '404 Not Found', '404 Not Found', '200 OK', '404 Not Found'])
+        self.assertEqual(bundle['entry'][0]['resource']['link'],
+                         'http://testserver/v1/fhir/ExplanationOfBenefit/carrier-1')
+        self.assertEqual(bundle['entry'][4]['response']['outcome']['resourceType'],
+                         'OperationOutcome')
+        self.assertEqual(self.session.get.call_count, 4)
+
+    def test_other_patient_not_fetched(self):
+        response = self.post(self.batch('Patient/20140000000001'))
+
+        self.assertEqual(response.json()['entry'][0]['response']['status'], '403 Forbidden')
+        self.assertFalse(self.session.get.called)
+
+    def test_only_get_reads(self):
+        bundle = self.batch('ExplanationOfBenefit/?patient=' + FHIR_ID)
+        bundle['entry'].append({'request': {'method': 'DELETE', 'url': 'Patient/1'}})
+
+        statuses = [e['response']['status'] for e in self.post(bundle).json()['entry']]
+
+        self.assertEqual(statuses, ['400 Bad Request', '405 Method Not Allowed'])
+
+    def test_malformed_entries(self):
+        """ Each gets its own 400, the others are still read """
+        self.session.get.side_effect = self.backend
+        bundle = self.batch(12, {'path': 'Patient/1'}, 'Patient/' + FHIR_ID)
+        bundle['entry'] += [{'request': {'method': ['GET'], 'url': 'Patient/1'}},
+                            {'request': 'GET Patient/1'},
+                            'Patient/1']
+
+        response = self.post(bundle)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([e['response']['status'] for e in response.json()['entry']],
+                         ['400 Bad Request', '400 Bad Request', '200 OK',
+                          '400 Bad Request', '400 Bad Request', '400 Bad Request'])
+
+    def test_not_a_batch(self):
+        self.assertEqual(self.post({'resourceType': 'Bundle', 'type': 'transaction'}).status_code, 400)
+        self.assertEqual(self.client.get('/v1/fhir/', **self.auth_headers).status_code, 405)
+
+    @override_settings(FHIR_BATCH_MAX_ENTRIES=1)
+    def test_entry_limit(self):
+        response = self.post(self.batch('Patient/' + FHIR_ID, 'Patient/' + FHIR_ID))
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_no_csrf_token_needed(self):
+        self.session.get.side_effect = self.backend
+
+        response = self.post(self.batch('Patient/' + FHIR_ID),
+                             client=Client(enforce_csrf_checks=True))
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_token_required(self):
+        response = self.client.post('/v1/fhir/', json.dumps(self.batch()),
+                                    content_type='application/json')
+
+        self.assertEqual(response.status_code, 401)
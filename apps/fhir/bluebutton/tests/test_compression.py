@@ -0,0 +1,88 @@
+import gzip
+import json
+
+from unittest.mock import patch
+
+from django.conf import settings
+from django.core.cache import caches
+from django.test import override_settings
+
+from .test_views import BACKEND, FHIR_ID, FhirProxyViewTestCase, backend_response
+
+
+def eob_bundle(entries=50):
+    return {'resourceType': 'Bundle',
+            'type': 'searchset',
+            'entry': [{'fullUrl': BACKEND + 'ExplanationOfBenefit/carrier-%s' % i,
+                       'resource': {'resourceType': 'ExplanationOfBenefit',
+                                    'id': 'carrier-%s' % i,
+                                    'patient': {'reference': 'Patient|' + FHIR_ID}}}
+                      for i in range(entries)]}
+
+
+class CompressionTest(FhirProxyViewTestCase):
+
+    def setUp(self):
+        super(CompressionTest, self).setUp()
+        caches[settings.FHIR_CACHE_ALIAS].clear()
+        self.session.get.side_effect = lambda *args, **kwargs: backend_response(eob_bundle())
+
+    def search(self, resource_type='ExplanationOfBenefit', **headers):
+        headers.update(self.auth_headers)
+        return self.client.get('/v1/fhir/%s/' % resource_type, **headers)
+
+    def test_gzip(self):
+        response = self.search(HTTP_ACCEPT_ENCODING='gzip, deflate')
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertTrue(response['ETag'].startswith('W/"'))
+        bundle = json.loads(gzip.decompress(response.content).decode('utf-8'))
+        self.assertEqual(bundle['entry'][49]['fullUrl'],
+                         'http://testserver/v1/fhir/ExplanationOfBenefit/carrier-49')
+
+    def test_identity(self):
+        response = self.search()
+
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(len(response.json()['entry']), 50)
+
+    def test_below_threshold(self):
+        self.session.get.side_effect = lambda *args, **kwargs: backend_response(eob_bundle(1))
+
+        response = self.search(HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_cache_entries_sent_as_stored(self):
+        """ A cached search is gzipped once, when it is stored """
+        with patch('apps.fhir.bluebutton.compression.gzip') as compression_gzip:
+            first = self.search(HTTP_ACCEPT_ENCODING='gzip')
+            second = self.search(HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertFalse(compression_gzip.compress.called)
+        self.assertEqual(self.session.get.call_count, 1)
+        self.assertEqual(second['Content-Encoding'], 'gzip')
+        self.assertEqual(second['ETag'], first['ETag'])
+        self.assertEqual(gzip.decompress(second.content), gzip.decompress(first.content))
+
+        response = self.search(HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_uncompressed_cache_hit(self):
+        first = self.search(HTTP_ACCEPT_ENCODING='gzip')
+        second = self.search()
+
+        self.assertFalse(second.has_header('Content-Encoding'))
+        self.assertEqual(second.content, gzip.decompress(first.content))
+
+    @override_settings(FHIR_STREAM_MEMORY_CEILING=10)
+    def test_streamed(self):
+        response = self.search(HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        content = gzip.decompress(b''.join(response.streaming_content)).decode('utf-8')
+        self.assertNotIn(BACKEND, content)
+        self.assertEqual(len(json.loads(content)['entry']), 50)
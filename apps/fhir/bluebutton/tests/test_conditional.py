@@ -0,0 +1,90 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.test import override_settings
+
+from .test_views import FHIR_ID, FhirProxyViewTestCase, backend_response
+
+PATIENT = {'resourceType': 'Patient',
+           'id': FHIR_ID,
+           'meta': {'versionId': '3', 'lastUpdated': '2018-02-01T10:00:00.000+00:00'}}
+
+
+class ConditionalReadTest(FhirProxyViewTestCase):
+
+    def setUp(self):
+        super(ConditionalReadTest, self).setUp()
+        caches[settings.FHIR_CACHE_ALIAS].clear()
+        self.session.get.side_effect = lambda *args, **kwargs: backend_response(PATIENT)
+        self.url = '/v1/fhir/Patient/%s' % FHIR_ID
+
+    def test_validators(self):
+        response = self.client.get(self.url, **self.auth_headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['ETag'].startswith('"'))
+        self.assertEqual(response['Last-Modified'], 'Thu, 01 Feb 2018 10:00:00 GMT')
+
+        # the same version through another url is another representation
+        other = self.client.get(self.url + '?_summary=data', **self.auth_headers)
+        self.assertNotEqual(other['ETag'], response['ETag'])
+
+    def test_if_none_match_served_without_backend(self):
+        etag = self.client.get(self.url, **self.auth_headers)['ETag']
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag, **self.auth_headers)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(self.session.get.call_count, 1)
+
+    def test_if_modified_since(self):
+        self.client.get(self.url, **self.auth_headers)
+
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE='Fri, 02 Feb 2018 00:00:00 GMT',
+                                   **self.auth_headers)
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE='Wed, 31 Jan 2018 00:00:00 GMT',
+                                   **self.auth_headers)
+        self.assertEqual(response.status_code, 200)
+
+    def test_changed_resource(self):
+        etag = self.client.get(self.url, **self.auth_headers)['ETag']
+        caches[settings.FHIR_CACHE_ALIAS].clear()
+        self.session.get.side_effect = lambda *args, **kwargs: backend_response(
+            dict(PATIENT, meta={'versionId': '4'}))
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag, **self.auth_headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    @override_settings(FHIR_VALIDATOR_CACHE_TTL=0)
+    def test_validator_cache_disabled(self):
+        etag = self.client.get(self.url, **self.auth_headers)['ETag']
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag, **self.auth_headers)
+
+        # checked against the backend's current version
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.session.get.call_count, 2)
+
+
+class ConditionalSearchTest(FhirProxyViewTestCase):
+
+    def setUp(self):
+        super(ConditionalSearchTest, self).setUp()
+        caches[settings.FHIR_CACHE_ALIAS].clear()
+        self.session.get.side_effect = lambda *args, **kwargs: backend_response(
+            {'resourceType': 'Bundle', 'type': 'searchset', 'total': 0})
+
+    def test_content_hash(self):
+        first = self.client.get('/v1/fhir/Coverage/', **self.auth_headers)
+        caches[settings.FHIR_CACHE_ALIAS].clear()
+
+        response = self.client.get('/v1/fhir/Coverage/', HTTP_IF_NONE_MATCH=first['ETag'],
+                                   **self.auth_headers)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.session.get.call_count, 2)
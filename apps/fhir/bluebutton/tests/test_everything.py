@@ -0,0 +1,117 @@
+import threading
+
+import requests
+
+from django.conf import settings
+from django.core.cache import caches
+from django.test import override_settings
+
+from .test_views import BACKEND, FHIR_ID, FhirProxyViewTestCase, backend_response
+
+
+class EverythingTest(FhirProxyViewTestCase):
+
+    def setUp(self):
+        super(EverythingTest, self).setUp()
+        caches[settings.FHIR_CACHE_ALIAS].clear()
+        self.url = '/v1/fhir/Patient/%s/$everything' % FHIR_ID
+
+    def backend(self, url, **kwargs):
+        if url.startswith(BACKEND + 'Patient/'):
+            return backend_response({'resourceType': 'Patient',
+                                     'id': FHIR_ID,
+                                     'link': BACKEND + 'Patient/' + FHIR_ID})
+        resource_type = url[len(BACKEND):].strip('/')
+        return backend_response(
+            {'resourceType': 'Bundle',
+             'entry': [{'fullUrl': BACKEND + '%s/%s-1' % (resource_type, resource_type),
+                        'resource': {'resourceType': resource_type}}]})
+
+    def test_bundle(self):
+        self.session.get.side_effect = self.backend
+
+        response = self.client.get(self.url, **self.auth_headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, BACKEND)
+        bundle = response.json()
+        self.assertEqual(bundle['resourceType'], 'Bundle')
+        self.assertEqual(bundle['total'], 3)
+        self.assertEqual([e['resource']['resourceType'] for e in bundle['entry']],
+                         ['Patient', 'Coverage', 'ExplanationOfBenefit'])
+        self.assertEqual(bundle['entry'][0]['resource']['link'],
+                         'http://testserver/v1/fhir/Patient/' + FHIR_ID)
+        self.assertEqual(bundle['entry'][2]['fullUrl'],
+                         'http://testserver/v1/fhir/ExplanationOfBenefit/ExplanationOfBenefit-1')
+
+    def paged_backend(self, url, params=None, **kwargs):
+        """ Two ExplanationOfBenefit pages of one entry each """
+        if 'ExplanationOfBenefit' not in url:
+            return self.backend(url, **kwargs)
+        start = params.get('startIndex', 0)
+        links = [{'relation': 'self', 'url': BACKEND + 'ExplanationOfBenefit?startIndex=%s' % start}]
+        if start == 0:
+            links.append({'relation': 'next', 'url': BACKEND + 'ExplanationOfBenefit?startIndex=1'})
+        return backend_response(
+            {'resourceType': 'Bundle', 'total': 2, 'link': links,
+             'entry': [{'fullUrl': BACKEND + 'ExplanationOfBenefit/carrier-%s' % start}]})
+
+    @override_settings(FHIR_PAGE_SIZE_MAX_BY_TYPE={'ExplanationOfBenefit': 1})
+    def test_pages_followed(self):
+        self.session.get.side_effect = self.paged_backend
+
+        bundle = self.client.get(self.url, **self.auth_headers).json()
+
+        self.assertEqual(bundle['total'], 4)
+        self.assertEqual([e['fullUrl'].rsplit('/', 1)[1] for e in bundle['entry'][2:]],
+                         ['carrier-0', 'carrier-1'])
+        self.assertEqual([link['relation'] for link in bundle['link']], ['self'])
+        self.assertEqual(self.session.get.call_count, 4)
+
+    @override_settings(FHIR_PAGE_SIZE_MAX_BY_TYPE={'ExplanationOfBenefit': 1},
+                       FHIR_EVERYTHING_MAX_PAGES=1)
+    def test_pages_capped(self):
+        """ The Bundle counts what the backend has and links to the rest """
+        self.session.get.side_effect = self.paged_backend
+
+        bundle = self.client.get(self.url, **self.auth_headers).json()
+
+        self.assertEqual(len(bundle['entry']), 3)
+        self.assertEqual(bundle['total'], 4)
+        self.assertEqual(bundle['link'][1],
+                         {'relation': 'next',
+                          'url': 'http://testserver/v1/fhir/ExplanationOfBenefit?_count=1&startIndex=1'})
+
+    def test_backend_calls_concurrent(self):
+        """ The three calls are all in flight at once """
+        barrier = threading.Barrier(3, timeout=5)
+
+        def backend(url, **kwargs):
+            barrier.wait()
+            return self.backend(url, **kwargs)
+
+        self.session.get.side_effect = backend
+
+        response = self.client.get(self.url, **self.auth_headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.session.get.call_count, 3)
+
+    def test_other_patient(self):
+        response = self.client.get('/v1/fhir/Patient/20140000000001/$everything',
+                                   **self.auth_headers)
+
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(self.session.get.called)
+
+    def test_backend_failure(self):
+        def backend(url, **kwargs):
+            if 'Coverage' in url:
+                raise requests.ConnectionError('reset')
+            return self.backend(url, **kwargs)
+
+        self.session.get.side_effect = backend
+
+        response = self.client.get(self.url, **self.auth_headers)
+
+        self.assertEqual(response.status_code, 502)
@@ -0,0 +1,199 @@
+import gzip
+import io
+import json
+import shutil
+import tempfile
+
+from datetime import timedelta
+
+from django.core.management import call_command
+from django.test import override_settings
+from django.utils import timezone
+from unittest.mock import patch
+
+from ..export import next_page_url, reclaim_stale_jobs
+from ..models import ExportJob
+from .test_views import BACKEND, FHIR_ID, FhirProxyViewTestCase, backend_response
+
+
+class ExportTest(FhirProxyViewTestCase):
+
+    def setUp(self):
+        super(ExportTest, self).setUp()
+        export_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, export_root)
+        settings_override = override_settings(FHIR_EXPORT_ROOT=export_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        # the worker gets its session from the export module
+        session_patcher = patch('apps.fhir.bluebutton.export.get_session')
+        session_patcher.start().return_value = self.session
+        self.addCleanup(session_patcher.stop)
+
+    def backend(self, url, params=None, **kwargs):
+        if url.startswith(BACKEND + 'Patient/'):
+            return backend_response({'resourceType': 'Patient', 'id': FHIR_ID})
+        if url == BACKEND + 'ExplanationOfBenefit/':
+            # first of two pages
+            return backend_response(
+                {'resourceType': 'Bundle',
+                 'link': [{'relation': 'next',
+                           'url': BACKEND + 'ExplanationOfBenefit/?page=2'}],
+                 'entry': [{'resource': {'resourceType': 'ExplanationOfBenefit',
+                                         'id': 'carrier-%s' % i,
+                                         'patient': {'reference': BACKEND + 'Patient/' + FHIR_ID}}}
+                           for i in range(2)]})
+        if url == BACKEND + 'ExplanationOfBenefit/?page=2':
+            return backend_response(
+                {'resourceType': 'Bundle',
+                 'link': [{'relation': 'next', 'url': 'https://elsewhere.example.com/'}],
+                 'entry': [{'resource': {'resourceType': 'ExplanationOfBenefit',
+                                         'id': 'carrier-2'}}]})
+        return backend_response({'resourceType': 'Bundle', 'entry': []})
+
+    def kick_off(self, query=''):
+        return self.client.get('/v1/fhir/Patient/$export' + query, **self.auth_headers)
+
+    def run_worker(self):
+        call_command('process_export_jobs', once=True, stdout=io.StringIO())
+
+    def test_export(self):
+        self.session.get.side_effect = self.backend
+
+        response = self.kick_off()
+        self.assertEqual(response.status_code, 202)
+        status_url = response['Content-Location']
+        self.assertFalse(self.session.get.called)
+
+        response = self.client.get(status_url, **self.auth_headers)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response['X-Progress'], 'queued')
+        self.assertIn('Retry-After', response)
+
+        self.run_worker()
+
+        response = self.client.get(status_url, **self.auth_headers)
+        self.assertEqual(response.status_code, 200)
+        manifest = response.json()
+        self.assertTrue(manifest['requiresAccessToken'])
+        self.assertEqual([(o['type'], o['count']) for o in manifest['output']],
+                         [('Patient', 1), ('Coverage', 0), ('ExplanationOfBenefit', 3)])
+
+        # the first page was asked for in FHIR_EXPORT_PAGE_SIZE pieces,
+        # the off-backend next link on the second was not followed
+        urls = [c[0][0] for c in self.session.get.call_args_list]
+        self.assertEqual(len(urls), 4)
+        eob_call = [c for c in self.session.get.call_args_list
+                    if c[0][0] == BACKEND + 'ExplanationOfBenefit/'][0]
+        self.assertEqual(eob_call[1]['params']['_count'], 100)
+        self.assertEqual(eob_call[1]['params']['patient'], FHIR_ID)
+
+        response = self.client.get(manifest['output'][2]['url'], HTTP_ACCEPT_ENCODING='gzip',
+                                   **self.auth_headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/fhir+ndjson')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        gzipped = b''.join(response.streaming_content)
+        lines = gzip.decompress(gzipped).decode('utf-8').splitlines()
+
+        # a client that does not take gzip gets plain NDJSON
+        response = self.client.get(manifest['output'][2]['url'], **self.auth_headers)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(b''.join(response.streaming_content), gzip.decompress(gzipped))
+        resources = [json.loads(line) for line in lines]
+        self.assertEqual([r['id'] for r in resources], ['carrier-0', 'carrier-1', 'carrier-2'])
+        self.assertEqual(resources[0]['patient']['reference'],
+                         'http://testserver/v1/fhir/Patient/' + FHIR_ID)
+
+    def test_type(self):
+        self.session.get.side_effect = self.backend
+
+        self.kick_off('?_type=Coverage')
+        self.run_worker()
+
+        job = ExportJob.objects.get()
+        self.assertEqual(job.status, ExportJob.COMPLETE)
+        self.assertEqual(job.get_output(), [{'type': 'Coverage', 'count': 0}])
+        self.assertEqual(self.session.get.call_count, 1)
+
+    def test_unsupported_type(self):
+        response = self.kick_off('?_type=Coverage,Claim')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(ExportJob.objects.exists())
+
+    def test_backend_failure(self):
+        self.session.get.return_value = backend_response({}, status_code=500)
+
+        status_url = self.kick_off()['Content-Location']
+        self.run_worker()
+
+        response = self.client.get(status_url, **self.auth_headers)
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(ExportJob.objects.get().status, ExportJob.FAILED)
+
+    def test_unexpected_error(self):
+        """ Any error fails the job and leaves the worker running """
+        self.session.get.side_effect = OSError('Could not find the TLS CA certificate bundle')
+
+        status_url = self.kick_off()['Content-Location']
+        self.run_worker()
+
+        job = ExportJob.objects.get()
+        self.assertEqual(job.status, ExportJob.FAILED)
+        self.assertIn('OSError', job.error)
+        self.assertEqual(self.client.get(status_url, **self.auth_headers).status_code, 500)
+
+    @override_settings(FHIR_EXPORT_STALE_AFTER=60, FHIR_EXPORT_MAX_ATTEMPTS=2)
+    def test_stale_job_reclaimed(self):
+        self.kick_off()
+        long_ago = timezone.now() - timedelta(seconds=120)
+        ExportJob.objects.update(status=ExportJob.RUNNING, attempts=1, date_heartbeat=long_ago)
+
+        self.assertEqual(reclaim_stale_jobs(), 1)
+        self.assertEqual(ExportJob.objects.get().status, ExportJob.QUEUED)
+
+        # a job whose worker keeps dying is given up on
+        ExportJob.objects.update(status=ExportJob.RUNNING, attempts=2, date_heartbeat=long_ago)
+        reclaim_stale_jobs()
+        self.assertEqual(ExportJob.objects.get().status, ExportJob.FAILED)
+
+        # one still being worked on is left alone
+        ExportJob.objects.update(status=ExportJob.RUNNING, date_heartbeat=timezone.now())
+        self.assertEqual(reclaim_stale_jobs(), 0)
+
+    def test_malformed_links(self):
+        rr = self.user.crosswalk.fhir_source
+        next_link = {'relation': 'next', 'url': BACKEND + 'ExplanationOfBenefit?page=2'}
+
+        self.assertEqual(next_page_url(rr, json.dumps({'link': [None, 'next', next_link]})),
+                         BACKEND + 'ExplanationOfBenefit?page=2')
+        self.assertIsNone(next_page_url(rr, json.dumps({'link': 'next'})))
+        self.assertIsNone(next_page_url(rr, json.dumps({'link': [{'relation': 'next', 'url': None}]})))
+
+    def test_other_user(self):
+        self.session.get.side_effect = self.backend
+        status_url = self.kick_off()['Content-Location']
+        self.run_worker()
+        file_url = self.client.get(status_url, **self.auth_headers).json()['output'][0]['url']
+
+        self._create_user('other', 'secret')
+        access_token = self._get_access_token('other', 'secret',
+                                              application=ExportJob.objects.get().application)
+        other_headers = {'HTTP_AUTHORIZATION': 'Bearer %s' % access_token}
+
+        self.assertEqual(self.client.get(status_url, **other_headers).status_code, 404)
+        self.assertEqual(self.client.get(file_url, **other_headers).status_code, 404)
+
+    def test_cancel(self):
+        status_url = self.kick_off()['Content-Location']
+
+        response = self.client.delete(status_url, **self.auth_headers)
+        self.assertEqual(response.status_code, 202)
+        self.run_worker()
+
+        self.assertFalse(self.session.get.called)
+        self.assertEqual(self.client.get(status_url, **self.auth_headers).status_code, 404)
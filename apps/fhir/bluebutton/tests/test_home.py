@@ -9,7 +9,15 @@ Created: 7/19/16 9:04 AM
 
 File created by: ''
 """
-from django.test import TestCase, RequestFactory
+import json
+
+from unittest.mock import patch
+from django.conf import settings
+from django.core.cache import caches
+from django.test import TestCase, RequestFactory, override_settings
+
+from .data_conformance import CONFORMANCE
+from .test_views import backend_response
 
 
 class BlueButtonReadRequestTest(TestCase):
@@ -32,3 +40,68 @@ class ConformanceFilterTest(TestCase):
     # Make call to Conformance Statement
 
     # Test that Patient is only resource displayed
+
+
+class MetadataCacheTest(TestCase):
+    """ The filtered statement is cached and revalidated by ETag """
+
+    fixtures = ['fhir_server_new_testdata.json']
+
+    def setUp(self):
+        caches[settings.FHIR_CACHE_ALIAS].clear()
+        session_patcher = patch('apps.fhir.bluebutton.utils.get_session')
+        self.session = session_patcher.start().return_value
+        self.addCleanup(session_patcher.stop)
+        self.session.get.side_effect = lambda *args, **kwargs: backend_response(
+            json.loads(CONFORMANCE))
+
+    def test_metadata_cached_with_etag(self):
+        response = self.client.get('/v1/fhir/metadata')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['ETag'].startswith('"'))
+        self.assertIn('max-age', response['Cache-Control'])
+        self.assertIn('security', response.json()['rest'][0])
+
+        again = self.client.get('/v1/fhir/metadata')
+        self.assertEqual(again.content, response.content)
+        self.assertEqual(self.session.get.call_count, 1)
+
+    def test_if_none_match(self):
+        etag = self.client.get('/v1/fhir/metadata')['ETag']
+
+        response = self.client.get('/v1/fhir/metadata',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+
+        response = self.client.get('/v1/fhir/metadata',
+                                   HTTP_IF_NONE_MATCH='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+        # compared as for reads: lists, * and weak validators
+        for if_none_match in ('"stale", ' + etag, '*', 'W/' + etag):
+            response = self.client.get('/v1/fhir/metadata',
+                                       HTTP_IF_NONE_MATCH=if_none_match)
+            self.assertEqual(response.status_code, 304)
+            self.assertIn('max-age', response['Cache-Control'])
+
+    @override_settings(FHIR_METADATA_REFRESH_AHEAD=3600)
+    def test_refresh_before_expiry(self):
+        """ An entry due for refresh is served while a rebuild runs """
+        self.client.get('/v1/fhir/metadata')
+
+        with patch('apps.fhir.bluebutton.views.home.Thread') as thread:
+            response = self.client.get('/v1/fhir/metadata')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.session.get.call_count, 1)
+        thread.return_value.start.assert_called_once_with()
+
+        # the thread rebuilds from values read off the request
+        refresh = thread.call_args[1]['target']
+        self.assertNotIn(response.wsgi_request, [cell.cell_contents for cell in refresh.__closure__])
+        refresh()
+        self.assertEqual(self.session.get.call_count, 2)
+        headers = self.session.get.call_args[1]['headers']
+        self.assertEqual(headers['BlueButton-OriginalUrl'], '/v1/fhir/metadata')
@@ -0,0 +1,60 @@
+import json
+
+from django.test import SimpleTestCase
+
+from apps.fhir.bluebutton.jsonscan import find_member, scan_object
+
+
+class FindMemberTest(SimpleTestCase):
+
+    def test_member_found(self):
+        text = json.dumps({'resourceType': 'ExplanationOfBenefit',
+                           'id': 'carrier-1',
+                           'patient': {'reference': 'Patient|20140000008325'},
+                           'item': [{'sequence': 1}]})
+
+        self.assertEqual(find_member(text, 'patient'),
+                         {'reference': 'Patient|20140000008325'})
+
+    def test_skips_members_ahead(self):
+        """ Nested members of the same name and brackets in strings """
+        text = ('{"contained": [{"patient": {"reference": "Patient|other"}}],\n'
+                ' "text": {"div": "<div>[ { \\" } ]</div>"},\n'
+                ' "total": -1.5e3, "active": true, "note": null,\n'
+                ' "p\\u0061tient": {"reference": "Patient|20140000008325"}}')
+
+        self.assertEqual(find_member(text, 'patient')['reference'],
+                         'Patient|20140000008325')
+
+    def test_missing_member(self):
+        with self.assertRaises(KeyError):
+            find_member('{"resourceType": "Coverage", "item": [1, 2]}', 'beneficiary')
+        with self.assertRaises(KeyError):
+            find_member(' {} ', 'beneficiary')
+
+    def test_not_an_object(self):
+        for text in ('[]', '', '{"a" 1}', '{"a": [1, 2}'):
+            with self.assertRaises(ValueError):
+                find_member(text, 'b')
+
+
+class ScanObjectTest(SimpleTestCase):
+
+    def test_members(self):
+        text = '{"a": [1, {"b": 2}, 3], "c" : {"d": "}"}, "e": {}}'
+
+        members, end = scan_object(text, 0, {'a': {}, 'c': {}})
+
+        self.assertEqual(end, len(text))
+        self.assertEqual([(name, text[start:end]) for name, start, end, scanned in members],
+                         [('a', '[1, {"b": 2}, 3]'), ('c', '{"d": "}"}'), ('e', '{}')])
+        items = members[0][3]
+        self.assertEqual([text[start:end] for start, end, scanned in items], ['1', '{"b": 2}', '3'])
+        self.assertEqual([scanned is None for start, end, scanned in items], [True, False, True])
+        self.assertEqual(members[1][3][0][0], 'd')
+        self.assertIsNone(members[2][3])
+
+    def test_not_an_object(self):
+        for text in ('[]', '', '{"a": 1,}', '{"a": [1 2]}', '{"a": 1'):
+            with self.assertRaises(ValueError):
+                scan_object(text, 0, {'a': {}})
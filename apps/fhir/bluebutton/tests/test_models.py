@@ -1,10 +1,17 @@
 from __future__ import unicode_literals
 from __future__ import absolute_import
 
+import requests
+
+from django.test import SimpleTestCase
+
 from apps.test import BaseApiTest
 
 from ..models import Crosswalk
+from ..utils import build_fhir_response
 from ...server.models import ResourceRouter
+from ...server.resilience import CircuitOpenError
+from .test_views import backend_response
 
 
 class TestModels(BaseApiTest):
@@ -54,3 +61,35 @@ class TestModels(BaseApiTest):
 
         invalid_match = "http://localhost:8000/fhir/" + "Practitioner/123456"
         self.assertNotEqual(url_info, invalid_match)
+
+
+class TestFhirResponse(SimpleTestCase):
+
+    def test_envelope_from_backend_response(self):
+        r = backend_response({'resourceType': 'Patient', 'id': '1'})
+        response = build_fhir_response(None, 'http://backend/Patient/1', None, r=r, elapsed=0.25)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['id'], '1')
+        self.assertIs(response.json(), response.json())
+        self.assertEqual(response.headers['Content-Type'], 'application/json+fhir')
+        self.assertEqual(response.elapsed, 0.25)
+        self.assertIsNone(response.error)
+        with self.assertRaises(AttributeError):
+            response.status_code = 500
+
+    def test_envelope_from_error(self):
+        response = build_fhir_response(None, 'http://backend/', None,
+                                       e=requests.exceptions.ReadTimeout())
+
+        self.assertEqual(response.status_code, 504)
+        self.assertEqual(response.error, 'timeout')
+        self.assertEqual(response.json()['code'], 504)
+        self.assertIsNone(response.retry_after)
+
+    def test_envelope_unavailable(self):
+        response = build_fhir_response(None, 'http://backend/', None,
+                                       e=CircuitOpenError(1, 30))
+
+        self.assertEqual((response.status_code, response.error, response.retry_after),
+                         (503, 'unavailable', 30))
@@ -0,0 +1,182 @@
+import json
+
+from unittest.mock import patch
+
+from django.conf import settings
+from django.core.cache import caches
+from django.test import SimpleTestCase, override_settings
+
+from apps.fhir.bluebutton.paging import next_page_parameters, page_parameters, rewrite_page_links
+
+from .test_views import BACKEND, FHIR_ID, FhirProxyViewTestCase, backend_response
+
+HOST_PATH = 'http://testserver/v1/fhir'
+
+
+def eob_page(start, count, total):
+    """ A backend searchset Bundle for one page of total EOBs """
+    links = [{'relation': 'first', 'url': BACKEND + 'ExplanationOfBenefit?_getpages=x&startIndex=0'},
+             {'relation': 'self', 'url': BACKEND + 'ExplanationOfBenefit?_getpages=x&startIndex=%s' % start}]
+    if start + count < total:
+        links.append({'relation': 'next', 'url': BACKEND + 'ExplanationOfBenefit?_getpages=x'})
+    return {'resourceType': 'Bundle',
+            'total': total,
+            'link': links,
+            'entry': [{'resource': {'resourceType': 'ExplanationOfBenefit', 'id': str(i)}}
+                      for i in range(start, min(start + count, total))]}
+
+
+class PageParametersTest(SimpleTestCase):
+
+    def test_default_and_clamp(self):
+        self.assertEqual(page_parameters({}, 'ExplanationOfBenefit'), {'_count': 50})
+        self.assertEqual(page_parameters({'_count': '500'}, 'ExplanationOfBenefit'), {'_count': 50})
+        self.assertEqual(page_parameters({'_count': '500'}, 'Coverage'), {'_count': 100})
+        self.assertEqual(page_parameters({'_count': '10', 'startIndex': '20'}, 'Coverage'),
+                         {'_count': 10, 'startIndex': 20})
+
+    def test_invalid(self):
+        for query in ({'_count': 'ten'}, {'_count': '-1'}, {'startIndex': '-5'}):
+            with self.assertRaises(ValueError):
+                page_parameters(query, 'Coverage')
+
+    def test_rewrite_links(self):
+        text = json.dumps(eob_page(10, 10, 35))
+        text_out = rewrite_page_links(text, HOST_PATH, 'ExplanationOfBenefit',
+                                      {'_count': 10, 'startIndex': 10, 'patient': FHIR_ID})
+
+        links = dict((l['relation'], l['url']) for l in json.loads(text_out)['link'])
+        self.assertEqual(links, {
+            'first': HOST_PATH + '/ExplanationOfBenefit?_count=10&startIndex=0',
+            'self': HOST_PATH + '/ExplanationOfBenefit?_count=10&startIndex=10',
+            'next': HOST_PATH + '/ExplanationOfBenefit?_count=10&startIndex=20'})
+        # nothing but the links changed
+        self.assertEqual(json.loads(text_out)['entry'], json.loads(text)['entry'])
+
+    def test_malformed_links_skipped(self):
+        page = eob_page(0, 10, 35)
+        page['link'][1:1] = ['self', None]
+        text = json.dumps(page)
+        params = {'_count': 10}
+
+        links = json.loads(rewrite_page_links(text, HOST_PATH, 'ExplanationOfBenefit', params))['link']
+
+        self.assertEqual(links[1:3], ['self', None])
+        self.assertEqual(links[4]['url'], HOST_PATH + '/ExplanationOfBenefit?_count=10&startIndex=10')
+        self.assertEqual(next_page_parameters(text, params), {'_count': 10, 'startIndex': 10})
+        self.assertIsNone(next_page_parameters('{"link": [null, "next"]}', params))
+
+    def test_rewrite_links_of_partial_text(self):
+        """ The start of a streamed page """
+        text = json.dumps(eob_page(0, 10, 35))
+        head = text[:text.index('"entry"') + 20]
+
+        text_out = rewrite_page_links(head, HOST_PATH, 'ExplanationOfBenefit', {'_count': 10})
+
+        self.assertNotIn(BACKEND, text_out)
+        self.assertTrue(text_out.endswith(head[-20:]))
+        # links cut off are left alone
+        head = text[:text.index('"link"') + 20]
+        self.assertEqual(rewrite_page_links(head, HOST_PATH, 'ExplanationOfBenefit', {'_count': 10}), head)
+
+
+class PagedSearchTest(FhirProxyViewTestCase):
+
+    def setUp(self):
+        super(PagedSearchTest, self).setUp()
+        caches[settings.FHIR_CACHE_ALIAS].clear()
+
+        def backend(url, params=None, **kwargs):
+            return backend_response(eob_page(params.get('startIndex', 0), params['_count'], 25))
+
+        self.session.get.side_effect = backend
+
+    def search(self, query=''):
+        return self.client.get('/v1/fhir/ExplanationOfBenefit/' + query, **self.auth_headers)
+
+    def test_page_size_clamped(self):
+        response = self.search('?_count=1000')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.session.get.call_args[1]['params']['_count'], 50)
+        self.assertEqual(len(response.json()['entry']), 25)
+
+    def test_walk_pages(self):
+        url = '?_count=10'
+        ids = []
+        while url:
+            response = self.search(url[url.index('?'):])
+            self.assertEqual(response.status_code, 200)
+            self.assertNotContains(response, BACKEND)
+            bundle = response.json()
+            ids.extend(e['resource']['id'] for e in bundle['entry'])
+            url = dict((l['relation'], l['url']) for l in bundle['link']).get('next')
+
+        self.assertEqual(ids, [str(i) for i in range(25)])
+        self.assertEqual([c[1]['params'].get('startIndex') for c in self.session.get.call_args_list],
+                         [None, 10, 20])
+
+    @override_settings(FHIR_STREAM_CHUNK_SIZE=100, FHIR_STREAM_MEMORY_CEILING=400)
+    def test_streamed_page_links(self):
+        """ A page too large to hold gets its links rewritten as well """
+        response = self.search('?_count=10&startIndex=10')
+
+        self.assertTrue(response.streaming)
+        bundle = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        links = dict((l['relation'], l['url']) for l in bundle['link'])
+        self.assertEqual(links['next'], HOST_PATH + '/ExplanationOfBenefit?_count=10&startIndex=20')
+        self.assertEqual([e['resource']['id'] for e in bundle['entry']],
+                         [str(i) for i in range(10, 20)])
+
+    def test_invalid_count(self):
+        response = self.search('?_count=many')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(self.session.get.called)
+
+    @override_settings(FHIR_PAGE_PREFETCH=True)
+    def test_prefetch_next_page(self):
+        class Pool(object):
+            """ Run submitted tasks right away """
+            def submit(self, fn, *args):
+                fn(*args)
+
+        with patch('apps.fhir.bluebutton.views.search.get_pool', return_value=Pool()):
+            # the first page alone is no sign of a client walking pages
+            self.search('?_count=10')
+            self.assertEqual(self.session.get.call_count, 1)
+
+            self.search('?_count=10&startIndex=10')
+            self.assertEqual(self.session.get.call_count, 3)
+
+            # the last page has no next page to prefetch
+            response = self.search('?_count=10&startIndex=20')
+            self.assertEqual(self.session.get.call_count, 3)
+
+        self.assertEqual([e['resource']['id'] for e in response.json()['entry']],
+                         [str(i) for i in range(20, 25)])
+
+    @override_settings(FHIR_PAGE_PREFETCH=True)
+    def test_prefetch_runs_without_the_request(self):
+        """ The task gets values read off the request, and may run once it is finished """
+        tasks = []
+
+        class Pool(object):
+            def submit(self, fn, *args):
+                tasks.append((fn, args))
+
+        with patch('apps.fhir.bluebutton.views.search.get_pool', return_value=Pool()):
+            response = self.search('?_count=10&startIndex=10')
+
+        run_task, (fetch, target_url) = tasks[0]
+        self.assertNotIn(response.wsgi_request, [cell.cell_contents for cell in fetch.__closure__])
+        run_task(fetch, target_url)
+
+        self.assertEqual(self.session.get.call_count, 2)
+        self.assertEqual(self.session.get.call_args[1]['params']['startIndex'], 20)
+        self.assertEqual(self.session.get.call_args[1]['headers']['BlueButton-OriginalQuery'],
+                         '_count=10&startIndex=10')
+        response = self.search('?_count=10&startIndex=20')
+        self.assertEqual(self.session.get.call_count, 2)
+        self.assertEqual([e['resource']['id'] for e in response.json()['entry']],
+                         [str(i) for i in range(20, 25)])
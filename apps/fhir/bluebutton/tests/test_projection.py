@@ -0,0 +1,131 @@
+import json
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.test import SimpleTestCase, override_settings
+
+from apps.fhir.bluebutton.projection import get_projection
+
+from .test_views import BACKEND, FHIR_ID, FhirProxyViewTestCase, backend_response
+
+EOB = {'resourceType': 'ExplanationOfBenefit',
+       'id': 'carrier-1',
+       'text': {'div': '<div>claim</div>'},
+       'type': {'text': 'carrier'},
+       'patient': {'reference': 'Patient|' + FHIR_ID},
+       'billablePeriod': {'start': '2017-01-01'},
+       'item': [{'sequence': 1}, {'sequence': 2}]}
+
+
+def apply(query, data):
+    text = get_projection(query).apply(json.dumps(data))
+    return json.loads(text, object_pairs_hook=OrderedDict)
+
+
+class GetProjectionTest(SimpleTestCase):
+
+    def test_no_projection(self):
+        self.assertIsNone(get_projection({}))
+        self.assertIsNone(get_projection({'_summary': 'false'}))
+
+    def test_invalid(self):
+        for query in ({'_summary': 'maybe'}, {'_summary': 'true', '_elements': 'id'}):
+            with self.assertRaises(ValueError):
+                get_projection(query)
+
+    def test_elements(self):
+        resource = apply({'_elements': 'type, billablePeriod'}, EOB)
+
+        self.assertEqual(list(resource), ['resourceType', 'id', 'type', 'billablePeriod', 'meta'])
+        self.assertEqual(resource['meta']['tag'][0]['code'], 'SUBSETTED')
+
+    def test_summary(self):
+        summary = apply({'_summary': 'true'}, EOB)
+        data = apply({'_summary': 'data'}, EOB)
+
+        self.assertNotIn('item', summary)
+        self.assertIn('patient', summary)
+        self.assertNotIn('text', data)
+        self.assertIn('item', data)
+
+    def test_bundle(self):
+        bundle = {'resourceType': 'Bundle', 'type': 'searchset', 'total': 1,
+                  'entry': [{'resource': dict(EOB)}]}
+
+        projected = apply({'_elements': 'type'}, bundle)
+        count = apply({'_summary': 'count'}, bundle)
+
+        self.assertEqual(list(projected['entry'][0]['resource']),
+                         ['resourceType', 'id', 'type', 'meta'])
+        self.assertNotIn('entry', count)
+        self.assertEqual(count['total'], 1)
+
+    def test_text_kept(self):
+        """ Members kept are copied from the backend's text, meta where it was """
+        text = ('{"resourceType":"Bundle","entry":[{"fullUrl":"x/1","resource":'
+                '{"resourceType":"ExplanationOfBenefit","meta":{"lastUpdated":"2018"},'
+                '"type":{ "text" : "carrier" },"item":[1,2]}},{"fullUrl":"x/2"}],"total":2}')
+
+        projected = get_projection({'_elements': 'type'}).apply(text)
+
+        self.assertEqual(projected,
+                         '{"resourceType":"Bundle","entry":[{"fullUrl":"x/1","resource":'
+                         '{"resourceType": "ExplanationOfBenefit", "meta": {"lastUpdated": "2018", "tag": '
+                         '[{"system": "http://hl7.org/fhir/v3/ObservationValue", "code": "SUBSETTED"}]}, '
+                         '"type": { "text" : "carrier" }}},{"fullUrl":"x/2"}],"total":2}')
+        # nothing cut, nothing changed
+        self.assertEqual(get_projection({'_summary': 'data'}).apply(text), text)
+
+
+class ProjectionViewTest(FhirProxyViewTestCase):
+
+    def setUp(self):
+        super(ProjectionViewTest, self).setUp()
+        caches[settings.FHIR_CACHE_ALIAS].clear()
+
+    def test_read_elements(self):
+        self.session.get.return_value = backend_response(EOB)
+
+        response = self.client.get('/v1/fhir/ExplanationOfBenefit/carrier-1?_elements=type',
+                                   **self.auth_headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.json()), ['resourceType', 'id', 'type', 'meta'])
+        self.assertNotIn('_elements', self.session.get.call_args[1]['params'])
+
+    def test_read_summary_count(self):
+        response = self.client.get('/v1/fhir/ExplanationOfBenefit/carrier-1?_summary=count',
+                                   **self.auth_headers)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(self.session.get.called)
+
+    def search(self, query):
+        self.session.get.return_value = backend_response(
+            {'resourceType': 'Bundle', 'type': 'searchset', 'total': 1,
+             'link': [{'relation': 'self', 'url': BACKEND + 'ExplanationOfBenefit?patient=' + FHIR_ID}],
+             'entry': [{'resource': EOB}]})
+        return self.client.get('/v1/fhir/ExplanationOfBenefit/' + query, **self.auth_headers)
+
+    def test_search_projected_here(self):
+        response = self.search('?_summary=true')
+
+        entry = response.json()['entry'][0]['resource']
+        self.assertNotIn('item', entry)
+        self.assertNotIn('_summary', self.session.get.call_args[1]['params'])
+        self.assertIn('_summary=true', response.json()['link'][0]['url'])
+
+        # the projection is part of the cache key
+        response = self.search('')
+        self.assertIn('item', response.json()['entry'][0]['resource'])
+        self.assertEqual(self.session.get.call_count, 2)
+
+    @override_settings(FHIR_PROJECTION_PASSTHROUGH=True)
+    def test_search_passthrough(self):
+        response = self.search('?_elements=type')
+
+        self.assertEqual(self.session.get.call_args[1]['params']['_elements'], 'type')
+        # the backend's answer is returned as it is
+        self.assertIn('item', response.json()['entry'][0]['resource'])
@@ -19,11 +19,11 @@ class ConformanceReadRequestTest(TestCase):
         # Setup the RequestFactory
         self.factory = RequestFactory()
 
-    @patch('apps.fhir.bluebutton.utils.requests')
-    def test_fhir_bluebutton_read_conformance_testcase(self, mock_requests):
+    @patch('apps.fhir.bluebutton.utils.get_session')
+    def test_fhir_bluebutton_read_conformance_testcase(self, mock_get_session):
         """ Checking Conformance
 
-            The @patch replaces the call to requests with mock_requests
+            The @patch replaces the pooled backend session with a mock
 
         """
 
@@ -31,18 +31,20 @@ class ConformanceReadRequestTest(TestCase):
         request = self.factory.get(call_to)
 
         # Now we can setup the responses we want to the call
-        mock_requests.get.return_value.status_code = 200
-        mock_requests.get.return_value.content = CONFORMANCE
+        mock_session = mock_get_session.return_value
+        mock_session.get.return_value.status_code = 200
+        mock_session.get.return_value.content = CONFORMANCE.encode('utf-8')
+        mock_session.get.return_value.encoding = 'utf-8'
 
-        # Make the call to request_call which uses requests.get
-        # patch will intercept the call to requests.get and
+        # Make the call to request_call which uses session.get
+        # patch will intercept the call to session.get and
         # return the pre-defined values
         result = apps.fhir.bluebutton.utils.request_call(request,
                                                          call_to,
                                                          cx=None)
 
         # Test for a match
-        self.assertEqual(result._response.content, CONFORMANCE)
+        self.assertEqual(result.text, CONFORMANCE)
 
     @patch('apps.fhir.bluebutton.views.home.get_resource_names')
     def test_fhir_conformance_filter(self, mock_get_resource_names):
@@ -0,0 +1,109 @@
+import io
+import json
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.test import override_settings
+from unittest.mock import patch
+
+from apps.fhir.bluebutton import search_cache
+from apps.fhir.server.config import bump_config_version
+from apps.fhir.server.models import ResourceRouter
+from hhs_oauth_server import request_logging
+
+from .test_views import BACKEND, FHIR_ID, FhirProxyViewTestCase, backend_response
+
+
+class SearchCacheTest(FhirProxyViewTestCase):
+
+    def setUp(self):
+        super(SearchCacheTest, self).setUp()
+        caches[settings.FHIR_CACHE_ALIAS].clear()
+        search_cache.reset_stats()
+        self.session.get.side_effect = lambda *args, **kwargs: backend_response(
+            {'resourceType': 'Bundle',
+             'link': [{'relation': 'self',
+                       'url': BACKEND + 'ExplanationOfBenefit/?patient=' + FHIR_ID}]})
+
+    def tearDown(self):
+        bump_config_version()
+
+    def search(self, resource_type='ExplanationOfBenefit'):
+        return self.client.get('/v1/fhir/%s/' % resource_type, **self.auth_headers)
+
+    def test_repeat_search_served_from_cache(self):
+        first = self.search()
+        second = self.search()
+
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.content, first.content)
+        self.assertNotContains(second, BACKEND)
+        self.assertEqual(self.session.get.call_count, 1)
+
+        stats = search_cache.cache_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['stores']), (1, 1, 1))
+
+    def test_patient_search_not_cached(self):
+        self.search('Patient')
+        self.search('Patient')
+
+        self.assertEqual(self.session.get.call_count, 2)
+
+    def test_disabled_by_server_search_expiry(self):
+        ResourceRouter.objects.filter(pk=1).update(server_search_expiry=0)
+        bump_config_version()
+
+        self.search()
+        self.search()
+
+        self.assertEqual(self.session.get.call_count, 2)
+
+    def test_purge_beneficiary(self):
+        self.search()
+        with patch('apps.fhir.bluebutton.management.commands.purge_search_cache.is_shared', return_value=True):
+            out = io.StringIO()
+            call_command('purge_search_cache', FHIR_ID, stdout=out)
+        self.search()
+
+        self.assertEqual(out.getvalue(), 'Purged cached searches for %s\n' % FHIR_ID)
+        self.assertEqual(self.session.get.call_count, 2)
+        self.assertEqual(search_cache.cache_stats()['purges'], 1)
+
+    def test_purge_refused_for_process_cache(self):
+        """ The command can not reach the workers' LocMemCache """
+        self.search()
+
+        out = io.StringIO()
+        with self.assertRaises(CommandError):
+            call_command('purge_search_cache', FHIR_ID, stdout=out)
+        self.assertEqual(out.getvalue(), '')
+        self.assertEqual(search_cache.cache_stats()['purges'], 0)
+
+    @override_settings(REQUEST_STATS_INTERVAL=60)
+    def test_stats_logged(self):
+        """ The counters go to the performance logger once the interval is up """
+        self.search()
+        with patch.object(request_logging, '_stats_logged_at', float('-inf')), \
+                patch('hhs_oauth_server.request_logging.logger') as logger:
+            self.search()
+            self.search()
+
+        records = [json.loads(c[0][0]) for c in logger.info.call_args_list]
+        stats = [r['stats'] for r in records if 'stats' in r]
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]['search_cache']['hits'], 1)
+        self.assertEqual(stats[0]['search_cache']['misses'], 1)
+
+    @override_settings(FHIR_STREAM_MEMORY_CEILING=10)
+    def test_streamed_search_not_cached(self):
+        b''.join(self.search().streaming_content)
+        self.search()
+
+        self.assertEqual(self.session.get.call_count, 2)
+
+    def test_key_ignores_parameter_order(self):
+        rr = ResourceRouter.objects.get(pk=1)
+        self.assertEqual(
+            search_cache.make_key(rr, 'Coverage', FHIR_ID, 'http://h', {'a': '1', 'b': '2'}),
+            search_cache.make_key(rr, 'Coverage', FHIR_ID, 'http://h', {'b': '2', 'a': '1'}))
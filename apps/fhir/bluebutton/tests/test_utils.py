@@ -21,6 +21,8 @@ from apps.fhir.bluebutton.utils import (
     dt_patient_reference,
     crosswalk_patient_id,
     get_resourcerouter,
+    build_rewrite_list,
+    stream_rewrite,
 )
 
 ENCODED = settings.ENCODING
@@ -413,6 +415,56 @@ class BlueButtonUtilRequestTest(TestCase):
 
         self.assertEqual(response, expected)
 
+    def test_mask_list_with_host_single_pass(self):
+        """ Rewrite all urls in one scan, longest url first """
+
+        request = self.factory.get('/cmsblue/fhir/v1/Patient')
+
+        input_text = '{"a": "http://example.com/Patient/1", ' \
+                     '"b": "http://example.com:8000/baseDstu3/Coverage/2"}'
+
+        response = mask_list_with_host(request,
+                                       'http://example.com:8000/v1/fhir/',
+                                       input_text,
+                                       ['http://example.com',
+                                        'http://example.com:8000/baseDstu3/'])
+
+        expected = '{"a": "http://example.com:8000/v1/fhir/Patient/1", ' \
+                   '"b": "http://example.com:8000/v1/fhir/Coverage/2"}'
+
+        self.assertEqual(response, expected)
+
+    def test_stream_rewrite(self):
+        """ Urls split across chunk boundaries are still rewritten """
+
+        request = self.factory.get('/cmsblue/fhir/v1/Patient')
+        input_text = 'a http://example.com:8000/x b http://example.com/y ' \
+                     'c http://example.com'
+        expected = mask_list_with_host(request,
+                                       'http://www.replaced.com',
+                                       input_text,
+                                       ['http://example.com',
+                                        'http://example.com:8000'])
+
+        for size in range(1, len(input_text) + 1):
+            data = input_text.encode('utf-8')
+            chunks = [data[i:i + size] for i in range(0, len(data), size)]
+            response = b''.join(stream_rewrite(request,
+                                               'http://www.replaced.com',
+                                               chunks,
+                                               ['http://example.com',
+                                                'http://example.com:8000']))
+            self.assertEqual(response.decode('utf-8'), expected)
+
+    def test_build_rewrite_list(self):
+        """ The default router fhir_url and server_address are included """
+
+        rr = get_resourcerouter()
+        response = build_rewrite_list()
+
+        self.assertIn(rr.fhir_url, response)
+        self.assertIn(rr.server_address, response)
+
     def test_get_host_ur_good(self):
         """
         Get the host url and split on resource_type
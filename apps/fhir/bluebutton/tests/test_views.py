@@ -0,0 +1,342 @@
+import gzip
+import io
+import json
+
+import requests
+import urllib3
+
+from unittest.mock import Mock, patch
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from oauth2_provider.models import AccessToken
+
+from apps.dot_ext import token_cache
+from apps.fhir.server import resilience
+
+from apps.test import BaseApiTest
+from apps.fhir.bluebutton.models import Crosswalk
+from apps.fhir.server.config import get_config
+from apps.fhir.server.models import ResourceRouter
+
+FHIR_ID = '20140000008325'
+BACKEND = 'https://fhir.backend.bluebutton.hhsdevcloud.us/baseDstu3/'
+
+
+def backend_response(data, status_code=200, content_length=True):
+    """ Build a requests.Response as returned by the backend FHIR server """
+    body = json.dumps(data).encode('utf-8')
+    r = requests.Response()
+    r.status_code = status_code
+    r.raw = io.BytesIO(body)
+    r.encoding = 'utf-8'
+    r.headers['Content-Type'] = 'application/json+fhir'
+    if content_length:
+        r.headers['Content-Length'] = str(len(body))
+    return r
+
+
+class FhirProxyViewTestCase(BaseApiTest):
+    """ Shared setup for calls through the read and search views """
+
+    fixtures = ['fhir_server_new_testdata.json']
+
+    def setUp(self):
+        token_cache.clear()
+        resilience.reset()
+        self.addCleanup(resilience.reset)
+        self.user = self._create_user('beneficiary', 'secret')
+        cx = Crosswalk(user=self.user,
+                       fhir_source=ResourceRouter.objects.get(pk=1),
+                       fhir_id=FHIR_ID)
+        cx.save()
+        access_token = self._get_access_token('beneficiary', 'secret')
+        self.auth_headers = {'HTTP_AUTHORIZATION': 'Bearer %s' % access_token}
+
+        session_patcher = patch('apps.fhir.bluebutton.utils.get_session')
+        self.session = session_patcher.start().return_value
+        self.addCleanup(session_patcher.stop)
+
+
+class ReadSearchPassthroughTest(FhirProxyViewTestCase):
+
+    def test_read_patient_passthrough(self):
+        """ The rewritten backend text is returned without re-encoding """
+        self.session.get.return_value = backend_response(
+            {'resourceType': 'Patient',
+             'id': FHIR_ID,
+             'link': BACKEND + 'Patient/' + FHIR_ID})
+
+        response = self.client.get('/v1/fhir/Patient/%s' % FHIR_ID,
+                                   **self.auth_headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertNotContains(response, BACKEND)
+        self.assertEqual(response.json()['link'],
+                         'http://testserver/v1/fhir/Patient/' + FHIR_ID)
+
+    def test_read_eob_other_patient(self):
+        """ An EOB owned by another beneficiary is reported as missing """
+        self.session.get.return_value = backend_response(
+            {'resourceType': 'ExplanationOfBenefit',
+             'id': 'carrier-1',
+             'patient': {'reference': 'Patient|20140000000001'}})
+
+        response = self.client.get('/v1/fhir/ExplanationOfBenefit/carrier-1',
+                                   **self.auth_headers)
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_read_eob_own_patient(self):
+        """ Line items ahead of the patient reference are skipped """
+        self.session.get.return_value = backend_response(
+            {'resourceType': 'ExplanationOfBenefit',
+             'id': 'carrier-1',
+             'item': [{'sequence': i, 'patient': {'reference': 'Patient|other'}}
+                      for i in range(100)],
+             'patient': {'reference': 'Patient|' + FHIR_ID}})
+
+        response = self.client.get('/v1/fhir/ExplanationOfBenefit/carrier-1',
+                                   **self.auth_headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['item']), 100)
+
+    def test_search_eob_passthrough(self):
+        self.session.get.return_value = backend_response(
+            {'resourceType': 'Bundle',
+             'link': [{'relation': 'self',
+                       'url': BACKEND + 'ExplanationOfBenefit/?patient=' + FHIR_ID}]})
+
+        response = self.client.get('/v1/fhir/ExplanationOfBenefit/',
+                                   **self.auth_headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, BACKEND)
+        self.assertEqual(self.session.get.call_args[1]['params']['patient'], FHIR_ID)
+
+    @override_settings(FHIR_RESPONSE_PASSTHROUGH=False)
+    def test_search_eob_reparsed(self):
+        self.session.get.return_value = backend_response(
+            {'resourceType': 'Bundle', 'total': 0})
+
+        response = self.client.get('/v1/fhir/ExplanationOfBenefit/',
+                                   **self.auth_headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'resourceType': 'Bundle', 'total': 0})
+
+
+class SearchStreamingTest(FhirProxyViewTestCase):
+
+    def test_search_buffers_small_unknown_length(self):
+        """ A small chunked body is read whole, not streamed """
+        self.session.get.return_value = backend_response(
+            {'resourceType': 'Bundle', 'total': 0},
+            content_length=False)
+
+        response = self.client.get('/v1/fhir/ExplanationOfBenefit/',
+                                   **self.auth_headers)
+
+        self.assertFalse(response.streaming)
+        self.assertEqual(response.json()['total'], 0)
+
+    @override_settings(FHIR_STREAM_CHUNK_SIZE=7, FHIR_STREAM_MEMORY_CEILING=100)
+    def test_search_streams_large_unknown_length(self):
+        """ A chunked body over the ceiling is streamed with urls rewritten """
+        entries = [{'fullUrl': BACKEND + 'ExplanationOfBenefit/carrier-%s' % i}
+                   for i in range(20)]
+        self.session.get.return_value = backend_response(
+            {'resourceType': 'Bundle', 'entry': entries},
+            content_length=False)
+
+        response = self.client.get('/v1/fhir/ExplanationOfBenefit/',
+                                   **self.auth_headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertNotIn(BACKEND, content)
+        self.assertEqual(json.loads(content)['entry'][19]['fullUrl'],
+                         'http://testserver/v1/fhir/ExplanationOfBenefit/carrier-19')
+        self.assertTrue(self.session.get.call_args[1]['stream'])
+
+    @override_settings(FHIR_STREAM_MEMORY_CEILING=10)
+    def test_search_streams_over_ceiling(self):
+        self.session.get.return_value = backend_response(
+            {'resourceType': 'Bundle', 'total': 0})
+
+        response = self.client.get('/v1/fhir/ExplanationOfBenefit/',
+                                   **self.auth_headers)
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(json.loads(b''.join(response.streaming_content).decode('utf-8')),
+                         {'resourceType': 'Bundle', 'total': 0})
+
+    @override_settings(FHIR_STREAM_MEMORY_CEILING=1000)
+    def test_ceiling_applies_to_decoded_size(self):
+        """ The Content-Length of a gzipped body is not its size """
+        body = json.dumps({'resourceType': 'Bundle', 'total': 0, 'padding': ' ' * 5000}).encode('utf-8')
+        r = requests.Response()
+        r.status_code = 200
+        r.raw = urllib3.HTTPResponse(io.BytesIO(gzip.compress(body)),
+                                     headers={'Content-Encoding': 'gzip'},
+                                     preload_content=False)
+        r.encoding = 'utf-8'
+        r.headers['Content-Encoding'] = 'gzip'
+        r.headers['Content-Length'] = str(len(gzip.compress(body)))
+        self.session.get.return_value = r
+
+        response = self.client.get('/v1/fhir/ExplanationOfBenefit/',
+                                   **self.auth_headers)
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(b''.join(response.streaming_content), body)
+
+
+class IdentityContextTest(FhirProxyViewTestCase):
+
+    def test_read_query_count(self):
+        """ Token, application, developer, user and crosswalk load once """
+        self.session.get.return_value = backend_response(
+            {'resourceType': 'Patient', 'id': FHIR_ID})
+
+        # load the router configuration snapshot up front
+        get_config()
+
+        # token with application/developer/user, crosswalk with router
+        with self.assertNumQueries(2):
+            self.client.get('/v1/fhir/Patient/%s' % FHIR_ID,
+                            **self.auth_headers)
+
+
+@override_settings(TOKEN_CACHE_LOCAL_TTL=60)
+class TokenCacheViewTest(FhirProxyViewTestCase):
+
+    def test_cached_token_skips_token_table(self):
+        self.session.get.return_value = backend_response(
+            {'resourceType': 'Patient', 'id': FHIR_ID})
+        self.client.get('/v1/fhir/Patient/%s' % FHIR_ID, **self.auth_headers)
+
+        self.session.get.return_value = backend_response(
+            {'resourceType': 'Patient', 'id': FHIR_ID})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/v1/fhir/Patient/%s' % FHIR_ID,
+                                       **self.auth_headers)
+
+        self.assertEqual(response.status_code, 200)
+        for query in queries.captured_queries:
+            self.assertNotIn('oauth2_provider_accesstoken', query['sql'])
+
+    def test_revoked_token_rejected(self):
+        self.session.get.return_value = backend_response(
+            {'resourceType': 'Patient', 'id': FHIR_ID})
+        self.client.get('/v1/fhir/Patient/%s' % FHIR_ID, **self.auth_headers)
+
+        AccessToken.objects.get(user=self.user).revoke()
+        response = self.client.get('/v1/fhir/Patient/%s' % FHIR_ID,
+                                   **self.auth_headers)
+
+        self.assertEqual(response.status_code, 401)
+
+
+@override_settings(FHIR_BREAKER_FAILURES=2, FHIR_BREAKER_RESET=30)
+class BackendResilienceTest(FhirProxyViewTestCase):
+
+    def test_open_circuit_fails_fast(self):
+        self.session.get.side_effect = requests.ConnectionError('refused')
+        for i in range(2):
+            response = self.client.get('/v1/fhir/Patient/%s' % FHIR_ID,
+                                       **self.auth_headers)
+            self.assertEqual(response.status_code, 502)
+
+        response = self.client.get('/v1/fhir/ExplanationOfBenefit/',
+                                   **self.auth_headers)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '30')
+        self.assertEqual(self.session.get.call_count, 2)
+
+    def test_failed_body_read_is_a_failure(self):
+        """ Headers that arrive with no body open the circuit, and add no latency sample """
+        def backend(url, **kwargs):
+            r = backend_response({'resourceType': 'Patient', 'id': FHIR_ID})
+            r.raw = Mock(spec=['read'], read=Mock(side_effect=requests.ConnectionError('reset')))
+            return r
+
+        self.session.get.side_effect = backend
+        for i in range(2):
+            response = self.client.get('/v1/fhir/Patient/%s' % FHIR_ID,
+                                       **self.auth_headers)
+            self.assertEqual(response.status_code, 502)
+
+        stats = resilience.resilience_stats()
+        self.assertEqual(stats['breakers'][1]['state'], 'open')
+        self.assertEqual(stats['latency']['1:Patient']['samples'], 0)
+
+    def test_read_has_timeout(self):
+        """ read used to wait on the backend forever """
+        self.session.get.return_value = backend_response(
+            {'resourceType': 'Patient', 'id': FHIR_ID})
+
+        self.client.get('/v1/fhir/Patient/%s' % FHIR_ID, **self.auth_headers)
+
+        connect, read = self.session.get.call_args[1]['timeout']
+        self.assertEqual(read, ResourceRouter.objects.get(pk=1).wait_time)
+
+    @override_settings(FHIR_MAX_CONCURRENT_CALLS=1, FHIR_MAX_QUEUED_CALLS=0)
+    def test_load_shed_when_slots_taken(self):
+        rr = ResourceRouter.objects.get(pk=1)
+        with resilience.call_slot(rr, 'Patient'):
+            response = self.client.get('/v1/fhir/Patient/%s' % FHIR_ID,
+                                       **self.auth_headers)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['error']['code'], 503)
+        self.assertFalse(self.session.get.called)
+        self.assertEqual(resilience.resilience_stats()['limiters']['1:Patient'],
+                         {'in_flight': 0, 'queued': 0, 'rejected': 1})
+
+
+@override_settings(FHIR_RETRY_ATTEMPTS=3, FHIR_RETRY_BACKOFF_MS=0)
+class BackendRetryTest(FhirProxyViewTestCase):
+
+    def test_transient_error_retried(self):
+        self.session.get.side_effect = [
+            requests.ConnectionError('reset'),
+            backend_response({}, status_code=503),
+            backend_response({'resourceType': 'Patient', 'id': FHIR_ID})]
+
+        response = self.client.get('/v1/fhir/Patient/%s' % FHIR_ID,
+                                   **self.auth_headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.session.get.call_count, 3)
+
+    def test_attempts_bounded(self):
+        self.session.get.side_effect = requests.ConnectionError('reset')
+
+        response = self.client.get('/v1/fhir/Patient/%s' % FHIR_ID,
+                                   **self.auth_headers)
+
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(self.session.get.call_count, 3)
+
+    @override_settings(FHIR_RETRY_BUDGET_CAP=1)
+    def test_retry_budget(self):
+        self.session.get.side_effect = requests.ConnectionError('reset')
+
+        self.client.get('/v1/fhir/Patient/%s' % FHIR_ID, **self.auth_headers)
+
+        # one retry in the budget
+        self.assertEqual(self.session.get.call_count, 2)
+
+    def test_client_error_not_retried(self):
+        self.session.get.return_value = backend_response({}, status_code=404)
+
+        response = self.client.get('/v1/fhir/Patient/%s' % FHIR_ID,
+                                   **self.auth_headers)
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.session.get.call_count, 1)
@@ -1,12 +1,35 @@
 from django.conf.urls import url
 from django.contrib import admin
 
+from apps.fhir.bluebutton.views.batch import batch
+from apps.fhir.bluebutton.views.everything import everything
+from apps.fhir.bluebutton.views.export import export, export_file, export_status
 from apps.fhir.bluebutton.views.read import read
 from apps.fhir.bluebutton.views.search import search
 
 admin.autodiscover()
 
 urlpatterns = [
+    url(r'^$',
+        batch,
+        name='bb_oauth_fhir_batch'),
+
+    url(r'^Patient/(?P<resource_id>[^/]+)/\$everything$',
+        everything,
+        name='bb_oauth_fhir_everything'),
+
+    url(r'^Patient/\$export$',
+        export,
+        name='bb_oauth_fhir_export'),
+
+    url(r'^\$export-poll-status/(?P<job_id>[0-9a-f-]+)$',
+        export_status,
+        name='bb_oauth_fhir_export_status'),
+
+    url(r'^\$export-file/(?P<job_id>[0-9a-f-]+)/(?P<resource_type>[A-Za-z]+)\.ndjson$',
+        export_file,
+        name='bb_oauth_fhir_export_file'),
+
     url(r'(?P<resource_type>[^/]+)/(?P<resource_id>[^/]+)',
         read,
         name='bb_oauth_fhir_read_or_update_or_delete'),
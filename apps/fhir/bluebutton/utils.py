@@ -1,8 +1,11 @@
 import os
+import re
 import json
+import codecs
 import logging
 import pytz
 import requests
+import time
 import uuid
 
 from collections import OrderedDict
@@ -11,12 +14,26 @@ from pytz import timezone
 
 from django.conf import settings
 from django.contrib import messages
-from apps.fhir.server.models import (SupportedResourceType,
-                                     ResourceRouter)
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.lru_cache import lru_cache
+from apps.fhir.server.config import get_config
+from apps.fhir.server.resilience import (RETRY_STATUSES,
+                                         BackendUnavailable,
+                                         CallRejectedError,
+                                         backoff_delay,
+                                         call_slot,
+                                         get_breaker,
+                                         get_latency,
+                                         get_retry_budget,
+                                         get_timeouts)
+from apps.fhir.server.sessions import get_session
+from apps.fhir.server.singleflight import coalesce
 
 from oauth2_provider.models import AccessToken
 
 from apps.wellknown.views import (base_issuer, build_endpoint_info)
+from hhs_oauth_server.request_logging import timed
+from .identity import RequestIdentity
 from .models import Crosswalk, Fhir_Response
 
 logger = logging.getLogger('hhs_server.%s' % __name__)
@@ -81,7 +98,7 @@ def get_fhir_now(my_now=None):
 
 
 def get_timestamp(request):
-    """ hhs_oauth_server.request_logging.RequestTimeLoggingMiddleware
+    """ hhs_oauth_server.request_logging.RequestTimingMiddleware
         adds request._logging_start_dt
 
         we grab it or set a timestamp and return it.
@@ -96,7 +113,7 @@ def get_timestamp(request):
 
 
 def get_query_id(request):
-    """ hhs_oauth_server.request_logging.RequestTimeLoggingMiddleware
+    """ hhs_oauth_server.request_logging.RequestTimingMiddleware
         adds request._logging_uuid
 
         we grab it or set a uuid and return it.
@@ -110,7 +127,7 @@ def get_query_id(request):
 
 
 def get_query_counter(request):
-    """ hhs_oauth_server.request_logging.RequestTimeLoggingMiddleware
+    """ hhs_oauth_server.request_logging.RequestTimingMiddleware
         adds request._logging_pass
 
         we grab it or set a counter and return it.
@@ -123,6 +140,29 @@ def get_query_counter(request):
         return request._logging_pass
 
 
+def get_identity(request):
+    """ Return the RequestIdentity for request, building it if needed
+
+        require_valid_token attaches one to every authenticated FHIR call.
+        Other callers (eg. the metadata view) get one built from the
+        logged in user and any bearer token on the request.
+    """
+    identity = getattr(request, 'identity', None)
+    if identity is not None:
+        return identity
+
+    access_token = None
+    token = get_access_token_from_request(request)
+    if token:
+        access_token = AccessToken.objects.select_related(
+            'application', 'application__user').filter(token=token).first()
+
+    identity = RequestIdentity(user=get_user_from_request(request),
+                               access_token=access_token)
+    request.identity = identity
+    return identity
+
+
 def generate_info_headers(request):
     """Returns a dict of headers to be sent to the backend"""
     result = {}
@@ -136,9 +176,10 @@ def generate_info_headers(request):
     result['BlueButton-OriginalQueryCounter'] = str(get_query_counter(request))
 
     # Return resource_owner or user
-    user = get_user_from_request(request)
+    identity = get_identity(request)
+    user = identity.user
     originating_ip = get_ip_from_request(request)
-    cx = get_crosswalk(user)
+    cx = identity.crosswalk
     if cx:
         # we need to send the HicnHash or the fhir_id
         if len(cx.fhir_id) > 0:
@@ -154,12 +195,11 @@ def generate_info_headers(request):
         result['BlueButton-User'] = str(user)
         result['BlueButton-Application'] = ""
         result['BlueButton-ApplicationId'] = ""
-        if AccessToken.objects.filter(token=get_access_token_from_request(request)).exists():
-            at = AccessToken.objects.get(token=get_access_token_from_request(request))
-            result['BlueButton-Application'] = str(at.application.name)
-            result['BlueButton-ApplicationId'] = str(at.application.id)
-            result['BlueButton-DeveloperId'] = str(at.application.user.id)
-            result['BlueButton-Developer'] = str(at.application.user)
+        if identity.application:
+            result['BlueButton-Application'] = str(identity.application.name)
+            result['BlueButton-ApplicationId'] = str(identity.application.id)
+            result['BlueButton-DeveloperId'] = str(identity.developer.id)
+            result['BlueButton-Developer'] = str(identity.developer)
         else:
             result['BlueButton-Application'] = ""
             result['BlueButton-ApplicationId'] = ""
@@ -186,6 +226,29 @@ def request_call(request, call_url, cx=None, timeout=None, get_parameters={}):
 
     """
 
+    fhir_response = call_backend(call_url, backend_headers(request), cx,
+                                 timeout=timeout, get_parameters=get_parameters)
+    if fhir_response.error == 'http':
+        messages.error(request, 'Problem connecting to FHIR Server.', fail_silently=True)
+    return fhir_response
+
+
+def backend_headers(request):
+    """ generate_info_headers plus the url and query the client asked for """
+    header_info = generate_info_headers(request)
+    header_info['BlueButton-OriginalUrl'] = request.path
+    header_info['BlueButton-OriginalQuery'] = request.META['QUERY_STRING']
+    return header_info
+
+
+def call_backend(call_url, header_info, cx=None, timeout=None, get_parameters={}, stream=False):
+    """
+    request_call without the request: header_info (see backend_headers)
+    is read from it beforehand, so this can run after the request has
+    finished, e.g. in a background thread. stream is as for
+    request_get_with_parms.
+    """
+
     # Updated to receive cx (Crosswalk entry for user)
     # call FhirServer_Auth(cx) to get authentication
     auth_state = FhirServerAuth(cx)
@@ -203,29 +266,23 @@ def request_call(request, call_url, cx=None, timeout=None, get_parameters={}):
     else:
         cert = ()
 
-    header_info = generate_info_headers(request)
     header_detail = header_info
-    header_detail['BlueButton-OriginalUrl'] = request.path
-    header_detail['BlueButton-OriginalQuery'] = request.META['QUERY_STRING']
     header_detail['BlueButton-BackendCall'] = call_url
 
     # TODO: send header info to performance log
     logger_perf.info(header_detail)
 
+    # Pooled keep-alive session: cert and verify are set on the session
+    rr = get_resourcerouter(cx)
+    session = get_session(rr, cert, verify_state)
+
+    start = time.monotonic()
     try:
-        if timeout:
-            r = requests.get(call_url,
-                             cert=cert,
-                             params=get_parameters,
-                             timeout=timeout,
-                             headers=header_info,
-                             verify=verify_state)
-        else:
-            r = requests.get(call_url,
-                             cert=cert,
-                             params=get_parameters,
-                             headers=header_info,
-                             verify=verify_state)
+        r = backend_get(session, rr, cx, call_url,
+                        params=get_parameters,
+                        timeout=timeout,
+                        stream=stream,
+                        headers=header_info)
 
         logger.debug("Request.get:%s" % call_url)
         logger.debug("Status of Request:%s" % r.status_code)
@@ -234,24 +291,33 @@ def request_call(request, call_url, cx=None, timeout=None, get_parameters={}):
 
         logger_perf.info(header_detail)
 
-        fhir_response = build_fhir_response(request, call_url, cx, r=r, e=None)
+        fhir_response = build_fhir_response(None, call_url, cx, r=r, e=None,
+                                            stream=isinstance(r, PartlyReadBody),
+                                            elapsed=time.monotonic() - start)
 
-        logger.debug("Leaving request_call with "
+        logger.debug("Leaving call_backend with "
                      "fhir_Response: %s" % fhir_response)
 
         return fhir_response
 
+    except BackendUnavailable as e:
+        logger.debug(str(e))
+        return build_fhir_response(None, call_url, cx, r=None, e=e,
+                                   elapsed=time.monotonic() - start)
+
     except requests.exceptions.Timeout as e:
 
         logger.debug("Gateway timeout talking to back-end server")
-        fhir_response = build_fhir_response(request, call_url, cx, r=None, e=e)
+        fhir_response = build_fhir_response(None, call_url, cx, r=None, e=e,
+                                            elapsed=time.monotonic() - start)
 
         return fhir_response
 
     except requests.ConnectionError as e:
-        logger.debug("Request.GET:%s" % request.GET)
+        logger.debug("Request.GET:%s" % get_parameters)
 
-        fhir_response = build_fhir_response(request, call_url, cx, r=None, e=e)
+        fhir_response = build_fhir_response(None, call_url, cx, r=None, e=e,
+                                            elapsed=time.monotonic() - start)
 
         return fhir_response
 
@@ -262,9 +328,8 @@ def request_call(request, call_url, cx=None, timeout=None, get_parameters={}):
         handle_e = handle_http_error(e)
         handle_e = handle_e
 
-        fhir_response = build_fhir_response(request, call_url, cx, r=None, e=e)
-
-        messages.error(request, 'Problem connecting to FHIR Server.')
+        fhir_response = build_fhir_response(None, call_url, cx, r=None, e=e,
+                                            elapsed=time.monotonic() - start)
 
         e = requests.Response
         logger.debug("HTTPError Status_code:%s" %
@@ -278,11 +343,14 @@ def request_get_with_parms(request,
                            call_url,
                            search_params={},
                            cx=None,
-                           timeout=None):
+                           timeout=None,
+                           stream=False):
     """  call to request or redirect on fail
     call_url = target server URL and search parameters to be sent
     cx = Crosswalk record. The crosswalk is keyed off Request.user
     timoeout allows a timeout in seconds to be set.
+    stream = leave a body larger than settings.FHIR_STREAM_MEMORY_CEILING
+       unread on the backend connection (see build_streaming_response).
     FhirServer is joined to Crosswalk.
     FhirServerAuth and FhirServerVerify receive cx and lookup
        values in the linked fhir_server model.
@@ -321,40 +389,47 @@ def request_get_with_parms(request,
     for k, v in search_params.items():
         logger.debug("\nkey:%s - value:%s" % (k, v))
 
+    # Pooled keep-alive session: cert and verify are set on the session
+    rr = get_resourcerouter(cx)
+    session = get_session(rr, cert, verify_state)
+
+    start = time.monotonic()
     try:
-        if timeout:
-            r = requests.get(call_url,
-                             params=search_params,
-                             cert=cert,
-                             timeout=timeout,
-                             verify=verify_state)
-        else:
-            r = requests.get(call_url,
-                             params=search_params,
-                             cert=cert,
-                             verify=verify_state)
+        r = backend_get(session, rr, cx, call_url,
+                        params=search_params,
+                        timeout=timeout,
+                        stream=stream)
 
         logger.debug("Request.get:%s" % call_url)
         logger.debug("Status of Request:%s" % r.status_code)
 
-        fhir_response = build_fhir_response(request, call_url, cx, r=r, e=None)
+        stream = isinstance(r, PartlyReadBody)
+        fhir_response = build_fhir_response(request, call_url, cx, r=r, e=None, stream=stream,
+                                            elapsed=time.monotonic() - start)
 
         logger.debug("Leaving request_call_with_parms with "
                      "fhir_Response: %s" % fhir_response)
 
         return fhir_response
 
+    except BackendUnavailable as e:
+        logger.debug(str(e))
+        return build_fhir_response(request, call_url, cx, r=None, e=e,
+                                   elapsed=time.monotonic() - start)
+
     except requests.exceptions.Timeout as e:
 
         logger.debug("Gateway timeout talking to back-end server")
-        fhir_response = build_fhir_response(request, call_url, cx, r=None, e=e)
+        fhir_response = build_fhir_response(request, call_url, cx, r=None, e=e,
+                                            elapsed=time.monotonic() - start)
 
         return fhir_response
 
     except requests.ConnectionError as e:
         logger.debug("Request.GET:%s" % request.GET)
 
-        fhir_response = build_fhir_response(request, call_url, cx, r=None, e=e)
+        fhir_response = build_fhir_response(request, call_url, cx, r=None, e=e,
+                                            elapsed=time.monotonic() - start)
 
         return fhir_response
 
@@ -365,9 +440,10 @@ def request_get_with_parms(request,
         handle_e = handle_http_error(e)
         handle_e = handle_e
 
-        fhir_response = build_fhir_response(request, call_url, cx, r=None, e=e)
+        fhir_response = build_fhir_response(request, call_url, cx, r=None, e=e,
+                                            elapsed=time.monotonic() - start)
 
-        messages.error(request, 'Problem connecting to FHIR Server.')
+        messages.error(request, 'Problem connecting to FHIR Server.', fail_silently=True)
 
         e = requests.Response
         logger.debug("HTTPError Status_code:%s" %
@@ -376,6 +452,131 @@ def request_get_with_parms(request,
     return fhir_response
 
 
+def backend_get(session, rr, cx, call_url, params={}, timeout=None, stream=False, headers=None):
+    """
+    session.get(call_url) shared between identical concurrent requests
+
+    Calls for the same router, url, parameters and beneficiary that
+    overlap in time make one upstream call (see
+    apps.fhir.server.singleflight). The body is read before it is
+    shared, except a body kept for streaming, which only its own caller
+    can consume.
+
+    Calls go through the router's circuit breaker and get connect/read
+    timeouts from recent latency, capped at timeout or rr.wait_time, and
+    wait for one of a limited number of call slots (see
+    apps.fhir.server.resilience). Raises BackendUnavailable while the
+    breaker is open or when no slot frees up in time.
+
+    Connection errors, timeouts and 502/503/504 responses are retried up
+    to settings.FHIR_RETRY_ATTEMPTS attempts in all, with backoff, while
+    the router's retry budget allows. Only use this for idempotent GETs.
+    """
+
+    resource_type = get_backend_resource_type(rr, call_url)
+    timeouts = get_timeouts(rr, resource_type, timeout)
+    # the body is always read below, so its download is timed apart
+    # from the wait for the response headers
+    kwargs = {'params': params,
+              'stream': True,
+              'headers': headers,
+              'timeout': timeouts}
+
+    def call():
+        budget = get_retry_budget(rr)
+        budget.deposit()
+
+        attempt = 1
+        while True:
+            start = time.monotonic()
+            try:
+                result = attempt_call()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                outcome = e.__class__.__name__
+                retry = attempt < settings.FHIR_RETRY_ATTEMPTS and budget.withdraw()
+                log_attempt(attempt, outcome, start, retry)
+                if not retry:
+                    raise
+            else:
+                r = result[0]
+                outcome = r.status_code
+                retry = (r.status_code in RETRY_STATUSES and
+                         attempt < settings.FHIR_RETRY_ATTEMPTS and
+                         budget.withdraw())
+                log_attempt(attempt, outcome, start, retry)
+                if not retry:
+                    return result
+                r.close()
+
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+
+    def log_attempt(attempt, outcome, start, retry):
+        logger_perf.info({'BlueButton-BackendCall': call_url,
+                          'BlueButton-BackendAttempt': attempt,
+                          'BlueButton-BackendResponse': outcome,
+                          'BlueButton-BackendElapsedMs': int((time.monotonic() - start) * 1000),
+                          'BlueButton-BackendRetry': retry})
+
+    def attempt_call():
+        breaker = get_breaker(rr)
+        breaker.check()
+
+        try:
+            with call_slot(rr, resource_type):
+                return slotted_call(breaker)
+        except CallRejectedError:
+            breaker.cancel_probe()
+            raise
+
+    def slotted_call(breaker):
+        start = time.monotonic()
+        try:
+            with timed('backend_ttfb'):
+                r = session.get(call_url, **kwargs)
+
+            # read the body now so every waiting caller gets the same bytes,
+            # unless it is for streaming and turns out too large to hold
+            with timed('backend_download'):
+                unread = read_within_ceiling(r) if stream else None
+                if unread is None:
+                    r.content
+        except Exception:
+            breaker.record_failure()
+            raise
+
+        # only a call whose body arrived counts as a success
+        if r.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+            get_latency(rr, resource_type).add(time.monotonic() - start)
+
+        if unread is not None:
+            return unread, False
+        return r, True
+
+    with timed('backend'):
+        if not settings.FHIR_COALESCE_REQUESTS:
+            return call()[0]
+
+        key = (rr.pk,
+               call_url,
+               tuple(sorted((k, str(v)) for k, v in params.items())),
+               getattr(cx, 'fhir_id', None),
+               stream)
+
+        return coalesce(key, call, timeout or rr.wait_time or settings.FHIR_COALESCE_WAIT)
+
+
+def get_backend_resource_type(rr, call_url):
+    """ First path segment of call_url below rr.fhir_url (or 'metadata') """
+    path = call_url.split('?')[0]
+    if path.startswith(rr.fhir_url):
+        return path[len(rr.fhir_url):].split('/')[0]
+    return path.rstrip('/').rsplit('/', 1)[-1]
+
+
 def notNone(value=None, default=None):
     """
     Test value. Return Default if None
@@ -507,19 +708,13 @@ def check_rt_controls(resource_type, rr=None):
     # Check for controls to apply to this resource_type
     # logger.debug('Resource_Type =%s' % resource_type)
     # We may get more than one resourceType returned.
-    # We need to deal with that.
+    # The configuration snapshot keeps the first one.
     # Best option is to pass fhir_server from Crosswalk to this call
 
     if rr is None:
         rr = get_resourcerouter()
 
-    try:
-        srtc = SupportedResourceType.objects.get(resourceType=resource_type,
-                                                 fhir_source=rr)
-    except SupportedResourceType.DoesNotExist:
-        srtc = None
-
-    return srtc
+    return get_config().resource(rr, resource_type)
 
 
 def masked(srtc=None):
@@ -560,8 +755,31 @@ def mask_with_this_url(request, host_path='', in_text='', find_url=''):
     return out_text
 
 
+@lru_cache(maxsize=64)
+def get_rewrite_pattern(urls_be_gone):
+    """ Compile a tuple of backend urls into one pattern
+
+        Longest urls are tried first so a url that is a prefix of
+        another never wins. Cached, so each router's url set is only
+        compiled once per worker.
+    """
+    find_urls = set()
+    for kill_url in urls_be_gone:
+        if kill_url.endswith('/'):
+            kill_url = kill_url[:-1]
+        if kill_url:
+            find_urls.add(kill_url)
+
+    if not find_urls:
+        return None
+
+    return re.compile('|'.join(re.escape(u) for u in sorted(find_urls,
+                                                            key=len,
+                                                            reverse=True)))
+
+
 def mask_list_with_host(request, host_path, in_text, urls_be_gone=[]):
-    """ Replace a series of URLs with the host_name """
+    """ Replace a series of URLs with the host_name in a single pass """
 
     if in_text == '':
         return in_text
@@ -570,22 +788,18 @@ def mask_list_with_host(request, host_path, in_text, urls_be_gone=[]):
         # Nothing in the list to be replaced
         return in_text
 
-    rr_def = get_resourcerouter()
-    rr_def_server_address = rr_def.server_address
-
-    if isinstance(rr_def_server_address, str):
-        if rr_def_server_address not in urls_be_gone:
-
-            urls_be_gone.append(rr_def_server_address)
+    if type(in_text) is not str:
+        return in_text
 
-    for kill_url in urls_be_gone:
-        # work through the list making replacements
-        if kill_url.endswith('/'):
-            kill_url = kill_url[:-1]
+    pattern = get_rewrite_pattern(tuple(urls_be_gone))
+    if pattern is None:
+        return in_text
 
-        in_text = mask_with_this_url(request, host_path, in_text, kill_url)
+    if host_path.endswith('/'):
+        host_path = host_path[:-1]
 
-    return in_text
+    # escape backslashes so host_path is used as a literal replacement
+    return pattern.sub(host_path.replace('\\', '\\\\'), in_text)
 
 
 def get_host_url(request, resource_type=''):
@@ -633,18 +847,132 @@ def build_conformance_url():
     return call_to
 
 
+def rewrite_response_text(request, host_path, r_text, rewrite_url_list):
+    """ Replace backend urls in the response text without parsing it """
+    if r_text == "":
+        return r_text
+
+    return mask_list_with_host(request,
+                               host_path,
+                               r_text,
+                               rewrite_url_list)
+
+
 def post_process_request(request, host_path, r_text, rewrite_url_list):
     if r_text == "":
         return r_text
 
-    pre_text = mask_list_with_host(request,
-                                   host_path,
-                                   r_text,
-                                   rewrite_url_list)
+    pre_text = rewrite_response_text(request,
+                                     host_path,
+                                     r_text,
+                                     rewrite_url_list)
 
     return json.loads(pre_text, object_pairs_hook=OrderedDict)
 
 
+def build_proxy_response(request, host_path, r_text, rewrite_url_list, projection=None):
+    """
+    Return the rewritten backend document to the client.
+
+    In passthrough mode (settings.FHIR_RESPONSE_PASSTHROUGH), or when it
+    is projected (see apps.fhir.bluebutton.projection), the rewritten
+    text is sent without being parsed as a whole. Otherwise it is parsed
+    and re-serialized through JsonResponse.
+    """
+    if settings.FHIR_RESPONSE_PASSTHROUGH or projection is not None:
+        with timed('rewrite'):
+            text_out = rewrite_response_text(request,
+                                             host_path,
+                                             r_text,
+                                             rewrite_url_list)
+            if projection is not None and text_out != "":
+                text_out = projection.apply(text_out)
+        with timed('serialize'):
+            return HttpResponse(text_out,
+                                content_type='application/json')
+
+    with timed('rewrite'):
+        text_out = post_process_request(request,
+                                        host_path,
+                                        r_text,
+                                        rewrite_url_list)
+    with timed('serialize'):
+        return JsonResponse(text_out)
+
+
+def stream_rewrite(request, host_path, chunks, urls_be_gone=[], encoding='utf-8'):
+    """
+    Replace a series of URLs with the host_name in a stream of byte chunks.
+
+    Only a chunk plus the length of the longest url is held at a time.
+    A url that could still be completed by the next chunk is kept back
+    until that chunk arrives.
+    """
+
+    pattern = get_rewrite_pattern(tuple(urls_be_gone))
+    if host_path.endswith('/'):
+        host_path = host_path[:-1]
+    replace_with = host_path.replace('\\', '\\\\')
+
+    if pattern is not None:
+        longest = max(len(u) for u in urls_be_gone)
+
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    pending = ''
+
+    for chunk in chunks:
+        pending += decoder.decode(chunk)
+        if pattern is None:
+            out_text, pending = pending, ''
+        else:
+            # a match starting before limit can not grow with more data
+            limit = len(pending) - longest + 1
+            out = []
+            pos = 0
+            for m in pattern.finditer(pending):
+                if m.start() >= limit:
+                    break
+                out.append(pending[pos:m.start()])
+                out.append(host_path)
+                pos = m.end()
+            if limit > pos:
+                out.append(pending[pos:limit])
+                pos = limit
+            out_text = ''.join(out)
+            pending = pending[pos:]
+
+        if out_text:
+            yield out_text.encode('utf-8')
+
+    pending += decoder.decode(b'', final=True)
+    if pattern is not None:
+        pending = pattern.sub(replace_with, pending)
+    if pending:
+        yield pending.encode('utf-8')
+
+
+def build_streaming_response(request, host_path, fhir_response, rewrite_url_list):
+    """
+    Stream a large backend body to the client, rewriting urls chunk by
+    chunk so no full copy of the document is held in memory.
+    """
+    r = fhir_response.stream
+
+    def content():
+        try:
+            chunks = r.iter_content(chunk_size=settings.FHIR_STREAM_CHUNK_SIZE)
+            for chunk in stream_rewrite(request,
+                                        host_path,
+                                        chunks,
+                                        rewrite_url_list,
+                                        r.encoding or 'utf-8'):
+                yield chunk
+        finally:
+            r.close()
+
+    return StreamingHttpResponse(content(), content_type='application/json')
+
+
 def prepend_q(pass_params):
     """ Add ? to parameters if needed """
     if len(pass_params) > 0:
@@ -707,17 +1035,8 @@ def get_resource_names(rr=None):
 
     if rr is None:
         rr = get_resourcerouter()
-    all_resources = SupportedResourceType.objects.filter(fhir_source=rr)
-    resource_types = []
-    for name in all_resources:
-        # check resourceType not already loaded to list
-        if name.resourceType in resource_types:
-            pass
-        else:
-            # Get the resourceType into a list
-            resource_types.append(name.resourceType)
 
-    return resource_types
+    return get_config().resource_names(rr)
 
 
 def get_resourcerouter(cx=None):
@@ -731,7 +1050,7 @@ def get_resourcerouter(cx=None):
 
     if cx is None:
         # use the default setting
-        rr = ResourceRouter.objects.get(pk=settings.FHIR_SERVER_DEFAULT)
+        rr = get_config().router(settings.FHIR_SERVER_DEFAULT)
     else:
         # use the user's default ResourceRouter from cx
         rr = cx.fhir_source
@@ -755,6 +1074,10 @@ def build_rewrite_list(cx=None):
     if rr.fhir_url not in rewrite_list:
         rewrite_list.append(rr.fhir_url)
 
+    if isinstance(rr.server_address, str):
+        if rr.server_address not in rewrite_list:
+            rewrite_list.append(rr.server_address)
+
     if isinstance(settings.FHIR_SERVER_CONF['REWRITE_FROM'], list):
         rewrite_list.extend(settings.FHIR_SERVER_CONF['REWRITE_FROM'])
     elif isinstance(settings.FHIR_SERVER_CONF['REWRITE_FROM'], str):
@@ -774,138 +1097,138 @@ def handle_http_error(e):
     return e
 
 
-def build_fhir_response(request, call_url, cx, r=None, e=None):
+class PartlyReadBody(object):
+    """
+    A backend response whose body went over the memory ceiling while it
+    was read: iter_content gives the chunks read so far, then the rest.
     """
-    setup a response object to return up the chain with consistent content
-    if requests hits an error fields like text or json don't get created.
-    So the purpose of fhir_response is to create a predictable object that
-    can be handled further up the stack.
 
-    :return:
+    def __init__(self, r, head, rest):
+        self.status_code = r.status_code
+        self.headers = r.headers
+        self.encoding = r.encoding
+        self._r = r
+        self._head = head
+        self._rest = rest
+
+    def rewrite_head(self, rewrite):
+        """
+        Replace the text read so far with rewrite(text). Bytes of a
+        character cut off at the end of it are kept as they are.
+        """
+        encoding = self.encoding or 'utf-8'
+        decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        text = decoder.decode(b''.join(self._head))
+        self._head = [rewrite(text).encode(encoding, 'replace') + decoder.getstate()[0]]
+
+    def iter_content(self, chunk_size=None):
+        head, self._head = self._head, []
+        for chunk in head:
+            yield chunk
+        for chunk in self._rest:
+            yield chunk
+
+    def close(self):
+        self._r.close()
+
+
+def read_within_ceiling(r):
     """
+    Read the body of r, requested with stream=True, while it fits in
+    settings.FHIR_STREAM_MEMORY_CEILING bytes.
 
-    if r is None:
-        r_dir = []
-    else:
-        r_dir = dir(r)
+    Returns None once the whole body is read (r.content holds it), or a
+    PartlyReadBody to stream if it is larger. Sizes are counted after
+    any Content-Encoding is undone, so neither a chunked body nor a
+    gzipped Content-Length decides it.
+    """
 
-    if e is None:
-        e_dir = []
-    else:
-        e_dir = dir(e)
+    if r.status_code != 200:
+        # error bodies are small and are handled as text
+        return None
 
-    fhir_response = Fhir_Response(r)
+    head = []
+    size = 0
+    chunks = r.iter_content(chunk_size=settings.FHIR_STREAM_CHUNK_SIZE)
+    for chunk in chunks:
+        head.append(chunk)
+        size += len(chunk)
+        if size > settings.FHIR_STREAM_MEMORY_CEILING:
+            return PartlyReadBody(r, head, chunks)
 
-    fhir_response.call_url = call_url
-    fhir_response.cx = cx
+    r._content = b''.join(head)
+    return None
 
-    if len(r_dir) > 0:
-        if 'status_code' in r_dir:
-            fhir_response._status_code = r.status_code
-        else:
-            fhir_response._status_code = '000'
 
-        if 'text' in r_dir:
-            fhir_response._text = r.text
-        else:
-            fhir_response._text = "No Text returned"
+def build_fhir_response(request, call_url, cx, r=None, e=None, stream=False, elapsed=None):
+    """
+    Wrap what the backend returned, the requests.Response r, or the
+    exception e raised instead, in a Fhir_Response so the views get the
+    same shape either way.
 
-        if 'json' in r_dir:
-            fhir_response._json = r.json
-        else:
-            fhir_response._json = {}
+    stream=True leaves the body of r unread in fhir_response.stream
 
-        if 'user' in request:
-            fhir_response._owner = request.user + ":"
-        else:
-            fhir_response._owner = ":"
+    :return:
+    """
 
-        if 'resource_owner' in request:
-            fhir_response._owner = request.resource_owner
-        else:
-            fhir_response._owner += ""
-
-    elif len(e_dir) > 0:
-        fhir_response.status_code = 504
-        fhir_response._status_code = fhir_response.status_code
-        fhir_response._json = {"errors": ["The gateway has timed out",
-                                          "Failed to reach FHIR Database."],
-                               "code": fhir_response.status_code,
-                               "status_code": fhir_response.status_code,
-                               "text": "The gateway has timed out"}
-        fhir_response._text = fhir_response._json
-        fhir_response._content = fhir_response._json
+    if r is not None:
+        if stream:
+            return Fhir_Response(r.status_code,
+                                 headers=r.headers,
+                                 encoding=r.encoding,
+                                 call_url=call_url,
+                                 elapsed=elapsed,
+                                 stream=r)
+
+        return Fhir_Response(r.status_code,
+                             content=r.content,
+                             headers=r.headers,
+                             encoding=r.encoding,
+                             call_url=call_url,
+                             elapsed=elapsed)
+
+    logger.debug('Backend call to %s failed: %r' % (call_url, e))
+
+    if isinstance(e, BackendUnavailable):
+        status_code = 503
+        error = 'unavailable'
+        errors = ["The upstream server is unavailable"]
     else:
-        fhir_response.status_code = '000'
-        fhir_response._status_code = '000'
-        fhir_response._text = "No Text returned"
-        fhir_response._json = {}
-
-        if 'user' in request:
-            fhir_response._owner = request.user + ":"
-        else:
-            fhir_response._owner = ":"
-        if 'resource_owner' in request:
-            fhir_response._owner += request.resource_owner
+        status_code = 504
+        if isinstance(e, requests.exceptions.Timeout):
+            error = 'timeout'
+        elif isinstance(e, requests.ConnectionError):
+            error = 'connection'
         else:
-            fhir_response._owner += ""
-
-    if e:
-        logger.debug("\ne_response:START\n")
-        e_dir = dir(e)
-        for k in e_dir:
-            if k == "characters_written":
-                pass
-            elif k == 'arg':
-                for i in e.arg:
-                    logger.debug("arg:%s" % i)
-            else:
-                logger.debug("%s:%s" % (k, e.__getattribute__(k)))
+            error = 'http'
+        errors = ["The gateway has timed out",
+                  "Failed to reach FHIR Database."]
 
-        logger.debug("\ne_response:END\n")
+    detail = {"errors": errors,
+              "code": status_code,
+              "status_code": status_code,
+              "text": errors[0]}
 
-    return fhir_response
+    return Fhir_Response(status_code,
+                         content=json.dumps(detail).encode('utf-8'),
+                         headers={'Content-Type': 'application/json'},
+                         call_url=call_url,
+                         elapsed=elapsed,
+                         error=error,
+                         detail=detail,
+                         retry_after=getattr(e, 'retry_after', None))
 
 
 def get_response_text(fhir_response=None):
     """
-    fhir_response: Fhir_Response class returned from request call
-    Receive the fhir_response and get the text element
-    text is in response.text or response._text
-
-    :param fhir_response:
-    :return:
+    fhir_response: Fhir_Response returned from request call
+    Return the decoded body, or "" if there is none
     """
 
-    text_in = ""
-
     if not fhir_response:
         return ""
 
-    try:
-        text_in = fhir_response.text
-        if len(text_in) > 0:
-            return text_in
-    except Exception:
-        pass
-
-    try:
-        text_in = fhir_response._response.text
-        if len(text_in) > 0:
-            return text_in
-    except Exception:
-        pass
-
-    try:
-        text_in = fhir_response._text
-        if len(text_in) > 0:
-            return text_in
-
-    except Exception:
-        logger.debug("Nothing in ._text")
-        logger.debug("giving up...")
-        text_in = ""
-        return text_in
+    return fhir_response.text
 
 
 def get_delegator(request, via_oauth=False):
@@ -929,15 +1252,18 @@ def get_delegator(request, via_oauth=False):
     return delegator
 
 
-def build_oauth_resource(request, format_type="json"):
+def build_oauth_resource(request, format_type="json", issuer=None):
     """
     Create a resource entry for oauth endpoint(s) for insertion
     into the conformance/capabilityStatement
 
+    issuer, if given, is base_issuer(request) read beforehand.
+
     :return: security
     """
-    endpoints = build_endpoint_info(OrderedDict(),
-                                    issuer=base_issuer(request))
+    if issuer is None:
+        issuer = base_issuer(request)
+    endpoints = build_endpoint_info(OrderedDict(), issuer=issuer)
     logger.info("\nEndpoints:%s" % endpoints)
 
     if format_type.lower() == "xml":
@@ -0,0 +1,134 @@
+import json
+import logging
+
+from collections import OrderedDict
+from http.client import responses
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.views.decorators.csrf import csrf_exempt
+
+from ..compression import compress_response
+from ..constants import ALLOWED_RESOURCE_TYPES
+from ..decorators import require_valid_token
+from ..errors import build_error_response, method_not_allowed
+from ..fanout import fan_out
+from .read import read_resource
+
+from apps.fhir.bluebutton.utils import (build_rewrite_list,
+                                        get_identity,
+                                        get_host_url,
+                                        rewrite_response_text)
+
+logger = logging.getLogger('hhs_server.%s' % __name__)
+
+
+@csrf_exempt
+@require_valid_token()
+def batch(request, *args, **kwargs):
+    """
+    POST a FHIR Bundle of type batch holding GET <type>/<id> entries.
+
+    Each entry is read as the read view would, with the same ownership
+    checks, and the entries run concurrently. Returns a batch-response
+    Bundle with one entry per request entry, in the same order.
+    """
+
+    logger.debug("Interaction: batch")
+
+    if request.method != 'POST':
+        return method_not_allowed(['POST'])
+
+    try:
+        bundle = json.loads(request.body.decode('utf-8'))
+    except ValueError:
+        return build_error_response(400, 'The request body must be a JSON Bundle')
+
+    if (not isinstance(bundle, dict) or
+            bundle.get('resourceType') != 'Bundle' or
+            bundle.get('type') != 'batch'):
+        return build_error_response(400, 'The request body must be a Bundle of type batch')
+
+    entries = bundle.get('entry', [])
+    if not isinstance(entries, list):
+        return build_error_response(400, 'Bundle.entry must be a list')
+    if len(entries) > settings.FHIR_BATCH_MAX_ENTRIES:
+        return build_error_response(400, 'A batch may hold at most %s entries'
+                                         % settings.FHIR_BATCH_MAX_ENTRIES)
+
+    identity = get_identity(request)
+    crosswalk = identity.crosswalk
+
+    # If the user isn't matched to a backend ID, they have no permissions
+    if crosswalk is None:
+        logger.info('Crosswalk for %s does not exist' % identity)
+        return build_error_response(403, 'No access information was found for the authenticated user')
+
+    host_path = get_host_url(request)[:-1]
+    rewrite_list = build_rewrite_list(crosswalk)
+
+    # load everything the backend header builder needs before the
+    # worker threads use it
+    identity.developer
+
+    def run_entry(read):
+        if not isinstance(read, tuple):
+            # the entry was turned down by parse_entry
+            return read
+
+        resource_type, resource_id = read
+        response = read_resource(request, crosswalk, resource_type, resource_id)
+        if isinstance(response, HttpResponse):
+            error = json.loads(response.content.decode('utf-8'))['error']
+            return entry_error(error['code'], error['message'])
+
+        text_out = rewrite_response_text(request, host_path, response.text, rewrite_list)
+        return OrderedDict([('resource', json.loads(text_out, object_pairs_hook=OrderedDict)),
+                            ('response', {'status': entry_status(200)})])
+
+    response_bundle = OrderedDict([('resourceType', 'Bundle'),
+                                   ('type', 'batch-response'),
+                                   ('entry', fan_out(run_entry, [parse_entry(e) for e in entries]))])
+
+    return compress_response(request,
+                             HttpResponse(json.dumps(response_bundle),
+                                          content_type='application/json'))
+
+
+def parse_entry(entry):
+    """ (resource type, id) read by a request entry, or its error entry """
+    request = entry.get('request') if isinstance(entry, dict) else None
+    if not isinstance(request, dict) or 'method' not in request or 'url' not in request:
+        return entry_error(400, 'Each entry needs request.method and request.url')
+
+    method = request['method']
+    url = request['url']
+    if not isinstance(method, str) or not isinstance(url, str):
+        return entry_error(400, 'request.method and request.url must be strings')
+
+    if method != 'GET':
+        return entry_error(405, 'Only GET entries are supported')
+
+    parts = url.split('?')[0].strip('/').split('/')
+    if len(parts) != 2 or not all(parts):
+        return entry_error(400, 'Only reads (<type>/<id>) are supported')
+
+    resource_type, resource_id = parts
+    if resource_type not in ALLOWED_RESOURCE_TYPES:
+        return entry_error(404, 'The requested resource type, %s, is not supported'
+                                % resource_type)
+    return resource_type, resource_id
+
+
+def entry_status(code):
+    return '%s %s' % (code, responses.get(code, ''))
+
+
+def entry_error(code, message):
+    """ batch-response entry for a failed request entry """
+    outcome = OrderedDict([('resourceType', 'OperationOutcome'),
+                           ('issue', [{'severity': 'error',
+                                       'code': 'processing',
+                                       'diagnostics': message}])])
+    return OrderedDict([('response', OrderedDict([('status', entry_status(code)),
+                                                  ('outcome', outcome)]))])
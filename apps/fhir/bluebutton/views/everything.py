@@ -0,0 +1,168 @@
+import json
+import logging
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.http import HttpResponse
+
+from .. import search_cache
+from ..compression import compress_response
+from ..decorators import require_valid_token
+from ..errors import backend_unavailable, build_error_response, method_not_allowed
+from ..fanout import fan_out
+from ..jsonscan import find_member
+from ..paging import next_page_parameters, page_parameters, page_url, rewrite_page_links
+from .search import search_parameters
+
+from apps.fhir.bluebutton.utils import (request_call,
+                                        request_get_with_parms,
+                                        build_rewrite_list,
+                                        get_identity,
+                                        get_host_url,
+                                        get_resourcerouter,
+                                        rewrite_response_text)
+
+logger = logging.getLogger('hhs_server.%s' % __name__)
+
+# Searched for the beneficiary alongside their Patient resource
+EVERYTHING_SEARCHES = ['Coverage', 'ExplanationOfBenefit']
+
+
+@require_valid_token()
+def everything(request, resource_id, *args, **kwargs):
+    """
+    Patient/<id>/$everything: the beneficiary's Patient resource and
+    their Coverage and ExplanationOfBenefit searches in one searchset
+    Bundle.
+
+    The token and crosswalk are checked once and the three backend calls
+    run concurrently, so the call takes about as long as the slowest one.
+    Each search follows the backend's next links for up to
+    settings.FHIR_EVERYTHING_MAX_PAGES pages. A search cut short there
+    is counted at the backend's total, and a next link points at the
+    page of it that was not included.
+    """
+
+    logger.debug("Interaction: everything")
+    logger.debug("Request.path: %s" % request.path)
+
+    if request.method != 'GET':
+        return method_not_allowed(['GET'])
+
+    identity = get_identity(request)
+    crosswalk = identity.crosswalk
+
+    # If the user isn't matched to a backend ID, they have no permissions
+    if crosswalk is None:
+        logger.info('Crosswalk for %s does not exist' % identity)
+        return build_error_response(403, 'No access information was found for the authenticated user')
+
+    if resource_id != crosswalk.fhir_id:
+        return build_error_response(403, 'You do not have permission to access data on the requested patient')
+
+    resource_router = get_resourcerouter(crosswalk)
+    host_path = get_host_url(request, 'Patient')[:-1]
+    rewrite_list = build_rewrite_list(crosswalk)
+
+    # load everything the backend header builder needs before the
+    # worker threads use it
+    identity.developer
+
+    def fetch(resource_type):
+        """
+        (rewritten page texts, parameters of the first page left out) for
+        one resource type, or the failed response
+        """
+        if resource_type == 'Patient':
+            target_url = resource_router.fhir_url + 'Patient/' + crosswalk.fhir_id + '/'
+            r = request_call(request, target_url, crosswalk, get_parameters={'_format': 'json'})
+            if r.status_code >= 300:
+                return r
+            return [rewrite_response_text(request, host_path, r.text, rewrite_list)], None
+
+        get_parameters = search_parameters(resource_type, crosswalk.fhir_id)
+        get_parameters.update(page_parameters({}, resource_type))
+
+        pages = []
+        while get_parameters is not None and len(pages) < settings.FHIR_EVERYTHING_MAX_PAGES:
+            text = fetch_page(resource_type, get_parameters)
+            if not isinstance(text, str):
+                return text
+            pages.append(text)
+            get_parameters = next_page_parameters(text, get_parameters)
+        return pages, get_parameters
+
+    def fetch_page(resource_type, get_parameters):
+        """ One page of a search, as the search view would send (and cache) it """
+        cache_key = None
+        if search_cache.is_cacheable(resource_router, resource_type):
+            cache_key = search_cache.make_key(resource_router,
+                                              resource_type,
+                                              crosswalk.fhir_id,
+                                              host_path,
+                                              get_parameters)
+            content = search_cache.get_search(cache_key)
+            if content is not None:
+                return content.decode('utf-8')
+
+        r = request_get_with_parms(request,
+                                   resource_router.fhir_url + resource_type + '/',
+                                   get_parameters,
+                                   crosswalk,
+                                   timeout=resource_router.wait_time)
+        if r.status_code >= 300:
+            return r
+
+        text_out = rewrite_page_links(r.text, host_path, resource_type, get_parameters)
+        text_out = rewrite_response_text(request, host_path, text_out, rewrite_list)
+        if cache_key is not None:
+            search_cache.set_search(cache_key, resource_router, text_out.encode('utf-8'))
+        return text_out
+
+    results = fan_out(fetch, ['Patient'] + EVERYTHING_SEARCHES)
+
+    for result in results:
+        if isinstance(result, tuple):
+            continue
+        if result.retry_after is not None:
+            return backend_unavailable(result.retry_after)
+        if result.status_code == 404:
+            return build_error_response(404, 'The requested resource does not exist')
+        return build_error_response(502, 'An error occurred contacting the upstream server')
+
+    patient = json.loads(results[0][0][0], object_pairs_hook=OrderedDict)
+    entries = [OrderedDict([('fullUrl', host_path + '/Patient/' + crosswalk.fhir_id),
+                            ('resource', patient)])]
+    total = 1
+    links = [{'relation': 'self', 'url': get_host_url(request)}]
+    for resource_type, (pages, next_parameters) in zip(EVERYTHING_SEARCHES, results[1:]):
+        found = []
+        for text in pages:
+            found.extend(json.loads(text, object_pairs_hook=OrderedDict).get('entry', []))
+        entries.extend(found)
+
+        if next_parameters is None:
+            total += len(found)
+            continue
+        # cut short: count what the backend has, and link to the rest
+        try:
+            backend_total = find_member(pages[0], 'total')
+        except (KeyError, ValueError):
+            backend_total = None
+        total += backend_total if isinstance(backend_total, int) else len(found)
+        links.append({'relation': 'next',
+                      'url': page_url(host_path,
+                                      resource_type,
+                                      next_parameters['_count'],
+                                      next_parameters['startIndex'])})
+
+    everything = OrderedDict([('resourceType', 'Bundle'),
+                              ('type', 'searchset'),
+                              ('total', total),
+                              ('link', links),
+                              ('entry', entries)])
+
+    return compress_response(request,
+                             HttpResponse(json.dumps(everything),
+                                          content_type='application/json'))
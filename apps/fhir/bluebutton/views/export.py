@@ -0,0 +1,182 @@
+import gzip
+import logging
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.http import FileResponse, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import patch_vary_headers
+
+from ..compression import accepts_gzip, set_gzip_encoding
+from ..decorators import require_valid_token
+from ..errors import build_error_response, method_not_allowed
+from ..export import EXPORT_TYPES, delete_export_files, export_file_name, get_export_storage
+from ..models import ExportJob
+
+from apps.fhir.bluebutton.utils import (get_identity,
+                                        get_host_url)
+
+logger = logging.getLogger('hhs_server.%s' % __name__)
+
+# _outputFormat values meaning NDJSON, the only format produced
+NDJSON_FORMATS = ('application/fhir+ndjson', 'application/ndjson', 'ndjson')
+
+
+@require_valid_token()
+def export(request, *args, **kwargs):
+    """
+    Patient/$export kick-off: queue a bulk export of the beneficiary's
+    data and return 202 with the status url in Content-Location.
+
+    _type limits the export to some of EXPORT_TYPES.
+    """
+
+    logger.debug("Interaction: export")
+
+    if request.method != 'GET':
+        return method_not_allowed(['GET'])
+
+    identity = get_identity(request)
+    crosswalk = identity.crosswalk
+
+    # If the user isn't matched to a backend ID, they have no permissions
+    if crosswalk is None:
+        logger.info('Crosswalk for %s does not exist' % identity)
+        return build_error_response(403, 'No access information was found for the authenticated user')
+
+    output_format = request.GET.get('_outputFormat', NDJSON_FORMATS[0])
+    if output_format not in NDJSON_FORMATS:
+        return build_error_response(400, 'The _outputFormat %s is not supported' % output_format)
+
+    if '_since' in request.GET:
+        return build_error_response(400, 'The _since parameter is not supported')
+
+    resource_types = EXPORT_TYPES
+    if request.GET.get('_type'):
+        resource_types = request.GET['_type'].split(',')
+        unsupported = [t for t in resource_types if t not in EXPORT_TYPES]
+        if unsupported:
+            return build_error_response(400, 'The requested resource type, %s, is not supported'
+                                             % ','.join(unsupported))
+
+    job = ExportJob.objects.create(user=identity.user,
+                                   application=identity.application,
+                                   resource_types=','.join(resource_types),
+                                   base_url=get_host_url(request, 'Patient'),
+                                   request_url=request.build_absolute_uri())
+    logger.info('Queued export %s for %s' % (job.pk, identity.user))
+
+    response = HttpResponse(status=202)
+    response['Content-Location'] = request.build_absolute_uri(
+        reverse('bb_oauth_fhir_export_status', kwargs={'job_id': job.pk}))
+    return response
+
+
+@require_valid_token()
+def export_status(request, job_id, *args, **kwargs):
+    """
+    GET: 202 with X-Progress while the export runs, then its manifest.
+    DELETE: cancel the export, or delete a finished one and its files.
+    """
+
+    job = get_export_job(request, job_id)
+    if job is None:
+        return build_error_response(404, 'The requested export does not exist')
+
+    if request.method == 'DELETE':
+        return cancel_export(job)
+
+    if request.method != 'GET':
+        return method_not_allowed(['GET', 'DELETE'])
+
+    if job.status in (ExportJob.QUEUED, ExportJob.RUNNING):
+        response = HttpResponse(status=202)
+        response['X-Progress'] = job.progress or job.status
+        response['Retry-After'] = str(settings.FHIR_EXPORT_POLL_INTERVAL)
+        return response
+
+    if job.status == ExportJob.FAILED:
+        return build_error_response(500, 'The export failed: %s' % job.error)
+
+    if job.status == ExportJob.CANCELLED:
+        return build_error_response(404, 'The requested export was cancelled')
+
+    output = []
+    for item in job.get_output():
+        url = reverse('bb_oauth_fhir_export_file',
+                      kwargs={'job_id': job.pk, 'resource_type': item['type']})
+        output.append(OrderedDict([('type', item['type']),
+                                   ('url', request.build_absolute_uri(url)),
+                                   ('count', item['count'])]))
+
+    manifest = OrderedDict([('transactionTime', job.date_started.isoformat()),
+                            ('request', job.request_url),
+                            ('requiresAccessToken', True),
+                            ('output', output),
+                            ('error', [])])
+    return JsonResponse(manifest)
+
+
+@require_valid_token()
+def export_file(request, job_id, resource_type, *args, **kwargs):
+    """
+    One NDJSON file of a complete export, sent gzip encoded as stored to
+    a client that accepts gzip, and decompressed as it goes otherwise.
+    """
+
+    if request.method != 'GET':
+        return method_not_allowed(['GET'])
+
+    job = get_export_job(request, job_id)
+    if (job is None or
+            job.status != ExportJob.COMPLETE or
+            resource_type not in job.get_resource_types()):
+        return build_error_response(404, 'The requested file does not exist')
+
+    storage = get_export_storage()
+    name = export_file_name(job, resource_type)
+    if not storage.exists(name):
+        return build_error_response(404, 'The requested file does not exist')
+
+    stored = storage.open(name, 'rb')
+    if not accepts_gzip(request):
+        response = StreamingHttpResponse(decompressed(stored),
+                                         content_type='application/fhir+ndjson')
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+    response = FileResponse(stored,
+                            content_type='application/fhir+ndjson')
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return set_gzip_encoding(response)
+
+
+def decompressed(stored):
+    """ Chunks of the gzipped file stored, decompressed; closes it when done """
+    with stored, gzip.GzipFile(fileobj=stored) as ndjson:
+        for chunk in iter(lambda: ndjson.read(FileResponse.block_size), b''):
+            yield chunk
+
+
+def get_export_job(request, job_id):
+    """ The job, if it belongs to the token's user """
+    try:
+        return ExportJob.objects.get(pk=job_id, user=get_identity(request).user)
+    except (ExportJob.DoesNotExist, ValidationError):
+        return None
+
+
+def cancel_export(job):
+    cancelled = ExportJob.objects.filter(
+        pk=job.pk, status__in=(ExportJob.QUEUED, ExportJob.RUNNING)).update(status=ExportJob.CANCELLED)
+    if cancelled:
+        # a running job's worker stops at its next page and deletes what
+        # it has written
+        logger.info('Cancelled export %s' % job.pk)
+    else:
+        delete_export_files(job)
+        job.delete()
+        logger.info('Deleted export %s' % job.pk)
+    return HttpResponse(status=202)
@@ -1,10 +1,21 @@
+import hashlib
 import json
 import logging
+import threading
+import time
 
+from threading import Thread
 from urllib.parse import urlencode
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
 from django.http import JsonResponse
 from django.shortcuts import HttpResponse
-from apps.fhir.bluebutton.utils import (request_call,
+from django.utils.cache import get_conditional_response
+from apps.fhir.server.config import get_config
+from apps.wellknown.views import base_issuer
+from apps.fhir.bluebutton.utils import (backend_headers,
+                                        call_backend,
                                         FhirServerUrl,
                                         get_host_url,
                                         prepend_q,
@@ -15,12 +26,17 @@ from apps.fhir.bluebutton.utils import (request_call,
                                         get_response_text,
                                         build_oauth_resource)
 
+from ..errors import backend_unavailable
 from ..opoutcome_utils import (strip_format_for_back_end,
                                valid_interaction)
 
 
 logger = logging.getLogger('hhs_server.%s' % __name__)
 
+# metadata cache keys being rebuilt by a background thread in this worker
+_refreshing = set()
+_refresh_lock = threading.Lock()
+
 __author__ = 'Mark Scrimshire:@ekivemark'
 
 
@@ -30,12 +46,56 @@ def fhir_conformance(request, via_oauth=False, *args, **kwargs):
     BaseDstu2 = "Conformance"
     BaseStu3 = "CapabilityStatement"
 
+    The filtered statement is cached for settings.FHIR_METADATA_CACHE_TTL
+    seconds and refreshed in the background before it expires.
+    It is served with a strong ETag so clients can revalidate with
+    If-None-Match.
+
     :param request:
     :param via_oauth:
     :param args:
     :param kwargs:
     :return:
     """
+    pass_params = request.GET
+    pass_params = strip_format_for_back_end(pass_params)
+
+    encoded_params = urlencode(pass_params)
+    pass_params = prepend_q(encoded_params)
+
+    host_path = get_host_url(request, '?')
+
+    cache = caches[settings.FHIR_CACHE_ALIAS]
+    key = metadata_cache_key(host_path, pass_params)
+    entry = cache.get(key)
+
+    if entry is None:
+        entry = build_metadata_entry(host_path, pass_params, backend_headers(request), base_issuer(request))
+        if isinstance(entry, HttpResponse):
+            # backend error, not cached
+            return entry
+        cache.set(key, entry, settings.FHIR_METADATA_CACHE_TTL)
+
+    elif entry['refresh_at'] <= time.time():
+        start_metadata_refresh(key, host_path, pass_params, backend_headers(request), base_issuer(request))
+
+    return metadata_response(request, entry)
+
+
+def metadata_cache_key(host_path, pass_params):
+    """ Key on the public url, the query and the router configuration """
+    key = '%s|%s|%s' % (host_path, pass_params, get_config().version)
+    return 'fhir_metadata:%s' % hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def build_metadata_entry(host_path, pass_params, header_info, issuer):
+    """ Fetch, rewrite and filter the backend statement into a cache entry
+
+        header_info (backend_headers) and issuer (base_issuer) are read
+        from the request beforehand, so this does not need it.
+
+        Returns an HttpResponse if the backend call failed
+    """
     cx = None
     rr = get_resourcerouter()
     call_to = FhirServerUrl()
@@ -45,29 +105,25 @@ def fhir_conformance(request, via_oauth=False, *args, **kwargs):
     else:
         call_to += '/metadata'
 
-    pass_params = request.GET
-    pass_params = strip_format_for_back_end(pass_params)
-
-    encoded_params = urlencode(pass_params)
-    pass_params = prepend_q(encoded_params)
-
-    r = request_call(request,
-                     call_to + pass_params,
+    r = call_backend(call_to + pass_params,
+                     header_info,
                      cx)
 
     text_out = ''
-    host_path = get_host_url(request, '?')
+
+    if r.retry_after is not None:
+        return backend_unavailable(r.retry_after)
 
     if r.status_code >= 300:
         logger.debug("We have an error code to deal with: %s" % r.status_code)
-        return HttpResponse(json.dumps(r._content),
+        return HttpResponse(json.dumps(r.detail),
                             status=r.status_code,
                             content_type='application/json')
 
     rewrite_url_list = build_rewrite_list(cx)
     text_in = get_response_text(fhir_response=r)
 
-    text_out = post_process_request(request,
+    text_out = post_process_request(None,
                                     host_path,
                                     text_in,
                                     rewrite_url_list)
@@ -75,11 +131,53 @@ def fhir_conformance(request, via_oauth=False, *args, **kwargs):
     od = conformance_filter(text_out, rr)
 
     # Append Security to ConformanceStatement
-    security_endpoint = build_oauth_resource(request, format_type="json")
+    security_endpoint = build_oauth_resource(None, format_type="json", issuer=issuer)
     od['rest'][0]['security'] = security_endpoint
     od['format'] = ['appliction/json']
 
-    return JsonResponse(od)
+    content = JsonResponse(od).content
+    now = time.time()
+    return {'content': content,
+            'etag': '"%s"' % hashlib.sha1(content).hexdigest(),
+            'refresh_at': now + settings.FHIR_METADATA_CACHE_TTL - settings.FHIR_METADATA_REFRESH_AHEAD}
+
+
+def start_metadata_refresh(key, host_path, pass_params, header_info, issuer):
+    """
+    Rebuild a cache entry in a background thread, once per key. Only
+    plain values go to the thread, never the request it outlives.
+    """
+    with _refresh_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def refresh():
+        try:
+            entry = build_metadata_entry(host_path, pass_params, header_info, issuer)
+            if not isinstance(entry, HttpResponse):
+                caches[settings.FHIR_CACHE_ALIAS].set(key, entry, settings.FHIR_METADATA_CACHE_TTL)
+        except Exception:
+            logger.exception('Background refresh of %s failed' % host_path)
+        finally:
+            with _refresh_lock:
+                _refreshing.discard(key)
+            connections.close_all()
+
+    Thread(target=refresh, daemon=True).start()
+
+
+def metadata_response(request, entry):
+    """
+    304 when the client already holds this version, else the statement.
+    If-None-Match is compared as for reads and searches (see
+    apps.fhir.bluebutton.conditional).
+    """
+    response = HttpResponse(entry['content'],
+                            content_type='application/json')
+    response['ETag'] = entry['etag']
+    response['Cache-Control'] = 'public, max-age=%s' % settings.FHIR_METADATA_MAX_AGE
+    return get_conditional_response(request, etag=entry['etag'], response=response)
 
 
 def conformance_filter(text_block, rr):
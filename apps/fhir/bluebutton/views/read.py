@@ -1,14 +1,19 @@
-from django.http import JsonResponse
 import logging
 
+from django.http import HttpResponse
+
+from ..compression import compress_response
+from ..conditional import cached_not_modified, conditional_response, validator_key
 from ..constants import ALLOWED_RESOURCE_TYPES
 from ..decorators import require_valid_token
-from ..errors import build_error_response, method_not_allowed
+from ..errors import backend_unavailable, build_error_response, method_not_allowed
+from ..jsonscan import find_member
+from ..projection import get_projection
 
 from apps.fhir.bluebutton.utils import (request_call,
                                         get_host_url,
-                                        post_process_request,
-                                        get_crosswalk,
+                                        build_proxy_response,
+                                        get_identity,
                                         get_resourcerouter,
                                         build_rewrite_list,
                                         get_response_text)
@@ -36,13 +41,53 @@ def read(request, resource_type, resource_id, *args, **kwargs):
         return build_error_response(404, 'The requested resource type, %s, is not supported'
                                          % resource_type)
 
-    crosswalk = get_crosswalk(request.resource_owner)
+    identity = get_identity(request)
+    crosswalk = identity.crosswalk
 
     # If the user isn't matched to a backend ID, they have no permissions
     if crosswalk is None:
-        logger.info('Crosswalk for %s does not exist' % request.user)
+        logger.info('Crosswalk for %s does not exist' % identity)
         return build_error_response(403, 'No access information was found for the authenticated user')
 
+    # _elements/_summary are applied here rather than by the backend, so
+    # the ownership check in read_resource always sees the whole resource
+    try:
+        projection = get_projection(request.GET)
+    except ValueError as e:
+        return build_error_response(400, str(e))
+    if projection is not None and projection.summary == 'count':
+        return build_error_response(400, '_summary=count only applies to searches')
+
+    validators = validator_key(request, crosswalk)
+    not_modified = cached_not_modified(request, validators)
+    if not_modified is not None:
+        return not_modified
+
+    response = read_resource(request, crosswalk, resource_type, resource_id)
+    if isinstance(response, HttpResponse):
+        return response
+
+    host_path = get_host_url(request, resource_type)[:-1]
+
+    # Add default FHIR Server URL to re-write
+    rewrite_url_list = build_rewrite_list(crosswalk)
+    text_in = get_response_text(fhir_response=response)
+
+    proxy_response = build_proxy_response(request, host_path, text_in, rewrite_url_list, projection)
+
+    proxy_response = conditional_response(request, validators, proxy_response, text_in,
+                                          response.headers.get('ETag'))
+    return compress_response(request, proxy_response)
+
+
+def read_resource(request, crosswalk, resource_type, resource_id):
+    """
+    Fetch resource_type/resource_id for the beneficiary of crosswalk.
+
+    Returns the Fhir_Response, or the error response for the client if
+    the call failed or the resource belongs to someone else.
+    """
+
     resource_router = get_resourcerouter(crosswalk)
 
     if resource_type == 'Patient':
@@ -68,6 +113,9 @@ def read(request, resource_type, resource_id, *args, **kwargs):
 
     response = request_call(request, target_url, crosswalk, timeout=None, get_parameters=get_parameters)
 
+    if response.retry_after is not None:
+        return backend_unavailable(response.retry_after)
+
     if response.status_code == 404:
         return build_error_response(404, 'The requested resource does not exist')
 
@@ -78,14 +126,15 @@ def read(request, resource_type, resource_id, *args, **kwargs):
     # Now check that the user has permission to access the data
     # Patient resources were taken care of above
     # Return 404 on error to avoid notifying unauthorized user the object exists
+    # Only the owning reference is decoded, not the whole document
     try:
         if resource_type == 'Coverage':
-            reference = response._json()['beneficiary']['reference']
+            reference = find_member(response.text, 'beneficiary')['reference']
             reference_id = reference.split('|')[1]
             if reference_id != crosswalk.fhir_id:
                 return standard_404()
         elif resource_type == 'ExplanationOfBenefit':
-            reference = response._json()['patient']['reference']
+            reference = find_member(response.text, 'patient')['reference']
             reference_id = reference.split('|')[1]
             if reference_id != crosswalk.fhir_id:
                 return standard_404()
@@ -93,14 +142,7 @@ def read(request, resource_type, resource_id, *args, **kwargs):
         logger.warning('An error occurred fetching beneficiary id')
         return standard_404()
 
-    host_path = get_host_url(request, resource_type)[:-1]
-
-    # Add default FHIR Server URL to re-write
-    rewrite_url_list = build_rewrite_list(crosswalk)
-    text_in = get_response_text(fhir_response=response)
-    text_out = post_process_request(request, host_path, text_in, rewrite_url_list)
-
-    return JsonResponse(text_out)
+    return response
 
 
 def standard_404():
@@ -1,17 +1,32 @@
-from django.http import HttpResponse, JsonResponse
+from django.conf import settings
+from django.http import HttpResponse
+import gzip
 import json
 import logging
 
+from .. import search_cache
+from ..compression import accepts_gzip, compress_response, precompressed_response
+from ..conditional import (cached_not_modified,
+                           conditional_response,
+                           kept_response,
+                           kept_validators,
+                           validator_key)
 from ..constants import ALLOWED_RESOURCE_TYPES
 from ..decorators import require_valid_token
-from ..errors import build_error_response, method_not_allowed
+from ..errors import backend_unavailable, build_error_response, method_not_allowed
+from ..fanout import get_pool, run_task
+from ..paging import next_page_parameters, page_parameters, rewrite_page_links
+from ..projection import get_projection
 
 from apps.fhir.bluebutton.utils import (request_get_with_parms,
+                                        backend_headers,
                                         build_rewrite_list,
-                                        get_crosswalk,
+                                        call_backend,
+                                        get_identity,
                                         get_host_url,
                                         get_resourcerouter,
-                                        post_process_request,
+                                        build_proxy_response,
+                                        build_streaming_response,
                                         get_response_text)
 
 
@@ -36,54 +51,193 @@ def search(request, resource_type, *args, **kwargs):
         return build_error_response(404, 'The requested resource type, %s, is not supported'
                                          % resource_type)
 
-    crosswalk = get_crosswalk(request.resource_owner)
+    identity = get_identity(request)
+    crosswalk = identity.crosswalk
 
     # If the user isn't matched to a backend ID, they have no permissions
     if crosswalk is None:
-        logger.info('Crosswalk for %s does not exist' % request.user)
+        logger.info('Crosswalk for %s does not exist' % identity)
         return build_error_response(403, 'No access information was found for the authenticated user')
 
     resource_router = get_resourcerouter(crosswalk)
     target_url = resource_router.fhir_url + resource_type + "/"
 
-    get_parameters = {
-        '_format': 'application/json+fhir'
-    }
-
     patient_id = '' if resource_type == 'Patient' else crosswalk.fhir_id
 
     if 'patient' in request.GET and request.GET['patient'] != patient_id:
         return build_error_response(403, 'You do not have permission to access the requested patient\'s data')
 
-    if resource_type == 'ExplanationOfBenefit':
-        get_parameters['patient'] = patient_id
-    elif resource_type == 'Coverage':
-        get_parameters['beneficiary'] = 'Patient/' + patient_id
+    if resource_type == 'Coverage':
         if 'beneficiary' in request.GET and patient_id not in request.GET['beneficiary']:
             return build_error_response(403, 'You do not have permission to access the requested patient\'s data')
-    elif resource_type == 'Patient':
-        get_parameters['_id'] = ''
+
+    try:
+        paging = page_parameters(request.GET, resource_type)
+        projection = get_projection(request.GET)
+    except ValueError as e:
+        return build_error_response(400, str(e))
+
+    get_parameters = search_parameters(resource_type, patient_id)
+    get_parameters.update(paging)
+
+    # _elements/_summary, carried on to the other pages
+    link_parameters = projection.parameters() if projection is not None else None
+    if projection is not None and settings.FHIR_PROJECTION_PASSTHROUGH:
+        # the backend does the projection
+        get_parameters.update(link_parameters)
+        projection = None
+
+    host_path = get_host_url(request, resource_type)[:-1]
+
+    validators = validator_key(request, crosswalk)
+    not_modified = cached_not_modified(request, validators)
+    if not_modified is not None:
+        return not_modified
+
+    cache_key = None
+    if search_cache.is_cacheable(resource_router, resource_type):
+        cache_key = page_cache_key(crosswalk, resource_type, host_path, get_parameters, projection)
+        gzipped = search_cache.get_search(cache_key, decompress=False)
+        if gzipped is not None:
+            return cached_search_response(request, validators, gzipped)
 
     r = request_get_with_parms(request,
                                target_url,
                                get_parameters,
                                crosswalk,
-                               timeout=resource_router.wait_time)
+                               timeout=resource_router.wait_time,
+                               stream=settings.FHIR_RESPONSE_PASSTHROUGH and projection is None)
+
+    if r.retry_after is not None:
+        return backend_unavailable(r.retry_after)
 
     if r.status_code >= 300:
         logger.debug("We have an error code to deal with: %s" % r.status_code)
-        return HttpResponse(json.dumps(r._content),
+        return HttpResponse(json.dumps(r.detail),
                             status=r.status_code,
                             content_type='application/json')
 
     rewrite_list = build_rewrite_list(crosswalk)
-    host_path = get_host_url(request, resource_type)[:-1]
+
+    if r.stream is not None:
+        # Too large to hold in memory: rewrite as it passes through. The
+        # Bundle's links come ahead of its entries, in the part read.
+        r.stream.rewrite_head(lambda text: rewrite_page_links(text,
+                                                              host_path,
+                                                              resource_type,
+                                                              get_parameters,
+                                                              link_parameters))
+        return compress_response(request,
+                                 build_streaming_response(request,
+                                                          host_path,
+                                                          r,
+                                                          rewrite_list))
 
     text_in = get_response_text(fhir_response=r)
+    next_parameters = next_page_parameters(text_in, get_parameters)
+    text_in = rewrite_page_links(text_in, host_path, resource_type, get_parameters, link_parameters)
 
-    text_out = post_process_request(request,
+    response = build_proxy_response(request,
                                     host_path,
                                     text_in,
-                                    rewrite_list)
+                                    rewrite_list,
+                                    projection)
+
+    gzipped = None
+    if cache_key is not None:
+        gzipped = search_cache.set_search(cache_key, resource_router, response.content)
+
+        # a client that asked for a later page is walking the pages
+        if (settings.FHIR_PAGE_PREFETCH and
+                next_parameters is not None and
+                'startIndex' in get_parameters):
+            prefetch_page(request, crosswalk, resource_type, host_path, next_parameters,
+                          rewrite_list, projection, link_parameters)
+
+    response = conditional_response(request, validators, response, text_in)
+    return compress_response(request, response, gzipped)
+
+
+def cached_search_response(request, validators, gzipped):
+    """
+    Response for a search cache hit. When the validators of the page are
+    still kept and the client takes gzip, the entry is sent as stored.
+    """
+    kept = kept_validators(validators)
+    if kept is not None and accepts_gzip(request):
+        response = precompressed_response(HttpResponse(content_type='application/json'), gzipped)
+        return kept_response(request, response, kept)
+
+    content = gzip.decompress(gzipped)
+    response = conditional_response(request,
+                                    validators,
+                                    HttpResponse(content, content_type='application/json'),
+                                    content.decode('utf-8'))
+    return compress_response(request, response, gzipped)
+
+
+def page_cache_key(crosswalk, resource_type, host_path, get_parameters, projection):
+    """ Search cache key of a page, projected at the proxy by projection """
+    if projection is not None:
+        get_parameters = dict(get_parameters, **projection.parameters())
+    return search_cache.make_key(get_resourcerouter(crosswalk),
+                                 resource_type,
+                                 crosswalk.fhir_id,
+                                 host_path,
+                                 get_parameters)
+
+
+def prefetch_page(request, crosswalk, resource_type, host_path, get_parameters,
+                  rewrite_list, projection=None, link_parameters=None):
+    """ Fetch and cache the page after this one while the client reads this one """
+    resource_router = get_resourcerouter(crosswalk)
+    cache_key = page_cache_key(crosswalk, resource_type, host_path, get_parameters, projection)
+    if cache_key in search_cache.get_cache():
+        return
+
+    # the worker thread gets plain values: the request is finished by
+    # the time it runs
+    header_info = backend_headers(request)
+    stream = settings.FHIR_RESPONSE_PASSTHROUGH and projection is None
+
+    def fetch(target_url):
+        try:
+            r = call_backend(target_url,
+                             header_info,
+                             crosswalk,
+                             timeout=resource_router.wait_time,
+                             get_parameters=get_parameters,
+                             stream=stream)
+            if r.stream is not None:
+                # too large to cache
+                r.stream.close()
+                return
+            if r.status_code >= 300:
+                return
+            text_in = rewrite_page_links(r.text, host_path, resource_type, get_parameters, link_parameters)
+            # the rewriting does not look at the request
+            response = build_proxy_response(None, host_path, text_in, rewrite_list, projection)
+            search_cache.set_search(cache_key, resource_router, response.content)
+        except Exception:
+            logger.exception('Prefetch of %s %s failed' % (resource_type, get_parameters))
+
+    # while the prefetch is in flight the client's own request for the
+    # page shares its backend call (see backend_get)
+    get_pool().submit(run_task, fetch, resource_router.fhir_url + resource_type + '/')
+
+
+def search_parameters(resource_type, patient_id):
+    """ Backend query restricting resource_type to the beneficiary patient_id """
+
+    get_parameters = {
+        '_format': 'application/json+fhir'
+    }
+
+    if resource_type == 'ExplanationOfBenefit':
+        get_parameters['patient'] = patient_id
+    elif resource_type == 'Coverage':
+        get_parameters['beneficiary'] = 'Patient/' + patient_id
+    elif resource_type == 'Patient':
+        get_parameters['_id'] = ''
 
-    return JsonResponse(text_out)
+    return get_parameters
@@ -0,0 +1,134 @@
+import logging
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger('hhs_server.%s' % __name__)
+
+# ResourceRouter and SupportedResourceType rows are read on every FHIR
+# call but only change through the admin. Each worker loads them once
+# into a ConfigSnapshot and reloads only when the version counter in
+# the cache changes. Saving or deleting either model bumps the counter
+# (see the receivers in apps.fhir.server.models).
+#
+# The counter only reaches other workers through a cache they share
+# (settings.FHIR_CONFIG_CACHE_ALIAS). As a backstop for a per-process
+# cache, or a change made outside the admin, a snapshot is also
+# reloaded once it is settings.FHIR_CONFIG_MAX_AGE seconds old.
+VERSION_KEY = 'fhir_server_config_version'
+
+_snapshot = None
+_checked_at = 0
+_lock = threading.Lock()
+
+
+class ConfigSnapshot(object):
+    """
+    Read-only copy of the ResourceRouter / SupportedResourceType tables.
+    The model instances it hands out are shared: do not modify them.
+    """
+
+    def __init__(self, version):
+        # imported here: apps.fhir.server.models imports this module
+        from .models import ResourceRouter, SupportedResourceType
+
+        self.version = version
+        self.loaded_at = time.time()
+        self.routers = OrderedDict()
+        for rr in ResourceRouter.objects.order_by('pk'):
+            self.routers[rr.pk] = rr
+
+        # router pk -> resourceType -> SupportedResourceType
+        # Where a router lists a resourceType more than once the
+        # lowest pk wins.
+        self.resources = {}
+        self.search_block = {}
+        self.search_add = {}
+        for srt in SupportedResourceType.objects.order_by('pk'):
+            by_type = self.resources.setdefault(srt.fhir_source_id, OrderedDict())
+            if srt.resourceType in by_type:
+                continue
+            by_type[srt.resourceType] = srt
+            key = (srt.fhir_source_id, srt.resourceType)
+            self.search_block[key] = srt.get_search_block()
+            self.search_add[key] = srt.get_search_add()
+
+    def is_current(self, version, now):
+        return (self.version == version and
+                now - self.loaded_at < settings.FHIR_CONFIG_MAX_AGE)
+
+    def router(self, pk):
+        """ ResourceRouter for pk or ResourceRouter.DoesNotExist """
+        from .models import ResourceRouter
+
+        try:
+            return self.routers[int(pk)]
+        except (KeyError, TypeError, ValueError):
+            raise ResourceRouter.DoesNotExist('ResourceRouter %s does not exist' % pk)
+
+    def resource(self, rr, resource_type):
+        """ SupportedResourceType for rr and resource_type, or None """
+        return self.resources.get(rr.pk, {}).get(resource_type)
+
+    def resource_names(self, rr):
+        return list(self.resources.get(rr.pk, {}).keys())
+
+    def get_search_block(self, rr, resource_type):
+        return self.search_block.get((rr.pk, resource_type), [])
+
+    def get_search_add(self, rr, resource_type):
+        return self.search_add.get((rr.pk, resource_type), [])
+
+
+def get_version_cache():
+    return caches[settings.FHIR_CONFIG_CACHE_ALIAS]
+
+
+def get_version():
+    cache = get_version_cache()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # first worker up, or the key was evicted
+        cache.add(VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def get_config():
+    """
+    Return the current ConfigSnapshot, reloading it when the version
+    counter has moved or it is older than settings.FHIR_CONFIG_MAX_AGE.
+    Both are checked at most once every settings.FHIR_CONFIG_CHECK_INTERVAL
+    seconds.
+    """
+    global _snapshot, _checked_at
+
+    now = time.time()
+    snapshot = _snapshot
+    if snapshot is not None and now - _checked_at < settings.FHIR_CONFIG_CHECK_INTERVAL:
+        return snapshot
+
+    version = get_version()
+    _checked_at = now
+    if snapshot is not None and snapshot.is_current(version, now):
+        return snapshot
+
+    with _lock:
+        if _snapshot is None or not _snapshot.is_current(version, now):
+            logger.debug('Loading FHIR server configuration version %s' % version)
+            _snapshot = ConfigSnapshot(version)
+        return _snapshot
+
+
+def bump_config_version():
+    """ Tell every worker to reload; drop this worker's copy now """
+    global _snapshot
+
+    get_version_cache().set(VERSION_KEY, uuid.uuid4().hex, None)
+    with _lock:
+        _snapshot = None
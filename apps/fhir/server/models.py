@@ -1,6 +1,11 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 from django.db import models
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from apps.fhir.server import resilience
+from apps.fhir.server.config import bump_config_version
+from apps.fhir.server.sessions import close_sessions
 from apps.fhir.server.utils import (text_to_list,
                                     init_text_list)
 
@@ -318,3 +323,22 @@ class SupportedResourceType(models.Model):
     def login_to_access(self):
         # Should the user be logged in to access this resource
         return self.secure_access
+
+
+@receiver(post_save, sender=ResourceRouter)
+@receiver(post_delete, sender=ResourceRouter)
+def reset_router_sessions(sender, instance, **kwargs):
+    # Connections were built with the old url/cert/verify settings,
+    # and breaker and latency history belong to the old server
+    close_sessions(instance.pk)
+    resilience.reset(instance.pk)
+
+
+@receiver(post_save, sender=ResourceRouter)
+@receiver(post_delete, sender=ResourceRouter)
+@receiver(post_save, sender=SupportedResourceType)
+@receiver(post_delete, sender=SupportedResourceType)
+@receiver(m2m_changed, sender=ResourceRouter.supported_resource.through)
+def reset_fhir_config(sender, **kwargs):
+    # Workers reload their configuration snapshot on the next request
+    bump_config_version()
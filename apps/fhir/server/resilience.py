@@ -0,0 +1,351 @@
+import logging
+import math
+import random
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from hhs_oauth_server.request_logging import register_stats
+
+logger = logging.getLogger('hhs_server.%s' % __name__)
+
+# Backend failure handling, per worker process.
+#
+# Each ResourceRouter has a CircuitBreaker. After FHIR_BREAKER_FAILURES
+# consecutive failures (timeouts, connection errors, 5xx) it opens and
+# calls fail fast with CircuitOpenError for FHIR_BREAKER_RESET seconds.
+# It then lets FHIR_BREAKER_PROBES calls through: a success closes it
+# again and a failure re-opens it.
+#
+# Each (router, resource type) keeps a window of recent call latencies.
+# The read timeout is a multiple of a high percentile of that window,
+# never above the router's wait_time.
+#
+# Each (router, resource type) also has a CallLimiter: at most
+# FHIR_MAX_CONCURRENT_CALLS calls in flight, at most FHIR_MAX_QUEUED_CALLS
+# more waiting up to FHIR_QUEUE_TIMEOUT seconds for a slot. Anything
+# beyond that is turned away with CallRejectedError.
+#
+# Failed idempotent GETs may be retried (FHIR_RETRY_ATTEMPTS > 1) after
+# a jittered exponential backoff. Each router has a RetryBudget so that
+# retries stay within FHIR_RETRY_BUDGET percent of calls and cannot
+# multiply the load on a backend that is already failing.
+
+# backend statuses worth another attempt
+RETRY_STATUSES = (502, 503, 504)
+
+_lock = threading.Lock()
+_breakers = {}
+_latencies = {}
+_limiters = {}
+_budgets = {}
+
+
+class BackendUnavailable(Exception):
+    """ Do not call the backend now; try again in retry_after seconds """
+
+    def __init__(self, message, retry_after):
+        super(BackendUnavailable, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(BackendUnavailable):
+    """ The backend is failing """
+
+    def __init__(self, router_pk, retry_after):
+        super(CircuitOpenError, self).__init__(
+            'Circuit open for ResourceRouter %s, retry after %ss' % (router_pk, retry_after),
+            retry_after)
+        self.router_pk = router_pk
+
+
+class CallRejectedError(BackendUnavailable):
+    """ Too many calls in flight and waiting for this router and resource """
+
+    def __init__(self, key, reason):
+        super(CallRejectedError, self).__init__(
+            'Call to %s:%s rejected: %s' % (key + (reason,)), 1)
+        self.key = key
+
+
+class CircuitBreaker(object):
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, router_pk):
+        self.router_pk = router_pk
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probes = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """ May a call go to the backend now? """
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < settings.FHIR_BREAKER_RESET:
+                    return False
+                logger.info('Circuit half open for ResourceRouter %s' % self.router_pk)
+                self.state = self.HALF_OPEN
+                self.probes = 0
+
+            if self.state == self.HALF_OPEN:
+                if self.probes >= settings.FHIR_BREAKER_PROBES:
+                    return False
+                self.probes += 1
+
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info('Circuit closed for ResourceRouter %s' % self.router_pk)
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= settings.FHIR_BREAKER_FAILURES:
+                if self.state != self.OPEN:
+                    logger.warning('Circuit open for ResourceRouter %s after %s failures'
+                                   % (self.router_pk, self.failures))
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def cancel_probe(self):
+        """ A call let through by allow() never reached the backend """
+        with self._lock:
+            if self.state == self.HALF_OPEN and self.probes > 0:
+                self.probes -= 1
+
+    def retry_after(self):
+        """ Whole seconds until the next probe is let through """
+        remaining = settings.FHIR_BREAKER_RESET - (time.monotonic() - self.opened_at)
+        return max(1, int(math.ceil(remaining)))
+
+    def check(self):
+        """ Raise CircuitOpenError unless a call may go through """
+        if not self.allow():
+            raise CircuitOpenError(self.router_pk, self.retry_after())
+
+
+class LatencyWindow(object):
+    """ The last FHIR_LATENCY_WINDOW call durations, in seconds """
+
+    def __init__(self):
+        self.samples = deque(maxlen=settings.FHIR_LATENCY_WINDOW)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def percentile(self, p):
+        with self._lock:
+            samples = sorted(self.samples)
+        if len(samples) < settings.FHIR_LATENCY_MIN_SAMPLES:
+            return None
+        index = min(len(samples) - 1, int(math.ceil(p / 100.0 * len(samples))) - 1)
+        return samples[max(0, index)]
+
+
+class CallLimiter(object):
+    """ Bounded concurrency with a bounded, timed wait queue """
+
+    def __init__(self, key):
+        self.key = key
+        self.in_flight = 0
+        self.queued = 0
+        self.rejected = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        limit = settings.FHIR_MAX_CONCURRENT_CALLS
+        with self._cond:
+            if self.in_flight < limit:
+                self.in_flight += 1
+                return
+
+            if self.queued >= settings.FHIR_MAX_QUEUED_CALLS:
+                self.rejected += 1
+                raise CallRejectedError(self.key, 'queue full')
+
+            self.queued += 1
+            try:
+                deadline = time.monotonic() + settings.FHIR_QUEUE_TIMEOUT
+                while self.in_flight >= limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise CallRejectedError(self.key, 'timed out in queue')
+                    self._cond.wait(remaining)
+                self.in_flight += 1
+            finally:
+                self.queued -= 1
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+
+class RetryBudget(object):
+    """
+    Token bucket: every call earns FHIR_RETRY_BUDGET / 100 of a token,
+    every retry spends one. Holds at most FHIR_RETRY_BUDGET_CAP tokens.
+    Counted in hundredths of a token to keep the arithmetic exact.
+    """
+
+    def __init__(self):
+        self.cents = settings.FHIR_RETRY_BUDGET_CAP * 100
+        self.retries = 0
+        self.exhausted = 0
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self):
+        return self.cents / 100.0
+
+    def deposit(self):
+        with self._lock:
+            self.cents = min(settings.FHIR_RETRY_BUDGET_CAP * 100,
+                             self.cents + settings.FHIR_RETRY_BUDGET)
+
+    def withdraw(self):
+        with self._lock:
+            if self.cents < 100:
+                self.exhausted += 1
+                return False
+            self.cents -= 100
+            self.retries += 1
+            return True
+
+
+def get_retry_budget(rr):
+    with _lock:
+        budget = _budgets.get(rr.pk)
+        if budget is None:
+            budget = _budgets[rr.pk] = RetryBudget()
+        return budget
+
+
+def backoff_delay(attempt):
+    """ Seconds to wait before attempt + 1: full jitter, capped """
+    ceiling = min(settings.FHIR_RETRY_BACKOFF_MAX_MS,
+                  settings.FHIR_RETRY_BACKOFF_MS * 2 ** (attempt - 1))
+    return random.uniform(0, ceiling) / 1000.0
+
+
+@contextmanager
+def call_slot(rr, resource_type):
+    """ Hold one of the in-flight slots for rr and resource_type """
+    if settings.FHIR_MAX_CONCURRENT_CALLS <= 0:
+        yield
+        return
+
+    key = (rr.pk, resource_type)
+    with _lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = CallLimiter(key)
+
+    limiter.acquire()
+    try:
+        yield
+    finally:
+        limiter.release()
+
+
+def get_breaker(rr):
+    with _lock:
+        breaker = _breakers.get(rr.pk)
+        if breaker is None:
+            breaker = _breakers[rr.pk] = CircuitBreaker(rr.pk)
+        return breaker
+
+
+def get_latency(rr, resource_type):
+    key = (rr.pk, resource_type)
+    with _lock:
+        window = _latencies.get(key)
+        if window is None:
+            window = _latencies[key] = LatencyWindow()
+        return window
+
+
+def get_timeouts(rr, resource_type, ceiling=None):
+    """
+    (connect, read) timeout for a call to resource_type on rr.
+
+    ceiling defaults to rr.wait_time. Until enough calls have been
+    seen the read timeout is the ceiling itself.
+    """
+    ceiling = ceiling or rr.wait_time
+    if not ceiling:
+        return None
+
+    read = ceiling
+    observed = get_latency(rr, resource_type).percentile(settings.FHIR_TIMEOUT_PERCENTILE)
+    if observed is not None:
+        read = min(ceiling, max(settings.FHIR_TIMEOUT_FLOOR,
+                                observed * settings.FHIR_TIMEOUT_MULTIPLIER))
+
+    return (min(settings.FHIR_CONNECT_TIMEOUT, ceiling), read)
+
+
+def resilience_stats():
+    """
+    Breaker state and retry budget per router; read timeout inputs and
+    in-flight, queued and rejected calls per router and resource type
+    """
+    with _lock:
+        breakers = list(_breakers.values())
+        latencies = list(_latencies.items())
+        limiters = list(_limiters.items())
+        budgets = list(_budgets.items())
+
+    return {
+        'breakers': dict((b.router_pk, {'state': b.state, 'failures': b.failures})
+                         for b in breakers),
+        'latency': dict(('%s:%s' % key, {'samples': len(w.samples),
+                                         'p50': w.percentile(50),
+                                         'p99': w.percentile(99)})
+                        for key, w in latencies),
+        'limiters': dict(('%s:%s' % key, {'in_flight': l.in_flight,
+                                          'queued': l.queued,
+                                          'rejected': l.rejected})
+                         for key, l in limiters),
+        'retries': dict((pk, {'tokens': b.tokens,
+                              'retries': b.retries,
+                              'exhausted': b.exhausted})
+                        for pk, b in budgets),
+    }
+
+
+def reset(router_pk=None):
+    """ Forget breaker and latency state for one router, or all """
+    with _lock:
+        for pk in list(_breakers):
+            if router_pk is None or pk == router_pk:
+                del _breakers[pk]
+        for key in list(_latencies):
+            if router_pk is None or key[0] == router_pk:
+                del _latencies[key]
+        for pk in list(_budgets):
+            if router_pk is None or pk == router_pk:
+                del _budgets[pk]
+        for key in list(_limiters):
+            # calls in flight keep their own reference to the limiter
+            if router_pk is None or key[0] == router_pk:
+                del _limiters[key]
+
+
+register_stats('resilience', resilience_stats)
@@ -0,0 +1,141 @@
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+
+from hhs_oauth_server.request_logging import register_stats
+
+logger = logging.getLogger('hhs_server.%s' % __name__)
+logger_perf = logging.getLogger('performance.%s' % __name__)
+
+# One pooled requests.Session per ResourceRouter and TLS settings per
+# worker process. The pool is keyed on everything that changes the TLS
+# connection (see session_key), so metadata calls (no crosswalk, no
+# server verification) and beneficiary calls keep separate Sessions
+# side by side, and an edited router row never reuses a connection
+# built for the old one.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class PooledAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that keeps count of in-flight requests so we can tell
+    when callers are waiting on (or overflowing) the connection pool.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.pool_maxsize = kwargs.get('pool_maxsize', requests.adapters.DEFAULT_POOLSIZE)
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.exhausted = 0
+        self._stats_lock = threading.Lock()
+        super(PooledAdapter, self).__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        with self._stats_lock:
+            self.requests += 1
+            self.in_flight += 1
+            if self.in_flight > self.peak_in_flight:
+                self.peak_in_flight = self.in_flight
+            if self.in_flight > self.pool_maxsize:
+                self.exhausted += 1
+                logger_perf.warning('Connection pool exhausted for %s '
+                                    '(%s in flight, pool size %s)' % (request.url,
+                                                                      self.in_flight,
+                                                                      self.pool_maxsize))
+        try:
+            return super(PooledAdapter, self).send(request, **kwargs)
+        finally:
+            with self._stats_lock:
+                self.in_flight -= 1
+
+    def stats(self):
+        return {'pool_maxsize': self.pool_maxsize,
+                'in_flight': self.in_flight,
+                'peak_in_flight': self.peak_in_flight,
+                'requests': self.requests,
+                'exhausted': self.exhausted}
+
+
+def session_key(router, cert=(), verify=False):
+    """ Build the pool key for a ResourceRouter and its TLS settings """
+    return (router.pk, router.fhir_url, tuple(cert or ()), verify)
+
+
+def build_session(cert=(), verify=False):
+    """ Create a keep-alive Session with a bounded connection pool """
+    session = requests.Session()
+    adapter = PooledAdapter(pool_connections=settings.FHIR_POOL_CONNECTIONS,
+                            pool_maxsize=settings.FHIR_POOL_MAXSIZE,
+                            pool_block=settings.FHIR_POOL_BLOCK)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if cert:
+        session.cert = tuple(cert)
+    session.verify = verify
+    # bodies come back gzipped and are inflated as they are read
+    session.headers['Accept-Encoding'] = 'gzip'
+    if not settings.FHIR_KEEP_ALIVE:
+        session.headers['Connection'] = 'close'
+    return session
+
+
+def get_session(router, cert=(), verify=False):
+    """
+    Return the pooled Session for router and TLS settings, building it
+    on first use. Sessions left over from an older url of the router
+    row are closed.
+    """
+    key = session_key(router, cert, verify)
+    session = _sessions.get(key)
+    if session is not None:
+        return session
+
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is not None:
+            return session
+        for old_key in [k for k in _sessions if k[0] == router.pk and k[1] != router.fhir_url]:
+            logger.debug('Closing backend session for an older url of router %s' % router.pk)
+            _sessions.pop(old_key).close()
+        session = build_session(cert, verify)
+        session.bb_key = key
+        _sessions[key] = session
+
+    return session
+
+
+def close_sessions(router_pk=None):
+    """ Drop pooled Sessions for one router, or all of them """
+    with _sessions_lock:
+        keys = [k for k in _sessions if router_pk is None or k[0] == router_pk]
+        for k in keys:
+            _sessions.pop(k).close()
+
+
+def pool_stats():
+    """
+    Per-router connection pool counters for this worker, added up over
+    the router's Sessions (peak_in_flight is the highest of them)
+    """
+    stats = {}
+    for key, session in list(_sessions.items()):
+        adapter_stats = session.get_adapter(key[1]).stats()
+        totals = stats.get(key[0])
+        if totals is None:
+            stats[key[0]] = adapter_stats
+            continue
+        for name, value in adapter_stats.items():
+            if name == 'peak_in_flight':
+                totals[name] = max(totals[name], value)
+            else:
+                totals[name] += value
+    return stats
+
+
+register_stats('connection_pools', pool_stats)
@@ -0,0 +1,107 @@
+import logging
+import threading
+
+from collections import Counter
+
+from hhs_oauth_server.request_logging import register_stats
+
+logger = logging.getLogger('hhs_server.%s' % __name__)
+
+# Identical backend GETs that overlap in time (an app firing the same
+# search over several connections, or retrying a slow one) share one
+# upstream call. The first caller for a key leads and makes the call;
+# callers that arrive while it is in flight follow and are handed the
+# same response. This only coalesces within one worker process.
+
+
+class Call(object):
+    """ One upstream call and the callers waiting on it """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.shared = False
+        self.followers = 0
+
+
+class Group(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stats = Counter()
+
+    def do(self, key, fn, timeout=None):
+        """
+        Run fn() once for all concurrent callers with the same key.
+
+        fn returns (result, shareable). A result that is not shareable
+        (e.g. a response body left unread for streaming) belongs to the
+        leader; followers then run fn() themselves, as they do if the
+        leader has not finished within timeout seconds. An exception
+        raised by the leader's call is raised in its followers too.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Call()
+            else:
+                call.followers += 1
+
+        if leader:
+            self.record('calls')
+            try:
+                call.result, call.shared = fn()
+            except Exception as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+            return call.result
+
+        if not call.done.wait(timeout):
+            logger.debug('Gave up waiting for in-flight call %s' % (key,))
+            self.record('timeouts')
+            return fn()[0]
+
+        if call.error is not None:
+            self.record('coalesced')
+            raise call.error
+
+        if not call.shared:
+            self.record('unshared')
+            return fn()[0]
+
+        self.record('coalesced')
+        return call.result
+
+    def record(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        """ calls, coalesced, timeouts, unshared and in_flight """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._calls)
+        for name in ('calls', 'coalesced', 'timeouts', 'unshared'):
+            stats.setdefault(name, 0)
+        return stats
+
+
+_backend_calls = Group()
+
+
+def coalesce(key, fn, timeout=None):
+    return _backend_calls.do(key, fn, timeout)
+
+
+def coalesce_stats():
+    return _backend_calls.stats()
+
+
+register_stats('coalescing', coalesce_stats)
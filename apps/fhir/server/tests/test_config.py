@@ -0,0 +1,62 @@
+from django.test import TestCase, override_settings
+
+from apps.fhir.server.config import bump_config_version, get_config
+from apps.fhir.server.models import ResourceRouter, SupportedResourceType
+
+
+class ConfigSnapshotTest(TestCase):
+
+    fixtures = ['fhir_server_new_testdata.json']
+
+    def setUp(self):
+        bump_config_version()
+
+    def tearDown(self):
+        # the test transaction rollback does not send signals
+        bump_config_version()
+
+    def test_snapshot_is_reused(self):
+        config = get_config()
+
+        with self.assertNumQueries(0):
+            self.assertIs(get_config(), config)
+            self.assertEqual(config.router(1).name, 'HHS IDEA Lab Sandbox[Default]')
+
+    def test_resources_for_router(self):
+        config = get_config()
+        rr = config.router(1)
+
+        self.assertEqual(config.resource_names(rr),
+                         ['Patient', 'ExplanationOfBenefit', 'CapabilityStatement'])
+        # duplicate resourceType rows: the lowest pk wins
+        self.assertEqual(config.resource(rr, 'ExplanationOfBenefit').pk, 2)
+        self.assertIsNone(config.resource(rr, 'Coverage'))
+        self.assertEqual(config.get_search_block(rr, 'Patient'),
+                         SupportedResourceType.objects.get(pk=1).get_search_block())
+
+    def test_reload_on_router_save(self):
+        get_config()
+        rr = ResourceRouter.objects.get(pk=1)
+        rr.name = 'Renamed'
+        rr.save()
+
+        self.assertEqual(get_config().router(1).name, 'Renamed')
+
+    def test_reload_on_resource_delete(self):
+        rr = get_config().router(1)
+        SupportedResourceType.objects.filter(pk=1).delete()
+
+        self.assertNotIn('Patient', get_config().resource_names(rr))
+
+    @override_settings(FHIR_CONFIG_CHECK_INTERVAL=0, FHIR_CONFIG_MAX_AGE=0)
+    def test_reload_when_too_old(self):
+        """ A change the version counter missed is picked up by age """
+        get_config()
+        # another worker's save, bumping a counter this one never sees
+        ResourceRouter.objects.filter(pk=1).update(name='Renamed')
+
+        self.assertEqual(get_config().router(1).name, 'Renamed')
+
+    def test_missing_router(self):
+        with self.assertRaises(ResourceRouter.DoesNotExist):
+            get_config().router(99)
@@ -0,0 +1,140 @@
+import threading
+
+from django.test import TestCase, override_settings
+
+from apps.fhir.server import resilience
+from apps.fhir.server.config import bump_config_version
+from apps.fhir.server.models import ResourceRouter
+from apps.fhir.server.resilience import (CallLimiter,
+                                         CallRejectedError,
+                                         CircuitBreaker,
+                                         CircuitOpenError,
+                                         RetryBudget,
+                                         backoff_delay,
+                                         get_latency,
+                                         get_timeouts)
+
+
+@override_settings(FHIR_BREAKER_FAILURES=3, FHIR_BREAKER_RESET=30, FHIR_BREAKER_PROBES=1)
+class CircuitBreakerTest(TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(1)
+
+    def fail(self, times):
+        for i in range(times):
+            self.breaker.record_failure()
+
+    def test_opens_after_consecutive_failures(self):
+        self.fail(2)
+        self.breaker.record_success()
+        self.fail(2)
+        self.assertTrue(self.breaker.allow())
+
+        self.fail(1)
+        self.assertFalse(self.breaker.allow())
+        with self.assertRaises(CircuitOpenError) as raised:
+            self.breaker.check()
+        self.assertEqual(raised.exception.retry_after, 30)
+
+    def test_half_open_probe(self):
+        self.fail(3)
+        with override_settings(FHIR_BREAKER_RESET=0):
+            self.assertTrue(self.breaker.allow())
+            # only one probe at a time
+            self.assertFalse(self.breaker.allow())
+
+            self.breaker.record_failure()
+            self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record_success()
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+
+@override_settings(FHIR_LATENCY_MIN_SAMPLES=5, FHIR_TIMEOUT_PERCENTILE=99,
+                   FHIR_TIMEOUT_MULTIPLIER=3, FHIR_TIMEOUT_FLOOR=1,
+                   FHIR_CONNECT_TIMEOUT=5)
+class AdaptiveTimeoutTest(TestCase):
+
+    fixtures = ['fhir_server_new_testdata.json']
+
+    def setUp(self):
+        resilience.reset()
+        self.rr = ResourceRouter.objects.get(pk=1)
+        self.rr.wait_time = 30
+
+    def tearDown(self):
+        resilience.reset()
+        bump_config_version()
+
+    def test_wait_time_until_enough_samples(self):
+        self.assertEqual(get_timeouts(self.rr, 'Patient'), (5, 30))
+        self.assertEqual(get_timeouts(self.rr, 'Patient', 10), (5, 10))
+
+    def test_timeout_follows_latency(self):
+        for seconds in (0.5, 0.5, 0.5, 0.5, 2):
+            get_latency(self.rr, 'ExplanationOfBenefit').add(seconds)
+        for seconds in (0.1, 0.1, 0.1, 0.1, 0.1):
+            get_latency(self.rr, 'Patient').add(seconds)
+
+        self.assertEqual(get_timeouts(self.rr, 'ExplanationOfBenefit'), (5, 6))
+        # never below the floor
+        self.assertEqual(get_timeouts(self.rr, 'Patient'), (5, 1))
+        # never above wait_time
+        self.assertEqual(get_timeouts(self.rr, 'ExplanationOfBenefit', 4), (4, 4))
+
+
+@override_settings(FHIR_MAX_CONCURRENT_CALLS=1, FHIR_MAX_QUEUED_CALLS=1, FHIR_QUEUE_TIMEOUT=5)
+class CallLimiterTest(TestCase):
+
+    def setUp(self):
+        self.limiter = CallLimiter((1, 'Patient'))
+        self.limiter.acquire()
+
+    def test_queue_full(self):
+        with override_settings(FHIR_MAX_QUEUED_CALLS=0):
+            with self.assertRaises(CallRejectedError):
+                self.limiter.acquire()
+        self.assertEqual(self.limiter.rejected, 1)
+
+    def test_queue_timeout(self):
+        with override_settings(FHIR_QUEUE_TIMEOUT=0):
+            with self.assertRaises(CallRejectedError):
+                self.limiter.acquire()
+        self.assertEqual(self.limiter.queued, 0)
+
+    def test_queued_call_gets_released_slot(self):
+        waiter = threading.Thread(target=self.limiter.acquire)
+        waiter.start()
+        while self.limiter.queued == 0:
+            pass
+        self.limiter.release()
+        waiter.join()
+
+        self.assertEqual((self.limiter.in_flight, self.limiter.queued), (1, 0))
+
+
+@override_settings(FHIR_RETRY_BUDGET=10, FHIR_RETRY_BUDGET_CAP=2,
+                   FHIR_RETRY_BACKOFF_MS=100, FHIR_RETRY_BACKOFF_MAX_MS=250)
+class RetryPolicyTest(TestCase):
+
+    def test_budget_refills_from_calls(self):
+        budget = RetryBudget()
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+
+        # ten calls earn one retry
+        for i in range(10):
+            budget.deposit()
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        self.assertEqual((budget.retries, budget.exhausted), (3, 2))
+
+    def test_backoff_is_jittered_and_capped(self):
+        for attempt, ceiling in ((1, 0.1), (2, 0.2), (3, 0.25), (8, 0.25)):
+            delay = backoff_delay(attempt)
+            self.assertTrue(0 <= delay <= ceiling)
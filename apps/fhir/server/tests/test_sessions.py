@@ -0,0 +1,63 @@
+from django.test import TestCase
+
+from apps.fhir.server.config import bump_config_version
+from apps.fhir.server.models import ResourceRouter
+from apps.fhir.server import sessions
+from apps.fhir.server.sessions import (close_sessions,
+                                       get_session,
+                                       pool_stats)
+
+
+class BackendSessionPoolTest(TestCase):
+
+    fixtures = ['fhir_server_new_testdata.json']
+
+    def setUp(self):
+        close_sessions()
+        self.rr = ResourceRouter.objects.get(pk=1)
+
+    def tearDown(self):
+        close_sessions()
+        # the test transaction rollback does not send signals
+        bump_config_version()
+
+    def test_session_is_reused(self):
+        """ The same router and TLS settings share one Session """
+        cert = ('/certstore/cert.pem', '/certstore/key.pem')
+        session = get_session(self.rr, cert, False)
+
+        self.assertIs(get_session(self.rr, cert, False), session)
+        self.assertEqual(session.cert, cert)
+        self.assertFalse(session.verify)
+
+    def test_tls_variants_coexist(self):
+        """ Each set of TLS settings keeps its own Session for the router """
+        session = get_session(self.rr, (), False)
+        verified = get_session(self.rr, (), True)
+
+        self.assertIsNot(verified, session)
+        self.assertTrue(verified.verify)
+        self.assertIs(get_session(self.rr, (), False), session)
+        self.assertIs(get_session(self.rr, (), True), verified)
+
+    def test_session_for_old_url_closed(self):
+        session = get_session(self.rr, (), False)
+        self.rr.fhir_url = 'https://other.example.com/baseDstu3/'
+
+        self.assertIsNot(get_session(self.rr, (), False), session)
+        self.assertEqual(len(sessions._sessions), 1)
+
+    def test_session_dropped_when_router_saved(self):
+        """ Saving the router in admin discards the pooled Session """
+        session = get_session(self.rr, (), False)
+        self.rr.wait_time = 10
+        self.rr.save()
+
+        self.assertIsNot(get_session(self.rr, (), False), session)
+
+    def test_pool_stats(self):
+        get_session(self.rr, (), False)
+        stats = pool_stats()[self.rr.pk]
+
+        self.assertEqual(stats['requests'], 0)
+        self.assertEqual(stats['exhausted'], 0)
@@ -0,0 +1,74 @@
+import threading
+
+from django.test import SimpleTestCase
+
+from apps.fhir.server.singleflight import Call, Group
+
+
+class SingleFlightTest(SimpleTestCase):
+
+    def setUp(self):
+        self.group = Group()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def slow_call(self, result=True, shareable=True):
+        def call():
+            self.calls += 1
+            self.release.wait(5)
+            if isinstance(result, Exception):
+                raise result
+            return object(), shareable
+        return call
+
+    def run_concurrently(self, fn, count=4):
+        """ Start count callers, release the leader once all are waiting """
+        results = []
+
+        def worker():
+            try:
+                results.append(self.group.do('key', fn, 5))
+            except Exception as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=worker) for i in range(count)]
+        threads[0].start()
+        while 'key' not in self.group._calls:
+            pass
+        for thread in threads[1:]:
+            thread.start()
+        while self.group._calls['key'].followers < count - 1:
+            pass
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_followers_share_the_leader_result(self):
+        results = self.run_concurrently(self.slow_call())
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(len(set(id(r) for r in results)), 1)
+        stats = self.group.stats()
+        self.assertEqual((stats['calls'], stats['coalesced']), (1, 3))
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_unshareable_result_is_not_shared(self):
+        results = self.run_concurrently(self.slow_call(shareable=False), count=2)
+
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(len(set(id(r) for r in results)), 2)
+
+    def test_leader_error_raised_in_followers(self):
+        results = self.run_concurrently(self.slow_call(ValueError('backend down')), count=3)
+
+        self.assertEqual(self.calls, 1)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+
+    def test_follower_timeout_calls_itself(self):
+        self.group._calls['key'] = Call()
+
+        result = self.group.do('key', lambda: ('own', True), timeout=0.01)
+
+        self.assertEqual(result, 'own')
+        self.assertEqual(self.group.stats()['timeouts'], 1)
@@ -0,0 +1,175 @@
+import logging
+import re
+import threading
+import time
+
+from urllib.parse import urlparse
+
+from corsheaders import defaults as cors_settings
+from corsheaders.middleware import (ACCESS_CONTROL_ALLOW_CREDENTIALS,
+                                    ACCESS_CONTROL_ALLOW_HEADERS,
+                                    ACCESS_CONTROL_ALLOW_METHODS,
+                                    ACCESS_CONTROL_ALLOW_ORIGIN,
+                                    ACCESS_CONTROL_MAX_AGE)
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.middleware import (AuthenticationMiddleware as BaseAuthenticationMiddleware,
+                                            SessionAuthenticationMiddleware as BaseSessionAuthenticationMiddleware)
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.messages.middleware import MessageMiddleware as BaseMessageMiddleware
+from django.contrib.sessions.middleware import SessionMiddleware as BaseSessionMiddleware
+from django.http import HttpResponse
+from django.middleware.clickjacking import XFrameOptionsMiddleware as BaseXFrameOptionsMiddleware
+from django.middleware.csrf import CsrfViewMiddleware as BaseCsrfViewMiddleware
+from django.utils.cache import patch_vary_headers
+from social_django.middleware import SocialAuthExceptionMiddleware as BaseSocialAuthExceptionMiddleware
+
+logger = logging.getLogger('hhs_server.%s' % __name__)
+
+##############################################################################
+#
+# Browser-only middleware, skipped on bearer token API requests
+#
+# The FHIR API, userinfo and the token endpoint authenticate every call
+# with an access token (or client credentials) and never use the
+# session, the CSRF token, request.user, messages or frame options.
+# The classes below stand in for the Django and social-auth middleware
+# of the same names in MIDDLEWARE_CLASSES and do nothing for paths
+# starting with one of settings.API_FAST_PATH_PREFIXES, so an API call
+# pays for no session lookup.
+#
+##############################################################################
+
+HOOKS = ('process_request', 'process_view', 'process_template_response',
+         'process_response', 'process_exception')
+
+
+def is_api_request(request):
+    return request.path_info.startswith(tuple(settings.API_FAST_PATH_PREFIXES))
+
+
+def skip_for_api(hook):
+    """ Wrap a middleware hook so it passes API requests through """
+    def wrapper(self, request, *args):
+        if is_api_request(request):
+            # process_response and process_template_response hand the
+            # response back, the other hooks return None
+            return args[0] if hook.__name__.endswith('_response') else None
+        return hook(self, request, *args)
+
+    wrapper.__name__ = hook.__name__
+    wrapper.__doc__ = hook.__doc__
+    return wrapper
+
+
+def browser_only(middleware_class):
+    """ Subclass of middleware_class skipping every hook on API requests """
+    hooks = dict((name, skip_for_api(getattr(middleware_class, name)))
+                 for name in HOOKS if hasattr(middleware_class, name))
+    return type(middleware_class.__name__, (middleware_class,), dict(hooks, __module__=__name__))
+
+
+SessionMiddleware = browser_only(BaseSessionMiddleware)
+CsrfViewMiddleware = browser_only(BaseCsrfViewMiddleware)
+SessionAuthenticationMiddleware = browser_only(BaseSessionAuthenticationMiddleware)
+MessageMiddleware = browser_only(BaseMessageMiddleware)
+XFrameOptionsMiddleware = browser_only(BaseXFrameOptionsMiddleware)
+SocialAuthExceptionMiddleware = browser_only(BaseSocialAuthExceptionMiddleware)
+
+
+class AuthenticationMiddleware(BaseAuthenticationMiddleware):
+    """ API requests get an AnonymousUser rather than the session's user """
+
+    def process_request(self, request):
+        if is_api_request(request):
+            request.user = AnonymousUser()
+            return None
+        return super(AuthenticationMiddleware, self).process_request(request)
+
+
+##############################################################################
+#
+# CORS preflight fast path
+#
+# Browsers send an OPTIONS preflight ahead of most cross-origin API
+# calls. CorsPreflightMiddleware, first in MIDDLEWARE_CLASSES, answers
+# them before the rest of the stack runs, with an Access-Control-Max-Age
+# (CORS_PREFLIGHT_MAX_AGE) letting the browser reuse the answer.
+#
+##############################################################################
+
+
+class CorsPreflightMiddleware(object):
+    """
+    Answer CORS preflights (OPTIONS with Access-Control-Request-Method)
+    for API paths before any other middleware sees the request.
+
+    The headers that do not depend on the origin are built once. Whether
+    an origin is allowed, which may take a CORS_MODEL query, is kept for
+    CORS_PREFLIGHT_ORIGIN_CACHE_TTL seconds. The rules are those of
+    corsheaders.middleware.CorsMiddleware, which still handles the
+    actual requests and any path not covered here.
+    """
+
+    def __init__(self):
+        self.allow_all = cors_settings.CORS_ORIGIN_ALLOW_ALL
+        self.echo_origin = not self.allow_all or cors_settings.CORS_ALLOW_CREDENTIALS
+        self.headers = [(ACCESS_CONTROL_ALLOW_HEADERS, ', '.join(cors_settings.CORS_ALLOW_HEADERS)),
+                        (ACCESS_CONTROL_ALLOW_METHODS, ', '.join(cors_settings.CORS_ALLOW_METHODS))]
+        if cors_settings.CORS_PREFLIGHT_MAX_AGE:
+            self.headers.append((ACCESS_CONTROL_MAX_AGE, str(cors_settings.CORS_PREFLIGHT_MAX_AGE)))
+        if cors_settings.CORS_ALLOW_CREDENTIALS:
+            self.headers.append((ACCESS_CONTROL_ALLOW_CREDENTIALS, 'true'))
+        self.urls_regex = re.compile(cors_settings.CORS_URLS_REGEX)
+        self.origins = {}
+        self._lock = threading.Lock()
+
+    def process_request(self, request):
+        if (request.method != 'OPTIONS' or
+                'HTTP_ACCESS_CONTROL_REQUEST_METHOD' not in request.META or
+                not is_api_request(request) or
+                not self.urls_regex.match(request.path)):
+            return None
+
+        request._cors_preflight = True
+        response = HttpResponse()
+        origin = request.META.get('HTTP_ORIGIN')
+        if not origin or not self.is_allowed(origin):
+            return response
+
+        response[ACCESS_CONTROL_ALLOW_ORIGIN] = origin if self.echo_origin else '*'
+        for name, value in self.headers:
+            response[name] = value
+        if self.echo_origin:
+            patch_vary_headers(response, ('Origin',))
+        return response
+
+    def is_allowed(self, origin):
+        if self.allow_all:
+            return True
+
+        now = time.monotonic()
+        with self._lock:
+            cached = self.origins.get(origin)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+        allowed = origin_allowed(origin)
+        with self._lock:
+            if len(self.origins) >= settings.CORS_PREFLIGHT_ORIGIN_CACHE_SIZE:
+                self.origins.clear()
+            self.origins[origin] = (allowed, now + settings.CORS_PREFLIGHT_ORIGIN_CACHE_TTL)
+        return allowed
+
+
+def origin_allowed(origin):
+    """ Would CorsMiddleware send CORS headers to origin? """
+    url = urlparse(origin)
+    if url.netloc in cors_settings.CORS_ORIGIN_WHITELIST:
+        return True
+    if any(re.match(pattern, origin) for pattern in cors_settings.CORS_ORIGIN_REGEX_WHITELIST):
+        return True
+    if cors_settings.CORS_MODEL is not None:
+        model = apps.get_model(*cors_settings.CORS_MODEL.split('.'))
+        return model.objects.filter(cors=url.netloc).exists()
+    return False
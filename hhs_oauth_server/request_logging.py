@@ -1,78 +1,277 @@
-import logging
 import datetime
+import json
+import logging
+import os
+import threading
+import time
 import uuid
 
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import connections
+from django.dispatch import receiver
+
 logger = logging.getLogger('performance.%s' % __name__)
 
 ##############################################################################
 #
-# Request time logging middleware
-# https://djangosnippets.org/snippets/1826/
+# Per-phase request timing
+#
+# RequestTimingMiddleware (near the top of MIDDLEWARE_CLASSES) and
+# ViewTimingMiddleware (last) time each request on the monotonic clock.
+# Code below them adds its own phases with timed(name), which does
+# nothing outside a timed request (e.g. in fan-out worker threads):
+#
+#   middleware        time outside the view, in the middleware
+#   view              the view, including the phases below
+#   token             access token validation
+#   db                SQL, from the debug cursor (REQUEST_TIMING_SQL)
+#   backend           backend calls, with waits for call slots, retries
+#                     and coalesced calls
+#   backend_ttfb      until the backend's response headers, connect
+#                     included (requests does not split the two)
+#   backend_download  reading the backend's response body
+#   fanout            waiting on backend calls run in parallel
+#   rewrite           url rewriting, parsing and projection
+#   serialize         building the response body
+#   compress          gzip
+#   stream            sending a streamed body, rewriting included
+#
+# Phases nest and overlap; each is the time spent in it. SQL is counted
+# as the debug cursor logs it, however full the connection's bounded
+# queries_log is. One JSON
+# record per request goes to the performance logger, and the phases
+# known before the body is sent go in a Server-Timing header when
+# settings.REQUEST_TIMING_HEADER is on. A streamed body is not read
+# here: its record is written once the body has been sent.
 #
 ##############################################################################
 
+_local = threading.local()
+
+##############################################################################
+#
+# Worker statistics
+#
+# Modules keeping counters for this worker (caches, pools, breakers)
+# register a function returning them, as a JSON serializable dict, with
+# register_stats(name, fn). At the end of a request, once every
+# settings.REQUEST_STATS_INTERVAL seconds (0 disables), the worker logs
+# them all as one record on the performance logger.
+#
+##############################################################################
+
+_stats_sources = OrderedDict()
+_stats_lock = threading.Lock()
+_stats_logged_at = time.monotonic()
+
 
-class RequestTimeLoggingMiddleware(object):
-    """Middleware class logging request time to stderr.
+class RequestTimer(object):
+    """ Time spent in each phase of one request """
 
-    This class can be used to measure time of request processing
-    within Django.  It can be also used to log time spent in
-    middleware and in view itself, by putting middleware multiple
-    times in INSTALLED_MIDDLEWARE.
+    def __init__(self):
+        self.start = time.monotonic()
+        self.phases = OrderedDict()
+        self.view_start = None
+        self.queries = []
 
-    Static method `log_message' may be used independently of the
-    middleware itself, outside of it, and even when middleware is not
-    listed in INSTALLED_MIDDLEWARE.
+    def add(self, name, seconds):
+        phase = self.phases.get(name)
+        if phase is None:
+            self.phases[name] = [seconds, 1]
+        else:
+            phase[0] += seconds
+            phase[1] += 1
+
+    def watch_queries(self):
+        for connection in connections.all():
+            log = QueryLog(connection.queries_log.maxlen)
+            self.queries.append((connection, connection.force_debug_cursor, connection.queries_log, log))
+            connection.queries_log = log
+            connection.force_debug_cursor = True
+
+    def stop_watching_queries(self):
+        count = 0
+        seconds = 0.0
+        for connection, force_debug_cursor, queries_log, log in self.queries:
+            connection.force_debug_cursor = force_debug_cursor
+            if connection.queries_log is log:
+                connection.queries_log = queries_log
+            queries_log.extend(log)
+            count += log.count
+            seconds += log.seconds
+        self.queries = []
+        if count:
+            self.phases['db'] = [seconds, count]
+
+    def finish(self):
+        total = time.monotonic() - self.start
+        view = self.phases.get('view', [0.0])[0]
+        self.phases['middleware'] = [total - view, 1]
+        self.phases['total'] = [total, 1]
+
+    def server_timing(self):
+        return ', '.join('%s;dur=%.1f' % (name, seconds * 1000)
+                         for name, (seconds, count) in self.phases.items())
+
+    def record(self, request, response):
+        return OrderedDict([
+            ('request_id', str(request._logging_uuid)),
+            ('start', request._logging_start_dt.isoformat()),
+            ('method', request.method),
+            ('path', request.path),
+            ('status', response.status_code),
+            ('streaming', response.streaming),
+            ('phases', OrderedDict((name, round(seconds * 1000, 1))
+                                   for name, (seconds, count) in self.phases.items())),
+            ('counts', OrderedDict((name, count)
+                                   for name, (seconds, count) in self.phases.items() if count > 1)),
+        ])
+
+
+class QueryLog(deque):
     """
+    Stands in for a connection's queries_log while a request is timed,
+    counting every query logged to it, including those the bound drops
+    """
+
+    def __init__(self, maxlen):
+        super(QueryLog, self).__init__(maxlen=maxlen)
+        self.count = 0
+        self.seconds = 0.0
+
+    def append(self, query):
+        super(QueryLog, self).append(query)
+        self.count += 1
+        self.seconds += float(query['time'])
+
+
+def current_timer():
+    """ The RequestTimer of the request this thread is handling, or None """
+    return getattr(_local, 'timer', None)
+
+
+@contextmanager
+def timed(name):
+    """ Add the time spent in the with block to phase name """
+    timer = current_timer()
+    if timer is None:
+        yield
+        return
 
-    @staticmethod
-    def log_message(request, tag, message=''):
-        """Log timing message to stderr.
-
-        Logs message about `request' with a `tag' (a string, 10
-        characters or less if possible), timing info and optional
-        `message'.
-
-        Log format is "timestamp tag uuid count path +delta message"
-        - timestamp is microsecond timestamp of message
-        - tag is the `tag' parameter
-        - uuid is the UUID identifying request
-        - count is number of logged message for this request
-        - path is request.path
-        - delta is timedelta between first logged message
-          for this request and current message
-        - message is the `message' parameter.
-        """
-
-        dt = datetime.datetime.utcnow()
-        if not hasattr(request, '_logging_uuid'):
-            request._logging_uuid = uuid.uuid1()
-            request._logging_start_dt = dt
-            request._logging_pass = 0
-
-        request._logging_pass += 1
-
-        # Replace this with logging output
-
-        logger.info('%s %-10s %s %2d %s +%s %s' % (
-                    dt.isoformat(),
-                    tag,
-                    request._logging_uuid,
-                    request._logging_pass,
-                    request.path,
-                    dt - request._logging_start_dt,
-                    message)
-                    )
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        timer.add(name, time.monotonic() - start)
+
+
+def register_stats(name, fn):
+    _stats_sources[name] = fn
+
+
+def log_stats_when_due():
+    """ Log the registered statistics if REQUEST_STATS_INTERVAL has passed """
+    global _stats_logged_at
+    if settings.REQUEST_STATS_INTERVAL <= 0:
+        return
+
+    now = time.monotonic()
+    with _stats_lock:
+        if now - _stats_logged_at < settings.REQUEST_STATS_INTERVAL:
+            return
+        _stats_logged_at = now
+
+    stats = OrderedDict([('pid', os.getpid())])
+    for name, fn in list(_stats_sources.items()):
+        try:
+            stats[name] = fn()
+        except Exception:
+            logger.exception('Statistics %s failed' % name)
+    logger.info(json.dumps({'stats': stats}))
+
+
+def log_record(timer, request, response):
+    logger.info(json.dumps(timer.record(request, response)))
+
+
+def timed_stream(timer, request, response, chunks):
+    start = time.monotonic()
+    try:
+        for chunk in chunks:
+            yield chunk
+    finally:
+        timer.add('stream', time.monotonic() - start)
+        log_record(timer, request, response)
+
+
+@receiver(request_finished)
+def forget_timer(sender, **kwargs):
+    """
+    Make sure the thread's next request starts untimed and the debug
+    cursor is off, even if process_response below never ran (e.g. a
+    later middleware's process_response raised).
+    """
+    timer = current_timer()
+    if timer is not None:
+        _local.timer = None
+        timer.stop_watching_queries()
+
+
+class RequestTimingMiddleware(object):
+    """
+    Start timing each request and report the phases with its response.
+
+    Sets request._logging_uuid, _logging_start_dt and _logging_pass,
+    which apps.fhir.bluebutton.utils forwards to the backend.
+    """
 
     def process_request(self, request):
-        self.log_message(request, 'request ')
+        timer = RequestTimer()
+        request._timer = timer
+        request._logging_uuid = uuid.uuid4()
+        request._logging_start_dt = datetime.datetime.utcnow()
+        request._logging_pass = 1
+        if settings.REQUEST_TIMING_SQL:
+            timer.watch_queries()
+        _local.timer = timer
+
+    def process_response(self, request, response):
+        timer = getattr(request, '_timer', None)
+        if timer is None:
+            # answered before this middleware ran, e.g. a CORS preflight
+            return response
+
+        _local.timer = None
+        timer.stop_watching_queries()
+        timer.finish()
+
+        if settings.REQUEST_TIMING_HEADER:
+            response['Server-Timing'] = timer.server_timing()
+
+        # a FileResponse keeps its file, for wsgi.file_wrapper
+        if response.streaming and getattr(response, 'file_to_stream', None) is None:
+            response.streaming_content = timed_stream(timer, request, response, response.streaming_content)
+        else:
+            log_record(timer, request, response)
+        log_stats_when_due()
+        return response
+
+
+class ViewTimingMiddleware(object):
+    """ Time the view; goes last in MIDDLEWARE_CLASSES """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        timer = getattr(request, '_timer', None)
+        if timer is not None:
+            timer.view_start = time.monotonic()
 
     def process_response(self, request, response):
-        s = getattr(response, 'status_code', 0)
-        r = str(s)
-        if s in (300, 301, 302, 307):
-            r += ' => %s' % response.get('Location', '?')
-        elif response.content:
-            r += ' (%db)' % len(response.content)
-        self.log_message(request, 'response', r)
+        timer = getattr(request, '_timer', None)
+        if timer is not None and timer.view_start is not None:
+            timer.add('view', time.monotonic() - timer.view_start)
+            timer.view_start = None
         return response
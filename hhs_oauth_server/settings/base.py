@@ -91,21 +91,49 @@ OPTIONAL_INSTALLED_APPS = ["", ]
 # otherwise the CORS headers will be lost from the 304 not-modified responses,
 # causing errors in some browsers.
 # See https://github.com/ottoyiu/django-cors-headers for more information.
+# The session, CSRF, auth, messages, clickjacking and social-auth
+# middleware come from hhs_oauth_server.api_middleware, which skips them
+# for bearer token API paths (API_FAST_PATH_PREFIXES)
+# CorsPreflightMiddleware answers CORS preflights for those paths before
+# anything else runs, so it stays first. RequestTimingMiddleware and
+# ViewTimingMiddleware time each request, around the middleware and
+# around the view.
 MIDDLEWARE_CLASSES = [
+    'hhs_oauth_server.api_middleware.CorsPreflightMiddleware',
+    'hhs_oauth_server.request_logging.RequestTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
-    'hhs_oauth_server.request_logging.RequestTimeLoggingMiddleware',
+    'hhs_oauth_server.api_middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
-    'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
-    'django.contrib.messages.middleware.MessageMiddleware',
-    'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'social_django.middleware.SocialAuthExceptionMiddleware',
+    'hhs_oauth_server.api_middleware.CsrfViewMiddleware',
+    'hhs_oauth_server.api_middleware.AuthenticationMiddleware',
+    'hhs_oauth_server.api_middleware.SessionAuthenticationMiddleware',
+    'hhs_oauth_server.api_middleware.MessageMiddleware',
+    'hhs_oauth_server.api_middleware.XFrameOptionsMiddleware',
+    'hhs_oauth_server.api_middleware.SocialAuthExceptionMiddleware',
+    'hhs_oauth_server.request_logging.ViewTimingMiddleware',
 ]
 
+# Send the per-phase timings of each request (see
+# hhs_oauth_server.request_logging) in a Server-Timing header
+REQUEST_TIMING_HEADER = bool_env(env('DJANGO_REQUEST_TIMING_HEADER', False))
+# Time SQL through the debug cursor, which keeps every query's SQL
+REQUEST_TIMING_SQL = bool_env(env('DJANGO_REQUEST_TIMING_SQL', False))
+# Seconds between the records of each worker's cache, pool and breaker
+# statistics on the performance logger (0 disables)
+REQUEST_STATS_INTERVAL = int_env(env('DJANGO_REQUEST_STATS_INTERVAL', 300))
+
+API_FAST_PATH_PREFIXES = ['/v1/fhir/',
+                          '/v1/connect/userinfo',
+                          '/v1/o/token/']
+
 CORS_ORIGIN_ALLOW_ALL = bool_env(env('CORS_ORIGIN_ALLOW_ALL', True))
+# Seconds browsers may reuse a preflight answer
+CORS_PREFLIGHT_MAX_AGE = int_env(env('DJANGO_CORS_PREFLIGHT_MAX_AGE', 86400))
+# Seconds CorsPreflightMiddleware keeps whether an origin is allowed,
+# for at most CORS_PREFLIGHT_ORIGIN_CACHE_SIZE origins
+CORS_PREFLIGHT_ORIGIN_CACHE_TTL = int_env(env('DJANGO_CORS_PREFLIGHT_ORIGIN_CACHE_TTL', 300))
+CORS_PREFLIGHT_ORIGIN_CACHE_SIZE = int_env(env('DJANGO_CORS_PREFLIGHT_ORIGIN_CACHE_SIZE', 1024))
 
 ROOT_URLCONF = 'hhs_oauth_server.urls'
 
@@ -308,6 +336,18 @@ DOT_EXPIRES_IN = (
     (86400 * 365 * 100, _('Forever')),
 )
 
+# Validated bearer tokens are cached (apps.dot_ext.token_cache) in the
+# CACHES entry named by TOKEN_CACHE_ALIAS, shared between workers, for up
+# to TOKEN_CACHE_TTL seconds, never past the token's expiry. 0 disables.
+TOKEN_CACHE_TTL = int_env(env('DJANGO_TOKEN_CACHE_TTL', 60))
+TOKEN_CACHE_ALIAS = env('DJANGO_TOKEN_CACHE_ALIAS', None)
+# Without TOKEN_CACHE_ALIAS, each worker can keep TOKEN_CACHE_SIZE tokens
+# of its own for TOKEN_CACHE_LOCAL_TTL seconds. Off by default: a token
+# revoked in one worker is still accepted by the others until their copy
+# expires.
+TOKEN_CACHE_LOCAL_TTL = int_env(env('DJANGO_TOKEN_CACHE_LOCAL_TTL', 0))
+TOKEN_CACHE_SIZE = int_env(env('DJANGO_TOKEN_CACHE_SIZE', 10000))
+
 GRANT_AUTHORIZATION_CODE = "authorization-code"
 GRANT_IMPLICIT = "implicit"
 GRANT_TYPES = (
@@ -431,6 +471,141 @@ FHIR_CLIENT_CERTSTORE = env('DJANGO_FHIR_CERTSTORE',
 # Timeout for request call
 REQUEST_CALL_TIMEOUT = (30, 120)
 
+# Pooled keep-alive connections to the backend FHIR server.
+# One pool per ResourceRouter per worker process (apps.fhir.server.sessions)
+FHIR_POOL_CONNECTIONS = int_env(env('DJANGO_FHIR_POOL_CONNECTIONS', 10))
+FHIR_POOL_MAXSIZE = int_env(env('DJANGO_FHIR_POOL_MAXSIZE', 10))
+# Block (rather than open extra connections) when the pool is exhausted
+FHIR_POOL_BLOCK = bool_env(env('DJANGO_FHIR_POOL_BLOCK', False))
+FHIR_KEEP_ALIVE = bool_env(env('DJANGO_FHIR_KEEP_ALIVE', True))
+# Identical concurrent backend GETs share one upstream call; callers
+# waiting on another's call give up after FHIR_COALESCE_WAIT seconds
+# (or the router's wait_time) and make their own.
+FHIR_COALESCE_REQUESTS = bool_env(env('DJANGO_FHIR_COALESCE_REQUESTS', True))
+FHIR_COALESCE_WAIT = int_env(env('DJANGO_FHIR_COALESCE_WAIT', 30))
+# Per-router circuit breaker (apps.fhir.server.resilience): open after
+# FHIR_BREAKER_FAILURES consecutive failures, fail fast with a 503 for
+# FHIR_BREAKER_RESET seconds, then let FHIR_BREAKER_PROBES calls through.
+FHIR_BREAKER_FAILURES = int_env(env('DJANGO_FHIR_BREAKER_FAILURES', 5))
+FHIR_BREAKER_RESET = int_env(env('DJANGO_FHIR_BREAKER_RESET', 30))
+FHIR_BREAKER_PROBES = int_env(env('DJANGO_FHIR_BREAKER_PROBES', 1))
+# Backend timeouts: read timeout is FHIR_TIMEOUT_MULTIPLIER times the
+# FHIR_TIMEOUT_PERCENTILE latency of the last FHIR_LATENCY_WINDOW calls
+# per resource type, between FHIR_TIMEOUT_FLOOR and the router's wait_time.
+FHIR_CONNECT_TIMEOUT = int_env(env('DJANGO_FHIR_CONNECT_TIMEOUT', 5))
+FHIR_TIMEOUT_PERCENTILE = int_env(env('DJANGO_FHIR_TIMEOUT_PERCENTILE', 99))
+FHIR_TIMEOUT_MULTIPLIER = int_env(env('DJANGO_FHIR_TIMEOUT_MULTIPLIER', 3))
+FHIR_TIMEOUT_FLOOR = int_env(env('DJANGO_FHIR_TIMEOUT_FLOOR', 2))
+FHIR_LATENCY_WINDOW = int_env(env('DJANGO_FHIR_LATENCY_WINDOW', 200))
+FHIR_LATENCY_MIN_SAMPLES = int_env(env('DJANGO_FHIR_LATENCY_MIN_SAMPLES', 20))
+# Backend calls in flight per router and resource type, per worker (0 for
+# no limit). Up to FHIR_MAX_QUEUED_CALLS more wait FHIR_QUEUE_TIMEOUT
+# seconds for a slot; the rest get a 503.
+FHIR_MAX_CONCURRENT_CALLS = int_env(env('DJANGO_FHIR_MAX_CONCURRENT_CALLS', 10))
+FHIR_MAX_QUEUED_CALLS = int_env(env('DJANGO_FHIR_MAX_QUEUED_CALLS', 20))
+FHIR_QUEUE_TIMEOUT = int_env(env('DJANGO_FHIR_QUEUE_TIMEOUT', 5))
+# Retry failed backend GETs (connection errors, timeouts, 502/503/504):
+# FHIR_RETRY_ATTEMPTS attempts in all, 1 for no retries. Backoff doubles
+# from FHIR_RETRY_BACKOFF_MS up to FHIR_RETRY_BACKOFF_MAX_MS, with jitter.
+# Retries per router are held to FHIR_RETRY_BUDGET percent of calls, with
+# at most FHIR_RETRY_BUDGET_CAP saved up.
+FHIR_RETRY_ATTEMPTS = int_env(env('DJANGO_FHIR_RETRY_ATTEMPTS', 1))
+FHIR_RETRY_BACKOFF_MS = int_env(env('DJANGO_FHIR_RETRY_BACKOFF_MS', 100))
+FHIR_RETRY_BACKOFF_MAX_MS = int_env(env('DJANGO_FHIR_RETRY_BACKOFF_MAX_MS', 2000))
+FHIR_RETRY_BUDGET = int_env(env('DJANGO_FHIR_RETRY_BUDGET', 10))
+FHIR_RETRY_BUDGET_CAP = int_env(env('DJANGO_FHIR_RETRY_BUDGET_CAP', 10))
+
+# ResourceRouter / SupportedResourceType rows are cached per worker
+# (apps.fhir.server.config) and reloaded when the version counter held in
+# this cache changes. Use a cache shared by all workers in production.
+FHIR_CONFIG_CACHE_ALIAS = env('DJANGO_FHIR_CONFIG_CACHE_ALIAS', 'default')
+# Seconds between checks of the version counter
+FHIR_CONFIG_CHECK_INTERVAL = int_env(env('DJANGO_FHIR_CONFIG_CHECK_INTERVAL', 5))
+# Seconds a worker keeps its copy even when the counter has not moved,
+# which bounds how stale it gets if the cache is not shared
+FHIR_CONFIG_MAX_AGE = int_env(env('DJANGO_FHIR_CONFIG_MAX_AGE', 60))
+
+# Return rewritten backend responses without a json parse/re-encode
+FHIR_RESPONSE_PASSTHROUGH = bool_env(env('DJANGO_FHIR_RESPONSE_PASSTHROUGH', True))
+
+# Search bodies are read in FHIR_STREAM_CHUNK_SIZE pieces. Once more than
+# this many bytes (after any Content-Encoding is undone) have been read,
+# the rest is streamed to the client instead of being held in memory;
+# Content-Length plays no part.
+FHIR_STREAM_MEMORY_CEILING = int_env(env('DJANGO_FHIR_STREAM_MEMORY_CEILING', 1024 * 1024))
+FHIR_STREAM_CHUNK_SIZE = int_env(env('DJANGO_FHIR_STREAM_CHUNK_SIZE', 64 * 1024))
+
+# The default cache is per-process unless DJANGO_CACHE_BACKEND names one
+# shared by all workers (e.g. memcached, with DJANGO_CACHE_LOCATION).
+# Purges of cached searches, router config changes and token revocations
+# only reach every worker through a shared cache.
+CACHES = {
+    'default': {
+        'BACKEND': env('DJANGO_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': env('DJANGO_CACHE_LOCATION', ''),
+    }
+}
+
+# Django cache (CACHES alias) holding proxied FHIR responses. Must be
+# shared by all workers for purge_search_cache to work.
+FHIR_CACHE_ALIAS = env('DJANGO_FHIR_CACHE_ALIAS', 'default')
+# Filtered CapabilityStatement served at /v1/fhir/metadata: kept for
+# FHIR_METADATA_CACHE_TTL seconds and rebuilt in the background once it is
+# within FHIR_METADATA_REFRESH_AHEAD seconds of expiry.
+FHIR_METADATA_CACHE_TTL = int_env(env('DJANGO_FHIR_METADATA_CACHE_TTL', 3600))
+FHIR_METADATA_REFRESH_AHEAD = int_env(env('DJANGO_FHIR_METADATA_REFRESH_AHEAD', 300))
+# Cache-Control max-age sent to clients
+FHIR_METADATA_MAX_AGE = int_env(env('DJANGO_FHIR_METADATA_MAX_AGE', 300))
+
+# Per-beneficiary search results are cached for the router's
+# server_search_expiry seconds (0 disables) for these resource types.
+FHIR_SEARCH_CACHE_RESOURCE_TYPES = ['ExplanationOfBenefit', 'Coverage']
+FHIR_SEARCH_CACHE_COMPRESSLEVEL = int_env(env('DJANGO_FHIR_SEARCH_CACHE_COMPRESSLEVEL', 6))
+# Largest _count asked of the backend for one page of a search, per
+# resource type; also the page size when the client gives no _count.
+FHIR_PAGE_SIZE_MAX = int_env(env('DJANGO_FHIR_PAGE_SIZE_MAX', 100))
+FHIR_PAGE_SIZE_MAX_BY_TYPE = {'ExplanationOfBenefit': 50}
+# Fetch the next page of a cacheable search into the search cache when a
+# client asks for a page past the first
+FHIR_PAGE_PREFETCH = bool_env(env('DJANGO_FHIR_PAGE_PREFETCH', False))
+# Send a search's _elements/_summary on to a backend that honors them,
+# instead of projecting the results here (reads are always projected here)
+FHIR_PROJECTION_PASSTHROUGH = bool_env(env('DJANGO_FHIR_PROJECTION_PASSTHROUGH', False))
+# Seconds the ETag/Last-Modified of a read or search response are kept,
+# so that a matching conditional request gets a 304 without a backend
+# call (0 disables)
+FHIR_VALIDATOR_CACHE_TTL = int_env(env('DJANGO_FHIR_VALIDATOR_CACHE_TTL', 60))
+# gzip level for proxied FHIR responses, sent to clients that accept
+# gzip when the body is at least FHIR_COMPRESS_MIN_SIZE bytes
+FHIR_COMPRESS_LEVEL = int_env(env('DJANGO_FHIR_COMPRESS_LEVEL', 6))
+FHIR_COMPRESS_MIN_SIZE = int_env(env('DJANGO_FHIR_COMPRESS_MIN_SIZE', 1024))
+# Threads per worker for views that make several backend calls at once
+# (apps.fhir.bluebutton.fanout)
+FHIR_FANOUT_WORKERS = int_env(env('DJANGO_FHIR_FANOUT_WORKERS', 10))
+# Pages of each search followed by Patient/$everything before it stops
+# and links to the rest
+FHIR_EVERYTHING_MAX_PAGES = int_env(env('DJANGO_FHIR_EVERYTHING_MAX_PAGES', 10))
+# Most entries accepted in one POST /v1/fhir/ batch Bundle
+FHIR_BATCH_MAX_ENTRIES = int_env(env('DJANGO_FHIR_BATCH_MAX_ENTRIES', 50))
+# Patient/$export bulk exports (apps.fhir.bluebutton.export). Files go to
+# FHIR_EXPORT_STORAGE, a dotted storage class path such as
+# 'hhs_oauth_server.s3_storage.MediaStorage', or when that is empty to
+# FHIR_EXPORT_ROOT on local disk (not served as media: downloads are
+# checked against the job's owner).
+FHIR_EXPORT_STORAGE = env('DJANGO_FHIR_EXPORT_STORAGE', '')
+FHIR_EXPORT_ROOT = env('DJANGO_FHIR_EXPORT_ROOT', os.path.join(BASE_DIR, 'export'))
+# _count asked of the backend for each page of a search being exported
+FHIR_EXPORT_PAGE_SIZE = int_env(env('DJANGO_FHIR_EXPORT_PAGE_SIZE', 100))
+# Retry-After sent to clients polling an unfinished export
+FHIR_EXPORT_POLL_INTERVAL = int_env(env('DJANGO_FHIR_EXPORT_POLL_INTERVAL', 10))
+# Seconds process_export_jobs sleeps when there is no queued job
+FHIR_EXPORT_WORKER_SLEEP = int_env(env('DJANGO_FHIR_EXPORT_WORKER_SLEEP', 5))
+# A running export not heard from for this many seconds lost its worker:
+# it is queued again, or failed once it has been tried
+# FHIR_EXPORT_MAX_ATTEMPTS times
+FHIR_EXPORT_STALE_AFTER = int_env(env('DJANGO_FHIR_EXPORT_STALE_AFTER', 600))
+FHIR_EXPORT_MAX_ATTEMPTS = int_env(env('DJANGO_FHIR_EXPORT_MAX_ATTEMPTS', 2))
+
 SIGNUP_TIMEOUT_DAYS = env('SIGNUP_TIMEOUT_DAYS', 7)
 ORGANIZATION_NAME = env('DJANGO_ORGANIZATION_NAME', 'CMS Blue Button API')
 
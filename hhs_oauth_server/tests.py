@@ -10,7 +10,20 @@ Created: 10/20/16 11:24 PM
 File created by: 'Mark Scrimshire: @ekivemark'
 """
 
-from django.test import TestCase
+import json
+
+from django.conf import settings
+from collections import deque
+
+from django.core.signals import request_finished
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from unittest.mock import patch
+
+from apps.fhir.bluebutton.tests.test_views import FHIR_ID, FhirProxyViewTestCase, backend_response
+from . import request_logging
+from .api_middleware import CorsPreflightMiddleware
 from .utils import bool_env, TRUE_LIST, FALSE_LIST, int_env
 
 
@@ -49,3 +62,177 @@ class Check_IntFromText_Test(TestCase):
         for x, y in int_list:
             result = int_env(x)
             self.assertEqual(result, y)
+
+
+class ApiFastPathTest(FhirProxyViewTestCase):
+    """ Browser-only middleware is skipped on bearer token API paths """
+
+    def setUp(self):
+        super(ApiFastPathTest, self).setUp()
+        # a client that also holds a logged in session
+        self.client.login(username='beneficiary', password='secret')
+        self.session.get.return_value = backend_response({'resourceType': 'Patient', 'id': FHIR_ID})
+
+    def test_fhir_call_skips_session(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/v1/fhir/Patient/%s' % FHIR_ID, **self.auth_headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([q for q in queries if 'django_session' in q['sql']])
+        self.assertFalse(response.has_header('X-Frame-Options'))
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+
+    def test_browser_path_keeps_middleware(self):
+        response = self.client.get('/')
+
+        self.assertTrue(response.has_header('X-Frame-Options'))
+        self.assertTrue(response.wsgi_request.user.is_authenticated())
+
+
+class CorsPreflightTest(TestCase):
+    """ CORS preflights for API paths are answered ahead of the stack """
+
+    preflight = {'HTTP_ORIGIN': 'https://app.example.com',
+                 'HTTP_ACCESS_CONTROL_REQUEST_METHOD': 'GET',
+                 'HTTP_ACCESS_CONTROL_REQUEST_HEADERS': 'authorization'}
+
+    def test_preflight(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.options('/v1/fhir/Patient/%s' % FHIR_ID, **self.preflight)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Access-Control-Allow-Origin'], '*')
+        self.assertIn('authorization', response['Access-Control-Allow-Headers'])
+        self.assertIn('GET', response['Access-Control-Allow-Methods'])
+        self.assertEqual(response['Access-Control-Max-Age'], str(settings.CORS_PREFLIGHT_MAX_AGE))
+        self.assertTrue(response.wsgi_request._cors_preflight)
+        self.assertEqual(len(queries), 0)
+
+    def test_other_requests_fall_through(self):
+        request = RequestFactory().options('/v1/fhir/Patient/%s' % FHIR_ID, HTTP_ORIGIN='https://app.example.com')
+        self.assertIsNone(CorsPreflightMiddleware().process_request(request))
+
+        request = RequestFactory().options('/v1/accounts/mfa/login', **self.preflight)
+        self.assertIsNone(CorsPreflightMiddleware().process_request(request))
+
+    def test_origin_allowlist_cached(self):
+        middleware = CorsPreflightMiddleware()
+        middleware.allow_all = False
+        middleware.echo_origin = True
+        request = RequestFactory().options('/v1/fhir/Patient/%s' % FHIR_ID, **self.preflight)
+
+        with patch('hhs_oauth_server.api_middleware.origin_allowed', return_value=True) as origin_allowed:
+            first = middleware.process_request(request)
+            second = middleware.process_request(request)
+
+        origin_allowed.assert_called_once_with('https://app.example.com')
+        self.assertEqual(second['Access-Control-Allow-Origin'], 'https://app.example.com')
+        self.assertEqual(second['Vary'], 'Origin')
+        self.assertEqual(sorted(first.items()), sorted(second.items()))
+
+    def test_origin_refused(self):
+        middleware = CorsPreflightMiddleware()
+        middleware.allow_all = False
+        request = RequestFactory().options('/v1/fhir/Patient/%s' % FHIR_ID, **self.preflight)
+
+        with patch('hhs_oauth_server.api_middleware.origin_allowed', return_value=False):
+            response = middleware.process_request(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('Access-Control-Allow-Origin'))
+
+
+class RequestTimingTest(FhirProxyViewTestCase):
+    """ Per-phase timings of a FHIR call """
+
+    def setUp(self):
+        super(RequestTimingTest, self).setUp()
+        self.session.get.return_value = backend_response({'resourceType': 'Patient', 'id': FHIR_ID})
+
+    def logged_record(self, logger):
+        self.assertEqual(logger.info.call_count, 1)
+        return json.loads(logger.info.call_args[0][0])
+
+    @override_settings(REQUEST_TIMING_HEADER=True)
+    def test_server_timing(self):
+        with patch('hhs_oauth_server.request_logging.logger') as logger:
+            response = self.client.get('/v1/fhir/Patient/%s' % FHIR_ID, **self.auth_headers)
+
+        phases = dict(entry.split(';dur=') for entry in response['Server-Timing'].split(', '))
+        for name in ('token', 'backend', 'backend_ttfb', 'backend_download', 'rewrite', 'serialize',
+                     'view', 'middleware', 'total'):
+            self.assertIn(name, phases)
+        self.assertGreaterEqual(float(phases['total']), float(phases['view']))
+
+        record = self.logged_record(logger)
+        self.assertEqual(record['request_id'], str(response.wsgi_request._logging_uuid))
+        self.assertEqual(record['status'], 200)
+        self.assertEqual(set(record['phases']), set(phases))
+        # the body of a read is downloaded after the headers, not by session.get
+        self.assertTrue(self.session.get.call_args[1]['stream'])
+
+    def test_header_is_opt_in(self):
+        response = self.client.get('/v1/fhir/Patient/%s' % FHIR_ID, **self.auth_headers)
+
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    @override_settings(FHIR_STREAM_MEMORY_CEILING=10)
+    def test_streamed_body_logged_when_sent(self):
+        self.session.get.return_value = backend_response({'resourceType': 'Bundle', 'type': 'searchset', 'total': 0})
+
+        with patch('hhs_oauth_server.request_logging.logger') as logger:
+            response = self.client.get('/v1/fhir/Coverage/', **self.auth_headers)
+            self.assertTrue(response.streaming)
+            self.assertFalse(logger.info.called)
+            content = b''.join(response.streaming_content)
+
+        self.assertEqual(json.loads(content.decode('utf-8'))['total'], 0)
+        record = self.logged_record(logger)
+        self.assertTrue(record['streaming'])
+        self.assertIn('stream', record['phases'])
+
+    @override_settings(REQUEST_STATS_INTERVAL=60)
+    def test_worker_stats_logged(self):
+        """ Pool, coalescing, breaker and cache counters, once per interval """
+        with patch.object(request_logging, '_stats_logged_at', float('-inf')), \
+                patch('hhs_oauth_server.request_logging.logger') as logger:
+            self.client.get('/v1/fhir/Patient/%s' % FHIR_ID, **self.auth_headers)
+            self.client.get('/v1/fhir/Patient/%s' % FHIR_ID, **self.auth_headers)
+
+        records = [json.loads(c[0][0]) for c in logger.info.call_args_list]
+        stats = [r['stats'] for r in records if 'stats' in r]
+        self.assertEqual(len(stats), 1)
+        for name in ('search_cache', 'resilience', 'coalescing', 'connection_pools'):
+            self.assertIn(name, stats[0])
+        self.assertEqual(stats[0]['coalescing']['in_flight'], 0)
+        self.assertIn('1:Patient', stats[0]['resilience']['limiters'])
+
+    @override_settings(REQUEST_TIMING_SQL=True)
+    def test_sql_counted_past_queries_limit(self):
+        """ A full queries_log still gets every query counted """
+        with patch('hhs_oauth_server.request_logging.logger') as logger:
+            self.client.get('/v1/fhir/Patient/%s' % FHIR_ID, **self.auth_headers)
+        expected = self.logged_record(logger)['counts']['db']
+
+        self.session.get.return_value = backend_response({'resourceType': 'Patient', 'id': FHIR_ID})
+        queries_log = deque([{'sql': '', 'time': '0.000'}], maxlen=1)
+        with patch.object(connection, 'queries_log', queries_log), \
+                patch('hhs_oauth_server.request_logging.logger') as logger:
+            self.client.get('/v1/fhir/Patient/%s' % FHIR_ID, **self.auth_headers)
+            self.assertIs(connection.queries_log, queries_log)
+
+        self.assertEqual(self.logged_record(logger)['counts']['db'], expected)
+        self.assertFalse(connection.force_debug_cursor)
+
+    @override_settings(REQUEST_TIMING_SQL=True)
+    def test_timer_forgotten_when_request_finishes(self):
+        """ Even when RequestTimingMiddleware.process_response did not run """
+        request = RequestFactory().get('/v1/fhir/metadata')
+        request_logging.RequestTimingMiddleware().process_request(request)
+        self.assertIsNotNone(request_logging.current_timer())
+        self.assertTrue(connection.force_debug_cursor)
+
+        request_finished.send(sender=self.__class__)
+
+        self.assertIsNone(request_logging.current_timer())
+        self.assertFalse(connection.force_debug_cursor)